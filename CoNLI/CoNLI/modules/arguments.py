@@ -107,6 +107,18 @@ class MitigationArguments:
     generations: Optional[int] = field(
         default=1, metadata={"help": "Number of generations (outputs) to produce"}
     )
+    mode: Optional[str] = field(
+        default='document', metadata={"help": "document: rewrite the whole response; sentence: rewrite only the flagged sentences, with local context, and splice them back"}
+    )
+    context_chars: Optional[int] = field(
+        default=300, metadata={"help": "Characters of the response shown before and after each flagged sentence in sentence mode"}
+    )
+    pack_token_budget: Optional[int] = field(
+        default=0, metadata={"help": "Pack the document-level rewrites of short data into one request while their sources, responses and instructions fit in this many tokens. 0 sends one request per data"}
+    )
+    pack_max_documents: Optional[int] = field(
+        default=8, metadata={"help": "Maximum number of data packed into one request"}
+    )
 
 @dataclass
 class TAArguments:
@@ -1,37 +1,87 @@
 from glob import glob
 import os
-from typing import Dict
-import pandas as pd
+import threading
+from collections.abc import Mapping
+from typing import Callable, Dict, Iterator, List, Tuple
+from CoNLI.modules.data.packed_corpus import PackedCorpus
+from CoNLI.modules.data.parallel_preprocess import preprocess_stream
+from CoNLI.modules.data.record_input import create_response_preprocess, record_sentences
 from CoNLI.modules.data.response_preprocess import ResponsePreprocess
+from CoNLI.modules.hd_constants import FieldName
+from CoNLI.modules.hypothesis_memo import HypothesisMemo
+
+
+class LazyMapping(Mapping):
+    """Read-only data_id -> value mapping whose values are computed by load(data_id) on every access, and not kept."""
+    def __init__(self, data_ids : List[str], load : Callable[[str], object]) -> None:
+        self._data_ids = data_ids
+        self._keys = set(data_ids)
+        self._load = load
+
+    def __getitem__(self, data_id : str):
+        if data_id not in self._keys:
+            raise KeyError(data_id)
+        return self._load(data_id)
+
+    def __contains__(self, data_id) -> bool:
+        return data_id in self._keys
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._data_ids)
+
+    def __len__(self) -> int:
+        return len(self._data_ids)
 
 
 class DataLoader:
 
     def __init__(self,
                  hypothesis: str,
-                 src_folder: str,
-                 test_mode: int = 0) -> None:
+                 src_folder: str = None,
+                 test_mode: int = 0,
+                 data_id_filter: Callable[[str], bool] = None,
+                 lazy: bool = False,
+                 preprocess_workers: int = 0) -> None:
+        # data_id_filter: only data ids for which it returns True are loaded (e.g. the data of one shard)
+        self._data_id_filter = data_id_filter
+        # lazy: only the data ids are listed up front, documents are read (and responses split into
+        # sentences) when the pipeline asks for them. A packed corpus (.jsonl) is always read lazily.
+        self._lazy = lazy
+        # preprocess_workers: split the responses into sentences in that many processes
+        self._preprocess_workers = preprocess_workers
+        self._split_responses = False
+        self._response_preprocess = None
+        self._preprocess_lock = threading.Lock()
 
         self._hypothesis = {}
         self._src_docs = {}
         self._hypothesis_preproc_sentences = {}
         self._data_ids = list()
 
-        if os.path.isdir(hypothesis):
-            self._hypothesis = self.__load_file_inputs(hypothesis, "*.txt")
-            self._hypothesis_preproc_sentences = self.hypothesis_preprocess_into_sentences(
-                self._hypothesis)
-        elif os.path.isfile(hypothesis) and hypothesis.endswith('.tsv'):
-            self._hypothesis_preproc_sentences = self.__load_sentencelevel_file(
-                hypothesis)  # hypothesis here is sentences
+        if os.path.isfile(hypothesis) and hypothesis.endswith('.jsonl'):
+            self.__load_packed_corpus(hypothesis)
         else:
-            raise ValueError(
-                '--input_hypothesis is incorrect. not a valid path or not a tsv file.')
+            if os.path.isdir(hypothesis):
+                self._hypothesis = self.__load_file_inputs(hypothesis, "*.txt")
+                self._split_responses = True
+                if lazy:
+                    self._hypothesis_preproc_sentences = LazyMapping(list(self._hypothesis.keys()), lambda data_id: self.preprocess_response(self._hypothesis[data_id]))
+                else:
+                    self._hypothesis_preproc_sentences = self.hypothesis_preprocess_into_sentences(
+                        self._hypothesis)
+            elif os.path.isfile(hypothesis) and hypothesis.endswith('.tsv'):
+                self._hypothesis_preproc_sentences = self.__load_sentencelevel_file(
+                    hypothesis)  # hypothesis here is sentences
+            else:
+                raise ValueError(
+                    '--input_hypothesis is incorrect. not a valid path, a tsv file or a packed jsonl corpus.')
 
-        print(f'Hypotheses Found: {len(self._hypothesis_preproc_sentences)}')
+            print(f'Hypotheses Found: {len(self._hypothesis_preproc_sentences)}')
 
-        self._src_docs = self.__load_file_inputs(src_folder, "*.txt")
-        print(f'Source Files Found: {len(self._src_docs)}')
+            self._src_docs = self.__load_file_inputs(src_folder, "*.txt")
+            print(f'Source Files Found: {len(self._src_docs)}')
+            if not lazy:
+                self._src_docs = DataLoader.intern_texts(self._src_docs)
 
         self._data_ids = list(set(self._hypothesis_preproc_sentences.keys(
         )).intersection(set(self._src_docs.keys())))
@@ -45,28 +95,67 @@ class DataLoader:
             print(
                 f'Running reduced dataset of {test_mode} IDs: {self._data_ids} ...')
 
+    def __keep(self, data_id : str) -> bool:
+        return self._data_id_filter is None or self._data_id_filter(data_id)
+
     def __load_file_inputs(self, folderpath: str,
                            searchpattern: str = "") -> Dict[str, str]:
-        retval = {}
+        paths = {}
         for fname in glob(os.path.join(folderpath, searchpattern)):
-            with open(fname, "r", encoding="utf-8") as f:
-                fnamenoext = os.path.splitext(os.path.basename(fname))[0]
-                retval[fnamenoext] = f.read()
-        return retval
+            fnamenoext = os.path.splitext(os.path.basename(fname))[0]
+            if self.__keep(fnamenoext):
+                paths[fnamenoext] = fname
+        if self._lazy:
+            return LazyMapping(sorted(paths), lambda data_id: DataLoader.read_text(paths[data_id]))
+        return {data_id: DataLoader.read_text(fname) for data_id, fname in paths.items()}
+
+    # data ids with the same source content share one str (e.g. several summaries of one article)
+    @staticmethod
+    def intern_texts(texts : Dict[str, str]) -> Dict[str, str]:
+        by_content = {}
+        interned = {data_id: by_content.setdefault(HypothesisMemo.source_key(text), text) for data_id, text in texts.items()}
+        if len(by_content) < len(texts):
+            print(f'Unique Sources: {len(by_content)} of {len(texts)}')
+        return interned
+
+    @staticmethod
+    def read_text(fname : str) -> str:
+        with open(fname, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def __load_packed_corpus(self, corpus_path : str) -> None:
+        corpus = PackedCorpus(corpus_path)
+        data_ids = [data_id for data_id in corpus.data_ids() if self.__keep(data_id)]
+        print(f'Packed Corpus Records Found: {len(data_ids)}')
+
+        def raw_response(data_id : str) -> str:
+            record = corpus.get(data_id)
+            if 'response' in record:
+                return record['response']
+            return ' '.join(s[FieldName.SENTENCE_TEXT] if isinstance(s, dict) else s for s in record['sentences'])
+
+        self._src_docs = LazyMapping(data_ids, lambda data_id: corpus.get(data_id)['source'])
+        self._hypothesis = LazyMapping(data_ids, raw_response)
+        self._hypothesis_preproc_sentences = LazyMapping(data_ids, lambda data_id: record_sentences(corpus.get(data_id), self.__get_response_preprocess()))
 
     def __load_sentencelevel_file(self, hypothesisfile) -> dict:
+        # pandas is only imported for sentence-level tsv inputs
+        import pandas as pd
         hypdf = pd.read_csv(hypothesisfile, sep='\t', header=0)
-        hypsens = {}
         important_columns = hypdf[["DataID", "SentenceID", "Sentence"]]
         important_columns = important_columns.drop_duplicates()
-        for index, row in important_columns.iterrows():
-            # because the loaded result IDs are int, but source IDs are string
-            En_Id = str(row["DataID"])
+        # because the loaded result IDs are int, but source IDs are string
+        data_ids = important_columns["DataID"].astype(str)
+        if self._data_id_filter is not None:
+            keep = data_ids.map(self._data_id_filter).astype(bool)
+            important_columns, data_ids = important_columns[keep], data_ids[keep]
+        hypsens = {}
+        for En_Id, sentence_id, sentence in zip(data_ids.tolist(), important_columns["SentenceID"].tolist(), important_columns["Sentence"].tolist()):
             if not hypsens.__contains__(En_Id):
                 hypsens[En_Id] = []
             sen_dict = {
-                'sentence_id': row["SentenceID"],
-                'text': row["Sentence"]
+                'sentence_id': sentence_id,
+                'text': sentence
             }
             hypsens[En_Id].append(sen_dict)
         return hypsens
@@ -80,16 +169,32 @@ class DataLoader:
         if len(self._data_ids) != len(self._hypothesis_preproc_sentences) or len(self._data_ids) != len(self._src_docs):
             print('=============\n!! WARNING !!\n=============\nThe number of unique data ids is different between your source and hypothesis folders.\nPlease confirm your inputs are correct before proceeding...\n=============')
 
-    def hypothesis_preprocess_into_sentences(self, hypothesis) -> dict:
-        hyp_sentences_preproc = {}
+    def __get_response_preprocess(self) -> ResponsePreprocess:
         # Configure response preprocessing module
         # There is an expectation that the input data is cleaned before running Hallucination Detection
-        preprocess_skipStartsWithSet = set(['#'])
-        preprocess_replaceWordSet = set([])
-        responsepreprocess = ResponsePreprocess(
-            skip_starts_with_set=preprocess_skipStartsWithSet,
-            replace_set=preprocess_replaceWordSet)
+        with self._preprocess_lock:
+            if self._response_preprocess is None:
+                self._response_preprocess = create_response_preprocess()
+        return self._response_preprocess
+
+    def preprocess_response(self, text : str) -> List[Dict[str, str]]:
+        return self.__get_response_preprocess().preprocess(text)
+
+    def hypothesis_preprocess_into_sentences(self, hypothesis) -> dict:
+        if self._preprocess_workers > 0:
+            return dict(preprocess_stream(hypothesis.items(), self._preprocess_workers))
+        hyp_sentences_preproc = {}
         for id in hypothesis.keys():
-            hyp_sentences_preproc[id] = responsepreprocess.Preprocess(
+            hyp_sentences_preproc[id] = self.preprocess_response(
                 hypothesis[id])
         return hyp_sentences_preproc
+
+    # lazily loaded responses split by the preprocessing process pool, see stream_hypothesis_sentences
+    @property
+    def streams_preprocessing(self) -> bool:
+        return self._lazy and self._split_responses and self._preprocess_workers > 0
+
+    # yields (data_id, sentences) of the given data ids as the process pool splits them (not in data_ids
+    # order), so that the caller can start detecting the first data while the others are being split
+    def stream_hypothesis_sentences(self, data_ids : List[str]) -> Iterator[Tuple[str, List[Dict]]]:
+        return preprocess_stream(((data_id, self._hypothesis[data_id]) for data_id in data_ids), self._preprocess_workers)
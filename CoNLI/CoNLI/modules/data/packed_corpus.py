@@ -0,0 +1,104 @@
+# a corpus packed into one jsonl file of {"data_id", "source", "response" | "sentences"} records, plus an
+# index of the byte offset and length of every record (<corpus>.idx, tab separated). Records are read on
+# demand from a memory map, so opening a corpus of millions of documents costs one open() and the index.
+
+import json
+import mmap
+import os
+from collections.abc import Mapping
+from typing import Dict, List, Tuple
+
+INDEX_SUFFIX = '.idx'
+
+
+def index_path(corpus_path : str) -> str:
+    return corpus_path + INDEX_SUFFIX
+
+
+# scans the corpus once and writes its index
+def build_index(corpus_path : str) -> Dict[str, Tuple[int, int]]:
+    index = {}
+    offset = 0
+    with open(corpus_path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                data_id = str(json.loads(line)['data_id'])
+                if data_id in index:
+                    raise ValueError(f'data_id {data_id} appears more than once in {corpus_path}')
+                index[data_id] = (offset, len(line))
+            offset += len(line)
+    write_index(corpus_path, index)
+    return index
+
+
+def write_index(corpus_path : str, index : Dict[str, Tuple[int, int]]) -> None:
+    tmp_path = f'{index_path(corpus_path)}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for data_id, (offset, length) in index.items():
+            f.write(f'{data_id}\t{offset}\t{length}\n')
+    os.replace(tmp_path, index_path(corpus_path))
+
+
+def read_index(corpus_path : str) -> Dict[str, Tuple[int, int]]:
+    index = {}
+    with open(index_path(corpus_path), 'r', encoding='utf-8') as f:
+        for line in f:
+            data_id, offset, length = line.rstrip('\n').split('\t')
+            index[data_id] = (int(offset), int(length))
+    return index
+
+
+class PackedCorpus:
+    """
+    Read-only, thread-safe access to the records of a packed corpus by data id. The index is rebuilt when
+    it is missing or older than the corpus.
+    """
+    def __init__(self, corpus_path : str) -> None:
+        self.path = corpus_path
+        idx = index_path(corpus_path)
+        if not os.path.isfile(idx) or os.path.getmtime(idx) < os.path.getmtime(corpus_path):
+            self._index = build_index(corpus_path)
+        else:
+            self._index = read_index(corpus_path)
+        self._file = open(corpus_path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(corpus_path) > 0 else None
+
+    def data_ids(self) -> List[str]:
+        return list(self._index.keys())
+
+    def __contains__(self, data_id : str) -> bool:
+        return data_id in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, data_id : str) -> Dict:
+        offset, length = self._index[data_id]
+        return json.loads(self._mmap[offset:offset + length])
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+
+# packs responses (data_id -> text) or sentences (data_id -> list of sentences, e.g. from a sentence-level tsv)
+# and a folder of sources into a corpus; only data ids present in both are written. The mappings may be lazy.
+def pack_corpus(corpus_path : str, src_folder : str, responses : Mapping = None, sentences : Mapping = None) -> int:
+    hypotheses = responses if responses is not None else sentences
+    field = 'response' if responses is not None else 'sentences'
+    index = {}
+    offset = 0
+    with open(corpus_path, 'wb') as f:
+        for data_id in sorted(hypotheses):
+            src_file = os.path.join(src_folder, f'{data_id}.txt')
+            if not os.path.isfile(src_file):
+                continue
+            with open(src_file, 'r', encoding='utf-8') as src:
+                line = (json.dumps({'data_id': data_id, 'source': src.read(), field: hypotheses[data_id]}) + '\n').encode('utf-8')
+            f.write(line)
+            index[data_id] = (offset, len(line))
+            offset += len(line)
+    write_index(corpus_path, index)
+    return len(index)
+
@@ -0,0 +1,46 @@
+# sentence splitting of responses in a process pool, streamed back chunk by chunk so that detection of the
+# first data can start while the rest of the corpus is still being split
+
+import itertools
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from CoNLI.modules.data.record_input import create_response_preprocess
+
+_worker_preprocess = None
+
+
+def _init_worker() -> None:
+    # punkt is loaded once per worker process
+    global _worker_preprocess
+    _worker_preprocess = create_response_preprocess()
+
+
+def _preprocess_chunk(chunk : List[Tuple[str, str]]) -> List[Tuple[str, List[Dict]]]:
+    return [(data_id, _worker_preprocess.preprocess(text)) for data_id, text in chunk]
+
+
+# yields (data_id, sentences) for every (data_id, response) of texts, in completion order. texts is consumed
+# lazily: at most 2 x workers chunks are read ahead of the consumer.
+def preprocess_stream(texts : Iterable[Tuple[str, str]], workers : int, chunk_size : int = 16) -> Iterator[Tuple[str, List[Dict]]]:
+    texts = iter(texts)
+    if workers <= 0:
+        preprocess = create_response_preprocess()
+        for data_id, text in texts:
+            yield data_id, preprocess.preprocess(text)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        in_flight = set()
+        exhausted = False
+        while not exhausted or in_flight:
+            while not exhausted and len(in_flight) < 2 * workers:
+                chunk = list(itertools.islice(texts, max(chunk_size, 1)))
+                if len(chunk) == 0:
+                    exhausted = True
+                else:
+                    in_flight.add(executor.submit(_preprocess_chunk, chunk))
+            if in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
@@ -0,0 +1,43 @@
+# single-document inputs given as json records, {"data_id", "source", "response" | "sentences"},
+# as read by the streaming runner and the detection service
+
+import json
+from typing import Dict, Iterator, List, TextIO, Tuple
+
+from CoNLI.modules.data.response_preprocess import ResponsePreprocess
+from CoNLI.modules.hd_constants import FieldName
+
+
+class RecordError(ValueError):
+    pass
+
+
+def create_response_preprocess() -> ResponsePreprocess:
+    # same preprocessing as DataLoader applies to a folder of responses
+    return ResponsePreprocess(skip_starts_with_set=set(['#']), replace_set=set([]))
+
+
+# "sentences" are taken as given, like the rows of a sentence-level tsv: strings, numbered from 1, or
+# {"sentence_id", "text"} objects. A "response" is split and cleaned.
+def record_sentences(record : Dict, preprocess : ResponsePreprocess) -> List[Dict]:
+    if not isinstance(record, dict) or not isinstance(record.get('source'), str):
+        raise RecordError('"source" (string) is required')
+    if isinstance(record.get('sentences'), list):
+        return [
+            {FieldName.SENTENCE_ID: s[FieldName.SENTENCE_ID], FieldName.SENTENCE_TEXT: str(s[FieldName.SENTENCE_TEXT])} if isinstance(s, dict)
+            else {FieldName.SENTENCE_ID: i + 1, FieldName.SENTENCE_TEXT: str(s)}
+            for i, s in enumerate(record['sentences'])]
+    if isinstance(record.get('response'), str):
+        return preprocess.preprocess(record['response'])
+    raise RecordError('"response" (string) or "sentences" (list of strings) is required')
+
+
+# yields (line number, record or RecordError) for every non-empty line
+def iter_jsonl_records(stream : TextIO) -> Iterator[Tuple[int, object]]:
+    for line_no, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_no, RecordError(f'line {line_no} is not valid json: {e}')
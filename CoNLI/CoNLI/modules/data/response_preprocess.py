@@ -1,13 +1,11 @@
-import nltk
 from typing import Dict, List
+from CoNLI.modules.utils.sentence_splitter import load_punkt
 
 
 class ResponsePreprocess:
 
     def __init__(self, skip_starts_with_set, replace_set) -> None:
-        nltk.download('punkt')
-        self._break_sentence = nltk.data.load(
-            "tokenizers/punkt/english.pickle")
+        self._break_sentence = load_punkt()
         self._skip_starts_with_set = skip_starts_with_set
         self._replace_set = replace_set
 
@@ -5,11 +5,19 @@ import time
 import logging
 import json
 import asyncio
-from typing import List
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.textanalytics.aio import TextAnalyticsClient
+import contextlib
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Dict, List
 
 from CoNLI.modules.arguments import TAArguments
+from CoNLI.modules.utils.concurrency import AdaptiveConcurrencyLimiter, CallOutcome, optional_slot
+from CoNLI.modules.utils.cassette import Cassette
+from CoNLI.modules.utils import tracing
+from CoNLI.modules.utils.deadline import Deadline
+
+if TYPE_CHECKING:
+    # azure is imported on first use, see _detect_entities
+    from azure.ai.textanalytics.aio import TextAnalyticsClient
 
 # entity class for hallucination detection
 @dataclass
@@ -30,7 +38,7 @@ class EntityDetectorBase:
         pass
 
     # detect entities in a given text, return a list of entities
-    def detect_entities(self, text_content : List[str]) -> List[List[HdEntity]]:
+    def detect_entities(self, text_content : List[str], deadline : Deadline = None) -> List[List[HdEntity]]:
         return [[] for _ in range(len(text_content))] # return empty list by default
 
 class PassThroughEntityDetector(EntityDetectorBase):
@@ -38,7 +46,7 @@ class PassThroughEntityDetector(EntityDetectorBase):
         super().__init__()
 
     # detect entities in a given text, return a list of entities
-    def detect_entities(self, text_content : List[str]) -> List[List[HdEntity]]:
+    def detect_entities(self, text_content : List[str], deadline : Deadline = None) -> List[List[HdEntity]]:
         # simply treat the whole sentennce as a giant "entity",
         # so that hallucination detection can be applied to the whole sentence
 
@@ -51,18 +59,18 @@ class EnsembledEntityDetector(EntityDetectorBase) :
         self.detectors = detectors
         assert self._check_detectors(), "PassThroughEntityDetector is not the last detector"
 
-    def _detect_entities(self, text_content : str) -> List[HdEntity]:
+    def _detect_entities(self, text_content : str, deadline : Deadline = None) -> List[HdEntity]:
         results = []
 
         for detector in self.detectors:
             if type(detector) is PassThroughEntityDetector and len(results) != 0:
                 continue
-            cur_result = detector.detect_entities(text_content)
+            cur_result = detector.detect_entities(text_content, deadline=deadline)
             results.extend(cur_result)
         return results
     
-    def detect_entities(self, text_content : List[str]) -> List[List[HdEntity]]:
-        return [self._detect_entities(text) for text in text_content]
+    def detect_entities(self, text_content : List[str], deadline : Deadline = None) -> List[List[HdEntity]]:
+        return [self._detect_entities(text, deadline) for text in text_content]
 
     def _detect_bkg_entities(self, text_content : str) -> List[HdEntity]:
         for detector in self.detectors:
@@ -84,14 +92,22 @@ class EnsembledEntityDetector(EntityDetectorBase) :
 
 
 class GenTAEntityDetector(EntityDetectorBase) :
-    def __init__(self, ta_args : TAArguments) -> None:
+    def __init__(self, ta_args : TAArguments, concurrency_limiter : AdaptiveConcurrencyLimiter = None, cassette : Cassette = None, call_observers : list = None) -> None:
         super().__init__()
+        # observer(kind, latency_seconds, outcome, usage) called after every TA call, as for AOAIUtil
+        self.call_observers = list(call_observers) if call_observers else []
         self.ta_args = ta_args
+        # optional AIMD limit on in-flight TA calls, shared by all entity detection threads
+        self.concurrency_limiter = concurrency_limiter
+        # optional record / replay of every TA call, replay needs neither endpoint nor key
+        self.cassette = cassette
         api_key = ta_args.api_key
-        if not api_key:
+        if not api_key and not (cassette is not None and cassette.replaying):
             raise ValueError("API_KEY is not defined in the config file and LANGUAGE_KEY is not set in environment")
 
-        self.credential = AzureKeyCredential(api_key)
+        # the azure sdk is only imported by runs with a TA entity detector
+        from azure.core.credentials import AzureKeyCredential
+        self.credential = AzureKeyCredential(api_key) if api_key else None
         self.endpoint = ta_args.endpoint
 
         # default to allow all entity types
@@ -116,33 +132,82 @@ class GenTAEntityDetector(EntityDetectorBase) :
             return "{0}".format(
                 entity.category)
 
-    async def _detect_entities(self, text_contents: List[str]) -> List[List[HdEntity]]:
-        ta_client = TextAnalyticsClient(
+    # TA results as plain dicts, for the cassette
+    @staticmethod
+    def encode_ta_results(results) -> List[Dict]:
+        encoded = []
+        for r in results:
+            if r.is_error:
+                encoded.append({'is_error': True, 'error': str(r.error)})
+            else:
+                encoded.append({'is_error': False, 'entities': [
+                    {'text': e.text, 'category': e.category, 'subcategory': e.subcategory, 'offset': e.offset, 'length': e.length, 'confidence_score': e.confidence_score}
+                    for e in r.entities]})
+        return encoded
+
+    # inverse of encode_ta_results, with the attributes read from the azure result objects
+    @staticmethod
+    def decode_ta_results(encoded : List[Dict]) -> list:
+        return [SimpleNamespace(is_error=True, error=r['error']) if r['is_error']
+                else SimpleNamespace(is_error=False, entities=[SimpleNamespace(**e) for e in r['entities']])
+                for r in encoded]
+
+    async def _recognize_entities(self, ta_client : 'TextAnalyticsClient', text_contents: List[str]):
+        if self.cassette is None:
+            return await ta_client.recognize_entities(documents=text_contents)
+        if self.cassette.replaying:
+            return self.cassette.call('ta_entities', {'documents': text_contents}, None, decode=GenTAEntityDetector.decode_ta_results)
+        start = time.monotonic()
+        try:
+            result = await ta_client.recognize_entities(documents=text_contents)
+        except Exception as e:
+            self.cassette.record('ta_entities', {'documents': text_contents}, error=e, latency=time.monotonic() - start)
+            raise
+        self.cassette.record('ta_entities', {'documents': text_contents}, response=GenTAEntityDetector.encode_ta_results(result), latency=time.monotonic() - start)
+        return result
+
+    # retries until TA answers or the deadline expires. On expiry deadline.timed_out is set and no entities
+    # are returned, so the entity-level round has nothing left to verify
+    async def _detect_entities(self, text_contents: List[str], deadline : Deadline = None) -> List[List[HdEntity]]:
+        from azure.ai.textanalytics.aio import TextAnalyticsClient
+        replaying = self.cassette is not None and self.cassette.replaying
+        ta_client = None if replaying else TextAnalyticsClient(
             endpoint=self.endpoint,
             credential=self.credential
         )
-        async with ta_client:
+        async with (ta_client if ta_client is not None else contextlib.nullcontext()):
             while True:
+                if deadline is not None and deadline.expired():
+                    logging.warning('[TA] Deadline expired or request cancelled, aborting TA request')
+                    deadline.mark_timed_out()
+                    return [[] for _ in range(len(text_contents))]
                 try:
-                    result = await ta_client.recognize_entities(
-                        documents=text_contents)
-                    # aggresively not allowing any error in TA.
-                    ta_results = []
-                    for r in result:
-                        assert (not r.is_error), r.error
-                        ta_results.append(r)
+                    call_start = time.monotonic()
+                    with tracing.span('ta_attempt', n_documents=len(text_contents)), optional_slot(self.concurrency_limiter):
+                        result = await self._recognize_entities(ta_client, text_contents)
+                        # aggresively not allowing any error in TA.
+                        ta_results = []
+                        for r in result:
+                            assert (not r.is_error), r.error
+                            ta_results.append(r)
+                    self._notify_observers(time.monotonic() - call_start, CallOutcome.SUCCESS)
 
                     break
                 except Exception as e:
                     errStr = str(e).lower()
+                    self._notify_observers(time.monotonic() - call_start, CallOutcome.from_error(e))
 
-                    if "invalid subscription key or wrong api endpoint" in errStr:
+                    if "invalid subscription key or wrong api endpoint" in errStr or "no recorded ta_entities call" in errStr:
                         raise Exception(
                             f'[TA] Unexpected, unrecoverable error: {errStr}')
                     else:
                         logging.info(
                             f"[TA] Unexpected error, retryable error: {errStr}")
-                        time.sleep(5)
+                        with tracing.span('backoff', seconds=5):
+                            if deadline is None:
+                                time.sleep(5)
+                            else:
+                                deadline.sleep(5)
                         continue
         entity_types_allow_list = self.get_entity_types_allow_list()
         return_list = []
@@ -166,8 +231,15 @@ class GenTAEntityDetector(EntityDetectorBase) :
 
         return return_list
 
-    def detect_entities(self, text_content : List[str]) -> List[List[HdEntity]]:
-        return asyncio.run(self._detect_entities(text_content))
+    def detect_entities(self, text_content : List[str], deadline : Deadline = None) -> List[List[HdEntity]]:
+        return asyncio.run(self._detect_entities(text_content, deadline))
+
+    def _notify_observers(self, latency : float, outcome : str) -> None:
+        for observer in self.call_observers:
+            try:
+                observer('ta_entities', latency, outcome, None)
+            except Exception as e:
+                logging.warning(f'TA call observer failed: {e}')
 
     # dup code - TODO: refactor
     def get_entity_types_allow_list(self) -> List[str]:
@@ -195,7 +267,7 @@ class EntityDetectorFactory:
             return PassThroughEntityDetector()
         elif entity_detector_type == "ta-general":
             ta_args = kwargs['ta_args']
-            return GenTAEntityDetector(ta_args)
+            return GenTAEntityDetector(ta_args, concurrency_limiter=kwargs.get('ta_concurrency_limiter', None), cassette=kwargs.get('ta_cassette', None), call_observers=kwargs.get('ta_call_observers', None))
         elif entity_detector_type == "base":
             return EntityDetectorBase() # only used for testing ensembled entity detector
         else:
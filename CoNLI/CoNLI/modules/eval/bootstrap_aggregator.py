@@ -0,0 +1,83 @@
+# bootstrap confidence intervals of per pair scores (e.g. rouge) with NumPy, as rouge_score.scoring.BootstrapAggregator
+# computes them, but with all the resamples drawn at once and for several metrics and systems in one pass
+
+import collections
+from typing import Dict, List
+
+import numpy as np
+
+# same fields as rouge_score.scoring.Score and AggregateScore, so results can be read the same way
+Score = collections.namedtuple('Score', ['precision', 'recall', 'fmeasure'])
+AggregateScore = collections.namedtuple('AggregateScore', ['low', 'mid', 'high'])
+
+DEFAULT_SYSTEM = 'default'
+
+
+# low, mid and high percentiles of the means of n_samples bootstrap resamples of the rows of scores
+# (n_pairs x n_columns), for every column. The resamples are drawn as one (n_samples x n_pairs) index matrix
+# and turned into counts, so that the resample means of all columns are a single matrix product. For very many
+# pairs the resamples are drawn in blocks of at most max_cells indices
+def bootstrap_percentiles(scores : np.ndarray, n_samples : int, confidence_interval : float, rng : np.random.Generator, max_cells : int = 2**24) -> np.ndarray:
+    n_pairs = scores.shape[0]
+    block = max(1, min(n_samples, max_cells // max(n_pairs, 1)))
+    sample_means = []
+    for start in range(0, n_samples, block):
+        n = min(block, n_samples - start)
+        indices = rng.integers(0, n_pairs, size=(n, n_pairs))
+        offsets = (np.arange(n) * n_pairs)[:, None]
+        counts = np.bincount((indices + offsets).ravel(), minlength=n * n_pairs).reshape(n, n_pairs)
+        sample_means.append(counts @ scores / n_pairs)
+    sample_means = np.concatenate(sample_means, axis=0)
+    percentiles = [(1 - confidence_interval) / 2 * 100, 50, (1 + confidence_interval) / 2 * 100]
+    return np.percentile(sample_means, percentiles, axis=0)
+
+
+class BootstrapAggregator:
+    """
+    Collects the per pair scores of one or several systems, {metric: Score} per pair as returned by
+    rouge_score.rouge_scorer.RougeScorer.score, and aggregates them into {metric: AggregateScore}.
+    All the systems and metrics are resampled with the same resamples (a paired bootstrap), drawn from a
+    Generator seeded with seed rather than from the global NumPy state.
+    """
+    def __init__(self, confidence_interval : float = 0.95, n_samples : int = 1000, seed : int = None) -> None:
+        if not 0 < confidence_interval < 1:
+            raise ValueError(f'confidence_interval must be in (0, 1), got {confidence_interval}')
+        if n_samples < 1:
+            raise ValueError(f'n_samples must be >= 1, got {n_samples}')
+        self._confidence_interval = confidence_interval
+        self._n_samples = n_samples
+        self._seed = seed
+        # system -> metric -> per pair rows of (precision, recall, fmeasure)
+        self._scores : Dict[str, Dict[str, List]] = {}
+
+    def add_scores(self, scores : Dict, system : str = DEFAULT_SYSTEM) -> None:
+        metrics = self._scores.setdefault(system, {})
+        for metric, score in scores.items():
+            metrics.setdefault(metric, []).append(tuple(score))
+
+    # the added scores of a system, {metric: [Score]} in the order they were added
+    def raw_scores(self, system : str = DEFAULT_SYSTEM) -> Dict[str, List[Score]]:
+        return {metric: [Score(*row) for row in rows] for metric, rows in self._scores.get(system, {}).items()}
+
+    def aggregate(self, system : str = DEFAULT_SYSTEM) -> Dict[str, AggregateScore]:
+        return self.aggregate_systems().get(system, {})
+
+    # {system: {metric: AggregateScore}} of every system
+    def aggregate_systems(self) -> Dict[str, Dict[str, AggregateScore]]:
+        columns = [(system, metric) for system, metrics in self._scores.items() for metric in metrics]
+        if len(columns) == 0:
+            return {}
+        n_pairs = set(len(self._scores[system][metric]) for system, metric in columns)
+        if len(n_pairs) > 1:
+            raise ValueError(f'All systems and metrics must have the same number of scored pairs, got {sorted(n_pairs)}')
+        # n_pairs x (n_columns * 3)
+        scores = np.concatenate([np.asarray(self._scores[system][metric], dtype=np.float64) for system, metric in columns], axis=1)
+        low, mid, high = bootstrap_percentiles(scores, self._n_samples, self._confidence_interval, np.random.default_rng(self._seed))
+        result = {}
+        for k, (system, metric) in enumerate(columns):
+            result.setdefault(system, {})[metric] = AggregateScore(
+                low = Score(*low[3 * k:3 * k + 3].tolist()),
+                mid = Score(*mid[3 * k:3 * k + 3].tolist()),
+                high = Score(*high[3 * k:3 * k + 3].tolist()),
+            )
+        return result
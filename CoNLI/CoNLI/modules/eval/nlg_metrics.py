@@ -1,46 +1,122 @@
-from rouge_score import rouge_scorer, scoring
-from sacrebleu import corpus_bleu
-from evaluate import load
-from typing import Dict, List
-from tqdm import tqdm
-import numpy as np
+# rouge_score, sacrebleu, evaluate, numpy and nltk are imported by the metrics that use them, so that
+# importing this module (and the evaluators) does not load all of them
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+import hashlib
+import json
+import os
 import re
+import threading
 
-try:
-    import nltk
-
-    NLTK_AVAILABLE = True
-except (ImportError, ModuleNotFoundError):
-    NLTK_AVAILABLE = False
-
-if NLTK_AVAILABLE:
-    try:
-        nltk.download("punkt", quiet=True)
-    except FileExistsError:  # multiprocessing race condition
-        pass
+from CoNLI.modules.utils.sentence_splitter import load_punkt
 
 def add_newline_to_end_of_each_sentence(x: str) -> str:
     re.sub("<n>", "", x)  # remove pegasus newline char
-    assert NLTK_AVAILABLE, "nltk must be installed to separate newlines betwee sentences. (pip install nltk)"
-    return "\n".join(nltk.sent_tokenize(x))
+    return "\n".join(load_punkt().tokenize(x))
+
+# the newline separated sentences of every text split so far in this process, shared by all the metrics and
+# calls. Texts not split yet are split once each, in the process pool when there is one
+_sentence_split_cache : Dict[str, str] = {}
+
+def _split_chunk(texts : List[str]) -> List[str]:
+    return [add_newline_to_end_of_each_sentence(text) for text in texts]
+
+def split_sentences_cached(texts : List[str], executor : ProcessPoolExecutor = None, chunk_size : int = 64) -> List[str]:
+    missing = list(dict.fromkeys(text for text in texts if text not in _sentence_split_cache))
+    chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+    splits = executor.map(_split_chunk, chunks) if executor is not None else map(_split_chunk, chunks)
+    for chunk, chunk_splits in zip(chunks, splits):
+        _sentence_split_cache.update(zip(chunk, chunk_splits))
+    return [_sentence_split_cache[text] for text in texts]
+
+# the bertscore metric is loaded once per process. evaluate keeps the scorer (and its model) of the last
+# compute on it, so later calls with the same model_type do not load the model again. The model comes from
+# the local Hugging Face cache, and is only downloaded when it is not there (unless HF_HUB_OFFLINE is set)
+_bertscore = None
+_bertscore_lock = threading.Lock()
+
+def load_bertscore():
+    global _bertscore
+    with _bertscore_lock:
+        if _bertscore is None:
+            from evaluate import load
+            _bertscore = load("bertscore")
+    return _bertscore
 
-def calcualte_bertscore(output_lns, refs_lns, **kwarg) -> dict:
+# per pair bertscore results, keyed by bertscore_key, and the cache files already read into it
+_bertscore_cache : Dict[str, Dict] = {}
+_bertscore_cache_files = set()
+
+# the key covers everything that changes the score: the model and the extra compute kwargs (e.g. num_layers,
+# idf, rescale_with_baseline), sorted so that their order does not matter
+def bertscore_key(model_type : str, output : str, ref : str, compute_kwargs : Dict = None) -> str:
+    kwargs_str = json.dumps(compute_kwargs or {}, sort_keys=True, default=str)
+    return hashlib.sha1('\0'.join([model_type or '', kwargs_str, output, ref]).encode('utf-8')).hexdigest()
+
+def _read_bertscore_cache(cache_file : str) -> None:
+    if cache_file is None or cache_file in _bertscore_cache_files:
+        return
+    _bertscore_cache_files.add(cache_file)
+    if not os.path.isfile(cache_file):
+        return
+    with open(cache_file) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue # partial last line of an interrupted run
+            _bertscore_cache[record.pop('key')] = record
+
+def calcualte_bertscore(output_lns, refs_lns, model_type : str = None, batch_size : int = 64, device : str = 'cpu', cache_file : str = None, **kwarg) -> dict:
+    """Mean BERTScore precision, recall and f1 of the pairs.
+    Pairs not scored before (in this process, or in cache_file) are scored together, batch_size pairs per
+    model batch, on device. model_type defaults to the bertscore default for english; further kwarg
+    (e.g. num_layers for a local model path) are passed to the bertscore compute.
+    """
+    from tqdm import tqdm
     print("start bertscore evaluation")
-    results = {'precision':[], 'recall':[], 'f1':[], 'hashcode':None}
-    bertscore = load("bertscore")
-    for output, ref in tqdm(zip(output_lns, refs_lns), total=len(output_lns)):
-        result = bertscore.compute(predictions=[output], references=[ref], lang="en")
-        results['precision'] += result['precision']
-        results['recall'] += result['recall']
-        results['f1'] += result['f1']
-        results['hashcode'] = result['hashcode']
-    results['precision'] = sum(results['precision']) / len(results['precision'])
-    results['recall'] = sum(results['recall']) / len(results['recall'])
-    results['f1'] = sum(results['f1']) / len(results['f1'])
+    _read_bertscore_cache(cache_file)
+    keys = [bertscore_key(model_type, output, ref, kwarg) for output, ref in zip(output_lns, refs_lns)]
+    missing = {}
+    for key, output, ref in zip(keys, output_lns, refs_lns):
+        if key not in _bertscore_cache:
+            missing[key] = (output, ref)
+    if len(missing) > 0:
+        bertscore = load_bertscore()
+        missing_keys = list(missing.keys())
+        # a few model batches per compute call, for the progress bar
+        step = max(batch_size, 1) * 8
+        cache_out = open(cache_file, 'a') if cache_file is not None else None
+        try:
+            for i in tqdm(range(0, len(missing_keys), step)):
+                chunk = missing_keys[i:i + step]
+                result = bertscore.compute(
+                    predictions=[missing[key][0] for key in chunk],
+                    references=[missing[key][1] for key in chunk],
+                    lang="en",
+                    model_type=model_type,
+                    batch_size=batch_size,
+                    device=device,
+                    **kwarg)
+                for j, key in enumerate(chunk):
+                    record = {'precision': result['precision'][j], 'recall': result['recall'][j], 'f1': result['f1'][j], 'hashcode': result['hashcode']}
+                    _bertscore_cache[key] = record
+                    if cache_out is not None:
+                        cache_out.write(json.dumps({'key': key, **record}) + '\n')
+                if cache_out is not None:
+                    cache_out.flush()
+        finally:
+            if cache_out is not None:
+                cache_out.close()
+    scores = [_bertscore_cache[key] for key in keys]
+    results = {'hashcode': scores[-1]['hashcode'] if len(scores) > 0 else None}
+    for stat in ['precision', 'recall', 'f1']:
+        results[stat] = sum(score[stat] for score in scores) / len(scores)
     return results
 
 def calculate_bleu(output_lns, refs_lns, **kwargs) -> dict:
     """Uses sacrebleu's corpus_bleu implementation."""
+    from sacrebleu import corpus_bleu
     return {"bleu": corpus_bleu(output_lns, [refs_lns], **kwargs).score}
 
 def extract_rouge_mid_statistics(dct):
@@ -52,6 +128,39 @@ def extract_rouge_mid_statistics(dct):
 
 ROUGE_KEYS = ["rouge1", "rouge2", "rougeL", "rougeLsum"]
 
+# the rouge scorer of a worker process, created once by its initializer
+_worker_scorer = None
+
+def _init_rouge_worker(rouge_keys : List[str], use_stemmer : bool) -> None:
+    global _worker_scorer
+    from rouge_score import rouge_scorer
+    _worker_scorer = rouge_scorer.RougeScorer(rouge_keys, use_stemmer=use_stemmer)
+
+def _score_chunk(pairs : List[Tuple[str, str]]) -> List[Dict]:
+    return [_worker_scorer.score(tgt, pred) for pred, tgt in pairs]
+
+def _create_rouge_executor(num_workers : int, rouge_keys : List[str], use_stemmer : bool) -> ProcessPoolExecutor:
+    if num_workers <= 0:
+        _init_rouge_worker(rouge_keys, use_stemmer)
+        return None
+    return ProcessPoolExecutor(max_workers=num_workers, initializer=_init_rouge_worker, initargs=(rouge_keys, use_stemmer))
+
+# the rouge scores of every (pred, tgt) pair, in order, in the executor or in this process when it is None
+def _score_rouge_pairs(pred_lns : List[str], tgt_lns : List[str], newline_sep : bool, executor : ProcessPoolExecutor, chunk_size : int) -> List[Dict]:
+    # rougeLsum expects "\n" separated sentences within a summary
+    if newline_sep:
+        pred_lns = split_sentences_cached(pred_lns, executor, chunk_size)
+        tgt_lns = split_sentences_cached(tgt_lns, executor, chunk_size)
+    pairs = list(zip(pred_lns, tgt_lns))
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    chunk_scores = executor.map(_score_chunk, chunks) if executor is not None else map(_score_chunk, chunks)
+    return [score for scores in chunk_scores for score in scores]
+
+def _rouge_statistics(result : Dict, return_precision_and_recall : bool) -> Dict:
+    if return_precision_and_recall:
+        return extract_rouge_mid_statistics(result)  # here we return dict
+    return {k: round(v.mid.fmeasure * 100, 4) for k, v in result.items()}
+
 def calculate_rouge(
     pred_lns: List[str],
     tgt_lns: List[str],
@@ -60,6 +169,10 @@ def calculate_rouge(
     return_precision_and_recall=True,
     bootstrap_aggregation=True,
     newline_sep=True,
+    num_workers=0,
+    chunk_size=64,
+    seed=1234,
+    n_samples=1000,
 ) -> Dict:
     """Calculate rouge using rouge_scorer package.
     Args:
@@ -73,39 +186,73 @@ def calculate_rouge(
             this function returns a collections.defaultdict[metric: list of values for each observation for each subscore]``
         newline_sep:(default=True) whether to add newline between sentences. This is essential for calculation rougeL
         on multi sentence summaries (CNN/DM dataset).
+        num_workers: (default=0) processes that split and score the pairs, 0 to do it in this process.
+        chunk_size: pairs (or texts to split) sent to a worker at a time.
+        seed: seed of the bootstrap resampling, independent of the global NumPy random state.
+        n_samples: number of bootstrap resamples.
     Returns:
          Dict[score: value] if aggregate else defaultdict(list) keyed by rouge_keys
     """
-    scorer = rouge_scorer.RougeScorer(rouge_keys, use_stemmer=use_stemmer)
-    aggregator = scoring.BootstrapAggregator()
+    from collections import defaultdict
+    from CoNLI.modules.eval.bootstrap_aggregator import BootstrapAggregator
+    aggregator = BootstrapAggregator(n_samples=n_samples, seed=seed)
     print("start rouge evaluation")
-    i = 0
-    for pred, tgt in zip(tgt_lns, pred_lns):
-        # rougeLsum expects "\n" separated sentences within a summary
-        if newline_sep:
-            pred = add_newline_to_end_of_each_sentence(pred)
-            tgt = add_newline_to_end_of_each_sentence(tgt)
-        scores = scorer.score(pred, tgt)
-        aggregator.add_scores(scores)
+    executor = _create_rouge_executor(num_workers, rouge_keys, use_stemmer)
+    try:
+        # scores are added in the order of the pairs, the bootstrap resampling does not depend on the workers
+        for score in _score_rouge_pairs(pred_lns, tgt_lns, newline_sep, executor, chunk_size):
+            aggregator.add_scores(score)
+    finally:
+        if executor is not None:
+            executor.shutdown()
     
     print("start rouge aggregation")
     if bootstrap_aggregation:
-        result = aggregator.aggregate()
-        if return_precision_and_recall:
-            return extract_rouge_mid_statistics(result)  # here we return dict
-        else:
-            return {k: round(v.mid.fmeasure * 100, 4) for k, v in result.items()}
+        return _rouge_statistics(aggregator.aggregate(), return_precision_and_recall)
 
     else:
-        return aggregator._scores  # here we return defaultdict(list)
+        return defaultdict(list, aggregator.raw_scores())  # here we return defaultdict(list)
+
+def calculate_rouge_systems(
+    system_pred_lns: Dict[str, List[str]],
+    tgt_lns: List[str],
+    use_stemmer=True,
+    rouge_keys=["rouge1", "rouge2","rougeLsum"],
+    return_precision_and_recall=True,
+    newline_sep=True,
+    num_workers=0,
+    chunk_size=64,
+    seed=1234,
+    n_samples=1000,
+) -> Dict[str, Dict]:
+    """calculate_rouge of several systems (e.g. mitigation variants) against the same references, {system: scores}.
+    All systems are aggregated together with the same bootstrap resamples, and the references are split once.
+    """
+    from CoNLI.modules.eval.bootstrap_aggregator import BootstrapAggregator
+    aggregator = BootstrapAggregator(n_samples=n_samples, seed=seed)
+    print("start rouge evaluation")
+    executor = _create_rouge_executor(num_workers, rouge_keys, use_stemmer)
+    try:
+        for system, pred_lns in system_pred_lns.items():
+            for score in _score_rouge_pairs(pred_lns, tgt_lns, newline_sep, executor, chunk_size):
+                aggregator.add_scores(score, system)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    print("start rouge aggregation")
+    return {system: _rouge_statistics(result, return_precision_and_recall) for system, result in aggregator.aggregate_systems().items()}
 
 def evaluate(output_lns: List[str],
              reference_lns: List[str],
              score_fn = calculate_rouge,
-             seed : int = 1234) -> dict:
-
-    np.random.seed(seed)
-    scores: dict = score_fn(output_lns, reference_lns)
+             seed : int = 1234,
+             **kwargs) -> dict:
+    import inspect
+    # metrics with randomness take their own seed, the global NumPy random state is left alone
+    if 'seed' in inspect.signature(score_fn).parameters:
+        kwargs.setdefault('seed', seed)
+    scores: dict = score_fn(output_lns, reference_lns, **kwargs)
     return scores
 
 if __name__ == "__main__":
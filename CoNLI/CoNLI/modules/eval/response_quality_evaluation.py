@@ -1,11 +1,12 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 from CoNLI.modules.hallucination_mitigator import HmResult
 from CoNLI.modules.data.data_loader import DataLoader
 from CoNLI.modules.eval.nlg_metrics import evaluate, calculate_rouge, calculate_bleu, calcualte_bertscore
 
 class QualityEvaluator:
-    def __init__(self, hypothesis, sources, gt_response):
+    def __init__(self, hypothesis, sources, gt_response, num_workers : int = 0, bertscore_args : dict = None):
         self.dataloader = DataLoader(
             hypothesis=hypothesis,
             sourcefolder=sources
@@ -13,6 +14,8 @@ class QualityEvaluator:
         self.hypothesis = hypothesis
         self.sources = sources
         self.gt_response = gt_response
+        self.num_workers = num_workers # processes for rouge and bleu, 0 to compute them in this process
+        self.bertscore_args = bertscore_args or {} # model_type, batch_size, device, cache_file of calcualte_bertscore
 
     def evaluate_responses(self):
         # load response to test against
@@ -42,7 +45,14 @@ class QualityEvaluator:
             gt_response.append(gt_response_dict[result.data_id])
             llm_response.append(result.refined_response)
             
-        llm_rouge_scores = evaluate(output_lns=llm_response, reference_lns=gt_response, score_fn=calculate_rouge)
-        llm_bleu_scores = evaluate(output_lns=llm_response, reference_lns=gt_response, score_fn=calculate_bleu)
-        llm_bertscores = evaluate(output_lns=llm_response, reference_lns=gt_response, score_fn=calcualte_bertscore)
+        if self.num_workers > 0:
+            # corpus bleu is a single statistic of all the pairs, it runs in its own process while rouge uses the others
+            with ProcessPoolExecutor(max_workers=1) as bleu_executor:
+                bleu_future = bleu_executor.submit(evaluate, output_lns=llm_response, reference_lns=gt_response, score_fn=calculate_bleu)
+                llm_rouge_scores = evaluate(output_lns=llm_response, reference_lns=gt_response, score_fn=calculate_rouge, num_workers=self.num_workers)
+                llm_bleu_scores = bleu_future.result()
+        else:
+            llm_rouge_scores = evaluate(output_lns=llm_response, reference_lns=gt_response, score_fn=calculate_rouge)
+            llm_bleu_scores = evaluate(output_lns=llm_response, reference_lns=gt_response, score_fn=calculate_bleu)
+        llm_bertscores = evaluate(output_lns=llm_response, reference_lns=gt_response, score_fn=calcualte_bertscore, **self.bertscore_args)
         return {"Rouge":llm_rouge_scores, "Bleu":llm_bleu_scores, "Bertscore":llm_bertscores}
\ No newline at end of file
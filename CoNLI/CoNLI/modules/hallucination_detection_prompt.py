@@ -1,7 +1,6 @@
 import copy
 import os
-import yaml
-from transformers import GPT2TokenizerFast
+from CoNLI.modules.utils.tokenizer_utils import load_gpt2_tokenizer
 
 class hallucination_detection_prompt :
     MAX_TOKEN_8K = 8192
@@ -11,7 +10,6 @@ class hallucination_detection_prompt :
                   prompt_resource_root_folder : str = None,
                   max_prompt_tokens : int = MAX_TOKEN_32K
                   ) -> None:
-        self._tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
         self._prompt_resource_root = prompt_resource_root_folder if prompt_resource_root_folder is not None else os.path.join(os.path.dirname(__file__), "..")
         self._max_prompt_tokens = max_prompt_tokens
         self._use_chat_completions = use_chat_completions
@@ -34,6 +32,7 @@ class hallucination_detection_prompt :
         return self._load_prompt_file(filename=filename, useChatCompletions=useChatCompletions)
 
     def _load_prompt_file(self, filename : str, useChatCompletions : bool = False) -> str :
+        import yaml
         yamlfile = self.resolve_file_path(f'prompts/chat_completions/{filename}.yaml')
         if useChatCompletions:
             return yaml.safe_load(self.load_file_content(yamlfile))
@@ -47,7 +46,7 @@ class hallucination_detection_prompt :
 
     def _validate_prompt(self, prompt, max_tokens) :
         if not self._use_chat_completions :
-            if len(self._tokenizer(prompt, truncation=True, max_length=32000)['input_ids']) + max_tokens > self._max_prompt_tokens :
+            if len(load_gpt2_tokenizer()(prompt, truncation=True, max_length=32000)['input_ids']) + max_tokens > self._max_prompt_tokens :
                 raise ValueError(f'len(prompt) ({len(prompt)}) + max_tokens ({max_tokens}) must be less than {self._max_prompt_tokens}') 
         return prompt
 
@@ -60,12 +59,17 @@ class hallucination_detection_prompt :
         return promptOrMessageObj.replace(before, after)
     
     
+    # the prompt with the source filled in, the part shared by every batch of hypotheses of that source
+    def fill_source(self, transcript: str):
+        prompt = copy.deepcopy(self.prompt)
+        return self._replace(prompt, '{{Source}}', transcript)
+
     # The parameter items is a list of dicts with keys: hypothesis, data_id, sentence_id etc.
     # Here the hypothesis in fact is the whole sentence with entity name highlighted
-    def create_batch_prompt(self, transcript: str, items: list, max_tokens: int):
+    # source_prompt: fill_source(transcript), if already computed
+    def create_batch_prompt(self, transcript: str, items: list, max_tokens: int, source_prompt = None):
         sentence = "\n".join([ "("+str(i)+"). " + item["Hypothesis"] for i, item in enumerate(items)])
-        prompt = copy.deepcopy(self.prompt)
-        prompt = self._replace(prompt, '{{Source}}', transcript)
+        prompt = source_prompt if source_prompt is not None else self.fill_source(transcript)
         prompt = self._replace(prompt, '{{Hypothesis}}', sentence)
         self._validate_prompt(prompt, max_tokens)
         return prompt
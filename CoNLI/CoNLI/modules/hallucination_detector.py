@@ -1,10 +1,9 @@
 
 import logging
 import math
-import pandas as pd
 import time
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
 from typing import Dict, List
 from pathlib import Path
 
@@ -13,9 +12,18 @@ from CoNLI.modules.arguments import OpenaiArguments, DetectionArguments
 from CoNLI.modules.entity_detector import EntityDetectorBase, GenTAEntityDetector
 from CoNLI.modules.hallucination_detection_prompt import hallucination_detection_prompt
 from CoNLI.modules.hd_constants import FieldName
+from CoNLI.modules.hypothesis_memo import HypothesisMemo, UnverifiedHypothesis
+from CoNLI.modules.micro_batcher import MicroBatcher
+from CoNLI.modules.source_store import SourceStore
+from CoNLI.modules.verdict_cache import NearDuplicateVerdictCache
 from CoNLI.modules.sentence_selector import SentenceSelectorBase
 from CoNLI.modules.utils.sentence_splitter import SentenceSplitter
 from CoNLI.modules.utils.aoai_utils import AOAIUtil
+from CoNLI.modules.utils.deadline import Deadline, DeadlineExceeded
+from CoNLI.modules.utils.concurrency import AdaptiveConcurrencyLimiter
+from CoNLI.modules.utils.cassette import Cassette
+from CoNLI.modules.utils.metrics import MetricsRegistry, endpoint_call_observer
+from CoNLI.modules.utils import profiling, tracing
 
 def count_tokens(text : str) -> int:
     import re
@@ -32,6 +40,15 @@ class HallucinationDetector :
                  disable_progress_bar : bool = False,
                  entity_detection_parallelism: int = 1,
                  entity_detection_batch: int = 25,
+                 enable_hypothesis_dedup: bool = True,
+                 verdict_cache: NearDuplicateVerdictCache = None,
+                 request_timeout: float = None,
+                 max_retry_wait: float = 60,
+                 concurrency_limiter: AdaptiveConcurrencyLimiter = None,
+                 cassette: Cassette = None,
+                 metrics: MetricsRegistry = None,
+                 micro_batch_window: float = 0,
+                 micro_batch_max_items: int = None,
                  ) -> None:
         self._entity_detector = entity_detector
         self._sentence_selector = sentence_selector
@@ -48,14 +65,42 @@ class HallucinationDetector :
 
         self.aoaiUtil = AOAIUtil(
             config_setting=openai_args.config_setting,
-            config_file=aoai_config_file)
+            config_file=aoai_config_file,
+            request_timeout=request_timeout,
+            max_retry_wait=max_retry_wait,
+            concurrency_limiter=concurrency_limiter,
+            cassette=cassette)
         
         self._entity_detection_batch = entity_detection_batch
 
         self._entity_detection_parallelism = entity_detection_parallelism
 
+        # run-wide dedup of (source, hypothesis) pairs, shared by all data and detection types
+        self._hypothesis_memo = HypothesisMemo() if enable_hypothesis_dedup else None
+        # optional reuse of verdicts for near-duplicate hypotheses of the same source
+        self._verdict_cache = verdict_cache
+        # hash key, token count and filled-in prompt computed once per distinct source
+        self._sources = SourceStore()
 
-    def detect_hallucinations_sentence_level(self, data_id : str, source : str, raw_response_text : str, split_sentence : bool = False) -> List[Dict]:
+        # optional coalescing of the hypotheses that concurrent documents send for the same source
+        # into shared GPT payloads, for a resident service receiving one document per request
+        self._micro_batcher = None
+        if micro_batch_window > 0 and detection_args.batch_size <= 1:
+            # payloads of one hypothesis cannot be shared, waiting for other callers would only add latency
+            logging.info('Micro-batching disabled, the GPT batch size is 1')
+        elif micro_batch_window > 0:
+            self._micro_batcher = MicroBatcher(
+                self._verify_items,
+                window=micro_batch_window,
+                max_items=micro_batch_max_items or detection_args.batch_size * max(openai_args.max_parallelism, 1))
+
+        # optional per-stage / per-detection-type / per-endpoint metrics
+        self._metrics = metrics
+        if metrics is not None:
+            self.aoaiUtil.call_observers.append(endpoint_call_observer(metrics, 'gpt'))
+
+
+    def detect_hallucinations_sentence_level(self, data_id : str, source : str, raw_response_text : str, split_sentence : bool = False, deadline : Deadline = None) -> List[Dict]:
         if split_sentence:
             # split raw_response_text into sentences
             sentences = self._sentence_splitter.split_into_sentences(raw_response_text)
@@ -73,9 +118,9 @@ class HallucinationDetector :
         sentences_enriched = [to_record(i+1, s) for i, s in enumerate(sentences)]
 
         # step #2: detect hallucinations in each sentence
-        return self.detect_hallucinations(data_id, source, sentences_enriched)
+        return self.detect_hallucinations(data_id, source, sentences_enriched, deadline=deadline)
 
-    def _add_entities_to_sentences(self, sentences : List[Dict]) -> List[Dict]:
+    def _add_entities_to_sentences(self, sentences : List[Dict], deadline : Deadline = None) -> List[Dict]:
         disable_progress = self._disable_progress_bar
         if isinstance(self._entity_detector, GenTAEntityDetector):
             batch_len = min(self._entity_detection_batch, 5)
@@ -84,27 +129,33 @@ class HallucinationDetector :
         else:
             batch_len = self._entity_detection_batch
 
-        sentences_df = pd.DataFrame(sentences)
-        sentences_text = sentences_df[FieldName.SENTENCE_TEXT].tolist()
+        sentences_text = [s[FieldName.SENTENCE_TEXT] for s in sentences]
         sentence_batches = [sentences_text[x:x+batch_len] for x in range(0, len(sentences_text), batch_len)]
         max_workers = min(max(self._entity_detection_parallelism, 1), len(sentence_batches))
         hd_entities = []
         with tqdm(total=len(sentence_batches), disable=disable_progress, leave=False) as pbar2:
             with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                for batch in executor.map(self._entity_detector.detect_entities, sentence_batches):
+                for batch in executor.map(tracing.traced(self._detect_entity_batch), sentence_batches, [deadline] * len(sentence_batches)):
                     hd_entities += batch
                     pbar2.update(1)
         n_entities = sum(len(x) for x in hd_entities)
-        sentences_df[FieldName.HD_ENTITY] = hd_entities
-        sentences = sentences_df.to_dict('records')
+        for s, entities in zip(sentences, hd_entities):
+            s[FieldName.HD_ENTITY] = entities
         return sentences, n_entities
     
-    def detect_hallucinations(self, data_id : str, source : str, sentences : List[Dict]) -> List[Dict]:
+    def _detect_entity_batch(self, sentences_text : List[str], deadline : Deadline = None) -> List[List]:
+        with profiling.stage(profiling.ENTITY_DETECTION):
+            return self._entity_detector.detect_entities(sentences_text, deadline=deadline)
+
+    # If a deadline is given, work left when it expires is dropped and deadline.timed_out is set,
+    # so the caller can mark the returned (partial) hallucinations as timed out.
+    def detect_hallucinations(self, data_id : str, source : str, sentences : List[Dict], deadline : Deadline = None) -> List[Dict]:
         perf_counters = {}
         perf_counters["n_gpt_requests"] = 0
         perf_counters["n_gpt_calls"] = 0
         t00 = time.time()
-        perf_counters["n_source_tokens"] = count_tokens(source)
+        source = self._sources.intern(source)
+        perf_counters["n_source_tokens"] = self._sources.artifact(source, 'n_tokens', count_tokens)
         hd_result = []
         if self._sentence_selector:
             perf_counters["n_sentences"] = len(sentences)
@@ -120,7 +171,9 @@ class HallucinationDetector :
             perf_counters["n_content_tokens"] = n_content_tokens
             # step #3.2: do hallucination detection with extra information
             t0 = time.time()
-            hd_result = self.do_hallucation_detection(data_id, source, sentences, perf_counters=perf_counters, sentence_level_hd=True)
+            with tracing.span('round', round='sentence_level', n_sentences=len(sentences)) as round_span:
+                hd_result = self.do_hallucation_detection(data_id, source, sentences, perf_counters=perf_counters, sentence_level_hd=True, deadline=deadline)
+                round_span.set(n_hallucinations=len(hd_result))
             t1 = time.time()
             perf_counters["hd_time_round_1"] = t1 - t0
 
@@ -129,15 +182,25 @@ class HallucinationDetector :
             sentences = [s for s in sentences if s[FieldName.SENTENCE_ID] not in is_hallucination_sentence_ids]
 
         # Add hd_result into sentences
+        if self._entity_detector and len(sentences) > 0 and deadline is not None and deadline.expired():
+            logging.warning(f"data_id: {data_id}, deadline expired, skipping entity-level detection")
+            deadline.mark_timed_out()
+            sentences = []
+
         if self._entity_detector and len(sentences) > 0:
             t0 = time.time()
             # step #2.1: detect entities in current sentence send for HD
-            sentences, perf_counters["n_entities"]  = self._add_entities_to_sentences(sentences)
+            with tracing.span('entity_detection', n_sentences=len(sentences)) as ed_span:
+                sentences, perf_counters["n_entities"]  = self._add_entities_to_sentences(sentences, deadline)
+                ed_span.set(n_entities=perf_counters["n_entities"])
             t1 = time.time()
             perf_counters["ed_time"] = t1 - t0
             # step #2.2: do hallucination detection with extra information
             t0 = time.time()
-            hd_result += self.do_hallucation_detection(data_id, source, sentences, perf_counters=perf_counters, sentence_level_hd=False)
+            with tracing.span('round', round='entity_level', n_sentences=len(sentences)) as round_span:
+                round_result = self.do_hallucation_detection(data_id, source, sentences, perf_counters=perf_counters, sentence_level_hd=False, deadline=deadline)
+                round_span.set(n_hallucinations=len(round_result))
+            hd_result += round_result
             t1 = time.time()
             perf_counters["hd_time_round_2"] = t1 - t0
         else:
@@ -156,21 +219,49 @@ class HallucinationDetector :
                 d[FieldName.SENTENCE_TEXT]))
         t11 = time.time()
         perf_counters["hd_time_total"] = t11 - t00
-        logging.info(data_id, perf_counters)
+        logging.info(f"data_id: {data_id}, perf_counters: {perf_counters}")
+        if self._metrics is not None:
+            self._record_metrics(perf_counters, hd_result, deadline)
 
         return hd_result
     
+    def _record_metrics(self, perf_counters : dict, hd_result : List[Dict], deadline : Deadline = None) -> None:
+        metrics = self._metrics
+        metrics.counter('documents_total', 'Documents processed').inc()
+        if deadline is not None and deadline.timed_out:
+            metrics.counter('documents_timed_out_total', 'Documents with partial results because their deadline expired').inc()
+        stage_seconds = metrics.histogram('stage_seconds', 'Wall-clock time per document of each detection stage')
+        for stage, key in [('sentence_level_hd', 'hd_time_round_1'), ('entity_detection', 'ed_time'), ('entity_level_hd', 'hd_time_round_2'), ('total', 'hd_time_total')]:
+            if perf_counters.get(key) is not None:
+                stage_seconds.observe(perf_counters[key], stage=stage)
+        for name, key, help in [
+                ('sentences_total', 'n_sentences', 'Sentences of the processed documents'),
+                ('entities_total', 'n_entities', 'Entities found by the entity detector'),
+                ('source_tokens_total', 'n_source_tokens', 'Words of the source documents'),
+                ('content_tokens_total', 'n_content_tokens', 'Words of the responses'),
+                ('gpt_batches_total', 'n_gpt_calls', 'Batched detection prompts sent to GPT')]:
+            if perf_counters.get(key):
+                metrics.counter(name, help).inc(perf_counters[key])
+        hallucinations = metrics.counter('hallucinations_total', 'Hallucinations found, by detection type')
+        for h in hd_result:
+            hallucinations.inc(detection_type=h[FieldName.DETECTION_TYPE])
+
+    # hypotheses by detection type and by how their verdict was obtained (gpt, memo, cache or timed_out)
+    def _count_hypotheses(self, items : List[Dict], resolution : str) -> None:
+        if self._metrics is None:
+            return
+        counter = self._metrics.counter('hypotheses_total', 'Hypotheses checked, by detection type and resolution (gpt, memo, cache, timed_out)')
+        for item in items:
+            counter.inc(detection_type=item['DetectionType'], resolution=resolution)
+
     def do_hallucation_detection(self, 
                                  data_id : str, 
                                  source : str,
                                  sentences : List[Dict],
                                  sentence_level_hd : bool,
-                                 perf_counters: dict) -> List[Dict]:
-        batch_size = self._detection_args.batch_size
-        max_parallelism = self._openai_args.max_parallelism
-        disable_progress = self._disable_progress_bar
-
-        items, results = [], []
+                                 perf_counters: dict,
+                                 deadline : Deadline = None) -> List[Dict]:
+        items = []
         for data in sentences:
             sentence_id = data[FieldName.SENTENCE_ID]
             sentence_text = data[FieldName.SENTENCE_TEXT].strip()
@@ -187,106 +278,252 @@ class HallucinationDetector :
                     'Sentence': sentence_text,
                     }
                 items.append(request)
+        return self._detect_items(data_id, source, items, perf_counters, deadline)
+
+    def _detect_items(self, data_id : str, source : str, items : List[Dict], perf_counters : dict, deadline : Deadline = None) -> List[Dict]:
+        results = []
+        # dedup (source, hypothesis) pairs against everything already sent in this run.
+        # items we own are sent to GPT, the others wait on the owner's verdict.
+        owned, pending = [], []
+        source_key = self._sources.key(source)
+        if self._hypothesis_memo is not None:
+            for item in items:
+                key = (source_key, item['Hypothesis'])
+                is_owner, future = self._hypothesis_memo.claim(key)
+                (owned if is_owner else pending).append((item, key, future))
+            items = [item for item, _, _ in owned]
+            perf_counters["n_memo_hits"] = perf_counters.get("n_memo_hits", 0) + len(pending)
+
+        verdicts, timed_out_items = [], []
+        try:
+            if self._verdict_cache is not None:
+                uncached_items = []
+                for item in items:
+                    hit = self._verdict_cache.lookup(source_key, item['Hypothesis'])
+                    if hit is None:
+                        uncached_items.append(item)
+                        continue
+                    logging.info(f"data_id: {data_id}, sentence_id: {item['SentenceId']}, reusing cached verdict of \"{hit.matched_hypothesis}\" (jaccard {hit.similarity:.2f}) for \"{item['Hypothesis']}\"")
+                    self._verdict_cache.record_reuse(data_id, item['SentenceId'], item['Hypothesis'], hit)
+                    verdicts.append((item, hit.reasons))
+                    self._count_hypotheses([item], 'cache')
+                perf_counters["n_cache_hits"] = perf_counters.get("n_cache_hits", 0) + len(items) - len(uncached_items)
+                items = uncached_items
+
+            perf_counters["n_gpt_requests"] += len(items)
+            if self._micro_batcher is not None:
+                gpt_verdicts, gpt_timed_out_items, unverified_items = self._micro_batcher.submit(source_key, source, items, perf_counters, deadline)
+            else:
+                gpt_verdicts, gpt_timed_out_items, unverified_items = self._verify_items(source, items, perf_counters, deadline)
+            timed_out_items += gpt_timed_out_items
+            # the default verdicts of failed or unparseable payloads are reported, but not reused
+            unverified = set(id(item) for item in unverified_items)
+            if self._verdict_cache is not None:
+                for item, reasons in gpt_verdicts:
+                    if id(item) not in unverified:
+                        self._verdict_cache.add(source_key, item['Hypothesis'], reasons)
+            verdicts += gpt_verdicts
+            self._count_hypotheses([item for item, _ in gpt_verdicts], 'gpt')
+        except BaseException as exc:
+            for _, key, future in owned:
+                self._hypothesis_memo.fail(key, future, exc)
+            raise
+
+        for item, reasons in verdicts:
+            results += [HallucinationDetector.to_hallucination_record(item, reason) for reason in reasons]
+
+        if len(timed_out_items) > 0:
+            self._count_hypotheses(timed_out_items, 'timed_out')
+            perf_counters["n_timed_out_requests"] = perf_counters.get("n_timed_out_requests", 0) + len(timed_out_items)
+            logging.warning(f"data_id: {data_id}, {len(timed_out_items)} hypotheses dropped because the deadline expired")
+
+        if self._hypothesis_memo is not None:
+            # publish our verdicts before waiting on others, so concurrent data never wait on each other in a cycle
+            verdict_by_hypothesis = {item['Hypothesis']: reasons for item, reasons in verdicts if id(item) not in unverified}
+            for item, key, future in owned:
+                if item['Hypothesis'] in verdict_by_hypothesis:
+                    HypothesisMemo.resolve(future, verdict_by_hypothesis[item['Hypothesis']])
+                elif id(item) in unverified:
+                    self._hypothesis_memo.fail(key, future, UnverifiedHypothesis(f"data_id: {data_id} got no usable verdict"))
+                else:
+                    self._hypothesis_memo.fail(key, future, DeadlineExceeded(f"data_id: {data_id} timed out"))
+
+            retry_items = []
+            with tracing.span('memo_wait', n_pending=len(pending)):
+                for item, _, future in pending:
+                    try:
+                        reasons = future.result(timeout=deadline.remaining() if deadline is not None else None)
+                    except FutureTimeoutError:
+                        deadline.mark_timed_out()
+                        self._count_hypotheses([item], 'timed_out')
+                        continue
+                    except (DeadlineExceeded, UnverifiedHypothesis):
+                        # the owner ran out of time or got no usable verdict, not us: check the hypothesis ourselves
+                        if deadline is not None and deadline.expired():
+                            deadline.mark_timed_out()
+                            self._count_hypotheses([item], 'timed_out')
+                        else:
+                            retry_items.append(item)
+                        continue
+                    results += [HallucinationDetector.to_hallucination_record(item, reason) for reason in reasons]
+                    self._count_hypotheses([item], 'memo')
+            if len(retry_items) > 0:
+                results += self._detect_items(data_id, source, retry_items, perf_counters, deadline)
+
+        return results
+
+    # sends the items to GPT in payloads of batch_size, returns (verdicts, items dropped because of the deadline,
+    # items without a usable verdict). Items coalesced from n_callers callers get the parallelism of as many calls
+    def _verify_items(self, source : str, items : List[Dict], perf_counters : dict, deadline : Deadline = None, n_callers : int = 1) -> tuple:
+        batch_size = self._detection_args.batch_size
+        max_parallelism = self._openai_args.max_parallelism * max(n_callers, 1)
+        disable_progress = self._disable_progress_bar
+
         count = len(items)
-        perf_counters["n_gpt_requests"] += count
         npayloads = math.ceil(count / batch_size)
-        gpt_request_payloads = [
-            self.create_payload(
-                items = items[i * batch_size: min((i + 1) * batch_size, count)],
-                src = source,
-                promptUtil = self._prompt_util,
-            )
-            for i in range(npayloads)
-        ]
-        perf_counters["n_gpt_calls"] += len(gpt_request_payloads)
-        if len(gpt_request_payloads) > 0:
-            gpt_results_raw = list()
-            max_workers = min(max(max_parallelism, 1), len(gpt_request_payloads))
-            with tqdm(total=len(gpt_request_payloads), disable=disable_progress, leave=False) as pbar2:
-                with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                    futures = {
-                        executor.submit(
-                            self.process_payload_by_GPT,
-                            payload,
-                            self.aoaiUtil,
-                            self._openai_args,
-                            self._detection_args): payload
-                        for payload in gpt_request_payloads
-                    }
-                    
-                    for future in as_completed(futures):
-                        gpt_results_raw.append(future.result())
-                        pbar2.update(1)
-            results += HallucinationDetector.parse_gpt_results(gpt_results_raw)
-            
-        return results
+        with tracing.span('build_prompts', n_items=count, n_payloads=npayloads), profiling.stage(profiling.PROMPT_CONSTRUCTION):
+            source_prompt = self._sources.artifact(source, 'detection_prompt', self._prompt_util.fill_source) if npayloads > 0 else None
+            gpt_request_payloads = [
+                self.create_payload(
+                    items = items[i * batch_size: min((i + 1) * batch_size, count)],
+                    src = source,
+                    promptUtil = self._prompt_util,
+                    source_prompt = source_prompt,
+                )
+                for i in range(npayloads)
+            ]
+        perf_counters["n_gpt_calls"] = perf_counters.get("n_gpt_calls", 0) + len(gpt_request_payloads)
+        if len(gpt_request_payloads) == 0:
+            return [], [], []
+        gpt_results_raw = list()
+        max_workers = min(max(max_parallelism, 1), len(gpt_request_payloads))
+        with tqdm(total=len(gpt_request_payloads), disable=disable_progress, leave=False) as pbar2:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(
+                        tracing.traced(self.process_payload_by_GPT),
+                        payload,
+                        self.aoaiUtil,
+                        self._openai_args,
+                        self._detection_args,
+                        deadline): payload
+                    for payload in gpt_request_payloads
+                }
+                
+                for future in as_completed(futures):
+                    gpt_results_raw.append(future.result())
+                    pbar2.update(1)
+        # payloads dropped because of the deadline have no verdict, they are neither cached nor reported
+        timed_out_items = []
+        for gpt_result_raw in gpt_results_raw:
+            if gpt_result_raw.get('timed_out', False):
+                timed_out_items += gpt_result_raw['items']
+        # items of failed calls or unparseable outputs get the default verdict, but are reported as unverified
+        unverified_items = []
+        with tracing.span('parse', n_payloads=len(gpt_results_raw)), profiling.stage(profiling.PARSING):
+            gpt_verdicts = HallucinationDetector.parse_gpt_verdicts([x for x in gpt_results_raw if not x.get('timed_out', False)], unverified_items)
+        return gpt_verdicts, timed_out_items, unverified_items
     
     @staticmethod
-    def create_payload(items, src, promptUtil : hallucination_detection_prompt) -> Dict:
-        prompt_to_send_to_gpt = promptUtil.create_batch_prompt(src, items, 4096)  # need to add this and the prompt
+    def create_payload(items, src, promptUtil : hallucination_detection_prompt, source_prompt = None) -> Dict:
+        prompt_to_send_to_gpt = promptUtil.create_batch_prompt(src, items, 4096, source_prompt=source_prompt)  # need to add this and the prompt
         return {'prompt': prompt_to_send_to_gpt, 'items': items}
 
     # send payload to GPT endpoint and get back the results
     @staticmethod
-    def process_payload_by_GPT(payload, aoaiUtil : AOAIUtil, openai_args : OpenaiArguments, detection_args : DetectionArguments) -> Dict:
+    def process_payload_by_GPT(payload, aoaiUtil : AOAIUtil, openai_args : OpenaiArguments, detection_args : DetectionArguments, deadline : Deadline = None) -> Dict:
 
-        outputs = []
-        try:
-            logging.info(f"Start to call GPT to process {len(payload['items'])} items")
-            if openai_args.use_chat_completions:
-                gpt_response = aoaiUtil.get_chat_completion(
-                    messages = payload['prompt'],
-                    temperature = detection_args.temp,
-                    top_p = detection_args.top_p, 
-                    max_tokens = detection_args.max_tokens,
-                    frequency_penalty = detection_args.freq_penalty,
-                    presence_penalty = detection_args.presence_penalty,
-                    generations=detection_args.generations)
-                choices = gpt_response['choices']
-                for choice in choices:
-                    outputs.append(gpt_output_utils.clean_for_tsv(choice['message']['content']))
-                payload['gpt_raw_output'] = outputs
-            else:
-                gpt_response = aoaiUtil.get_completion(
-                    prompt = payload['prompt'],
-                    max_tokens = detection_args.max_tokens,
-                    temperature = detection_args.temp,
-                    top_p = detection_args.top_p,
-                    frequency_penalty = detection_args.freq_penalty,
-                    presence_penalty = detection_args.presence_penalty,
-                    logprobs = detection_args.log_prob,
-                    generations=detection_args.generations)
-                choices = gpt_response['choices']
-                for choice in choices:
-                    outputs.append(gpt_output_utils.clean_for_tsv(choice['text']))
-                payload['gpt_raw_output'] = outputs
-            logging.info(f"Completed calling GPT to process {len(payload['items'])} items")
-        except Exception as exc:
-            logging.warning(f"Failed to call GPT: output format wrong!")
-            logging.warning(f'Exception: {exc}')
-            payload['gpt_raw_output'] = [ 'the format of gpt output is wrong' ]
+        with tracing.span('gpt_batch', n_items=len(payload['items'])) as batch_span, profiling.stage(profiling.GPT_ROUND_TRIP):
+            outputs = []
+            try:
+                logging.info(f"Start to call GPT to process {len(payload['items'])} items")
+                if openai_args.use_chat_completions:
+                    gpt_response = aoaiUtil.get_chat_completion(
+                        messages = payload['prompt'],
+                        temperature = detection_args.temp,
+                        top_p = detection_args.top_p, 
+                        max_tokens = detection_args.max_tokens,
+                        frequency_penalty = detection_args.freq_penalty,
+                        presence_penalty = detection_args.presence_penalty,
+                        generations=detection_args.generations,
+                        deadline=deadline)
+                    choices = gpt_response['choices']
+                    for choice in choices:
+                        outputs.append(gpt_output_utils.clean_for_tsv(choice['message']['content']))
+                    payload['gpt_raw_output'] = outputs
+                else:
+                    gpt_response = aoaiUtil.get_completion(
+                        prompt = payload['prompt'],
+                        max_tokens = detection_args.max_tokens,
+                        temperature = detection_args.temp,
+                        top_p = detection_args.top_p,
+                        frequency_penalty = detection_args.freq_penalty,
+                        presence_penalty = detection_args.presence_penalty,
+                        logprobs = detection_args.log_prob,
+                        generations=detection_args.generations,
+                        deadline=deadline)
+                    choices = gpt_response['choices']
+                    for choice in choices:
+                        outputs.append(gpt_output_utils.clean_for_tsv(choice['text']))
+                    payload['gpt_raw_output'] = outputs
+                logging.info(f"Completed calling GPT to process {len(payload['items'])} items")
+            except Exception as exc:
+                if deadline is not None and deadline.timed_out and deadline.expired():
+                    logging.warning(f"GPT request for {len(payload['items'])} items timed out")
+                    payload['timed_out'] = True
+                else:
+                    logging.warning(f"Failed to call GPT: output format wrong!")
+                    logging.warning(f'Exception: {exc}')
+                    payload['failed'] = True
+                payload['gpt_raw_output'] = [ 'the format of gpt output is wrong' ]
+            batch_span.set(timed_out=payload.get('timed_out', False), n_outputs=len(payload['gpt_raw_output']))
 
         return payload
 
     @staticmethod
-    def parse_gpt_results_single(gpt_result_raw) -> list:
-        gpt_result_cooked = []
+    def to_hallucination_record(item, reason : str) -> Dict:
+        return {
+            FieldName.DATA_ID: item['DataId'],
+            FieldName.SENTENCE_ID: item['SentenceId'],
+            FieldName.DETECTION_TYPE: item["DetectionType"],
+            FieldName.SENTENCE_TEXT: item['Hypothesis'],
+            FieldName.NAME: item['DetectedEntityCleaned'],
+            FieldName.TYPE: item['DetectedEntityType'],
+            FieldName.REASON: reason
+        }
+
+    # returns (item, reasons) for every item in the payload, with one reason per generation
+    # that flagged the item as hallucination. An empty list means no hallucination. The items of a failed
+    # call, or that a generation could not be parsed for, are appended to unverified_items when it is given
+    @staticmethod
+    def parse_gpt_verdicts_single(gpt_result_raw, unverified_items : list = None) -> list:
+        reasons = [[] for _ in gpt_result_raw["items"]]
+        verified = [not gpt_result_raw.get('failed', False) for _ in gpt_result_raw["items"]]
         # extraction depends on the prompts
         for generation in range(len(gpt_result_raw["gpt_raw_output"])):
             ans = gpt_output_utils.parse_gpt_batch(gpt_result_raw["gpt_raw_output"][generation], len(gpt_result_raw["items"]))  # this is the the result for each item
-            for i, item in enumerate(gpt_result_raw["items"]):
+            for i in range(len(gpt_result_raw["items"])):
+                verified[i] = verified[i] and ans[i]['ParseSuccessful']
                 if ans[i]['IsHallucination']:
                     # At this point we think we've found a hallucination
-                    gpt_result_cooked.append({
-                        FieldName.DATA_ID: item['DataId'],
-                        FieldName.SENTENCE_ID: item['SentenceId'],
-                        FieldName.DETECTION_TYPE: item["DetectionType"],
-                        FieldName.SENTENCE_TEXT: item['Hypothesis'],
-                        FieldName.NAME: item['DetectedEntityCleaned'],
-                        FieldName.TYPE: item['DetectedEntityType'],
-                        FieldName.REASON: ans[i]['Reason']
-                    })
-        return gpt_result_cooked
+                    reasons[i].append(ans[i]['Reason'])
+        if unverified_items is not None:
+            unverified_items += [item for item, ok in zip(gpt_result_raw["items"], verified) if not ok]
+        return list(zip(gpt_result_raw["items"], reasons))
+
+    @staticmethod
+    def parse_gpt_verdicts(gpt_results_raw, unverified_items : list = None) -> list:
+        verdicts = []
+        for gpt_result_raw in gpt_results_raw:
+            verdicts += HallucinationDetector.parse_gpt_verdicts_single(gpt_result_raw, unverified_items)
+        return verdicts
+
+    @staticmethod
+    def parse_gpt_results_single(gpt_result_raw) -> list:
+        return [
+            HallucinationDetector.to_hallucination_record(item, reason)
+            for item, reasons in HallucinationDetector.parse_gpt_verdicts_single(gpt_result_raw)
+            for reason in reasons]
 
     @staticmethod
     def parse_gpt_results(gpt_results_raw) -> List[Dict]:
@@ -294,4 +531,3 @@ class HallucinationDetector :
         for gpt_result_raw in gpt_results_raw:
             gpt_results_cooked += HallucinationDetector.parse_gpt_results_single(gpt_result_raw)
         return gpt_results_cooked
-
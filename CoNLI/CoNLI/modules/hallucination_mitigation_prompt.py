@@ -1,16 +1,16 @@
 import copy
 import os
-import yaml
-from transformers import GPT2TokenizerFast
+from CoNLI.modules.utils.tokenizer_utils import load_gpt2_tokenizer
 
 class hallucination_mitigation_prompt :
 
     def __init__(self, use_chat_completions : bool, prompt_resource_root_folder : str = None) -> None:
-        self._tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
         self._prompt_resource_root = prompt_resource_root_folder if prompt_resource_root_folder is not None else os.path.join(os.path.dirname(__file__), "..")
         self._maxPromptTokens = 32000
         self._use_chat_completions = use_chat_completions
         self._prompt = self._loadPrompt('hallucination_mitigation/v3', use_chat_completions) # TODO: add prompt
+        self._sentence_prompt = self._loadPrompt('hallucination_mitigation/sentence_local.v1', use_chat_completions)
+        self._packed_prompt = self._loadPrompt('hallucination_mitigation/packed.v1', use_chat_completions)
 
     def resolve_file_path(self, file_path : str) -> str:
         # if file_path is not a full path, then resolve it to the full path
@@ -24,6 +24,7 @@ class hallucination_mitigation_prompt :
         return open(file_path, 'r').read()
 
     def _loadPrompt(self, filename : str, useChatCompletions : bool = False) :
+        import yaml
         yamlfile = self.resolve_file_path(f'prompts/chat_completions/{filename}.yaml')
         if useChatCompletions:
             return yaml.safe_load(self.load_file_content(yamlfile))
@@ -37,7 +38,7 @@ class hallucination_mitigation_prompt :
 
     def _validate_prompt(self, prompt, max_tokens) :
         if not self._use_chat_completions :
-            if len(self._tokenizer(prompt, truncation=True, max_length=32000)['input_ids']) + max_tokens > self._maxPromptTokens :
+            if len(load_gpt2_tokenizer()(prompt, truncation=True, max_length=32000)['input_ids']) + max_tokens > self._maxPromptTokens :
                 raise ValueError(f'len(prompt) ({len(prompt)}) + max_tokens ({max_tokens}) must be less than {self._maxPromptTokens}') 
         return prompt
 
@@ -57,4 +58,19 @@ class hallucination_mitigation_prompt :
         prompt = self._replace(prompt, '{{raw_response}}', raw_response)
         prompt = self._replace(prompt, '{{rewrite_instructions}}', rewrite_instructions)
         self._validate_prompt(prompt, max_tokens)
-        return prompt
\ No newline at end of file
+        return prompt
+
+    # sentence-local rewrite: sentences is the numbered list of the flagged sentences with their context and reasons
+    def create_sentence_prompt(self, source: str, sentences: str, max_tokens: int):
+        prompt = copy.deepcopy(self._sentence_prompt)
+        prompt = self._replace(prompt, '{{source}}', source)
+        prompt = self._replace(prompt, '{{sentences}}', sentences)
+        self._validate_prompt(prompt, max_tokens)
+        return prompt
+
+    # several short data in one request: documents is the numbered sections, each with its source, response and instructions
+    def create_packed_prompt(self, documents: str, max_tokens: int):
+        prompt = copy.deepcopy(self._packed_prompt)
+        prompt = self._replace(prompt, '{{documents}}', documents)
+        self._validate_prompt(prompt, max_tokens)
+        return prompt
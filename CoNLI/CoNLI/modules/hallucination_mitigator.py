@@ -1,21 +1,42 @@
 import logging
 import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import Callable, Dict, List, Tuple
 from tqdm import tqdm
 from pathlib import Path
 
 import CoNLI.modules.utils.gpt_output_utils as gpt_output_utils
 from CoNLI.modules.utils.aoai_utils import AOAIUtil
+from CoNLI.modules.utils import profiling
 from CoNLI.modules.hallucination_mitigation_prompt import hallucination_mitigation_prompt
 from CoNLI.modules.arguments import OpenaiArguments, MitigationArguments
+from CoNLI.modules.hd_constants import FieldName, MitigationMode
+
+# sentence mode: where the flagged sentence sits in its context, and the answer that removes it
+SENTENCE_PLACEHOLDER = '[SENTENCE]'
+DELETE_MARKER = '[DELETE]'
+
+# answer length the document mode prompts tell GPT to expect
+GPT_OUTPUT_LENGTH_EXPECTATION = 4096 # TODO: make it configurable
+
+# packed requests: the sections of the prompt and of the answer, numbered by the position of the data in the pack
+PACKED_DOCUMENT_START = '=== Document {} ==='
+PACKED_DOCUMENT_END = '=== End of document {} ==='
+PACKED_ANSWER_START = '=== Corrected CLAIM {} ==='
+PACKED_ANSWER_END = '=== End of CLAIM {} ==='
+PACK_SECTION_TOKENS = 32 # markers and headers of a section, in prompt and answer
+
+# rough token count (about 4 characters per token) to size packs without loading a tokenizer
+def estimate_tokens(text : str) -> int:
+    return len(text) // 4 + 1
 
 @dataclass
 class HmResult:
     data_id: str
     raw_response: str
     refined_response: str
+    failed: bool = False # the GPT call failed, refined_response is not a rewrite
 
 @dataclass
 class HdResult:
@@ -23,7 +44,31 @@ class HdResult:
     reason: List[str] # why the sentence is hallucination or not
     instruction: str # instruction for rewriting the sentence
     detection_type: str # the detector type that found the hallucination (sentence-level, entity-level)
+    sentence_id: int = None # id of the sentence in raw_response, the detections of a sentence share it
+
+# the HdResults of a data from its detected hallucinations, as returned by HallucinationDetector.detect_hallucinations
+# and written to allhallucinations.jsonl
+def to_hd_results(hallucinations : List[Dict]) -> List[HdResult]:
+    return [
+        HdResult(
+            hallucinated_sentence = hallucination[FieldName.SENTENCE_TEXT],
+            reason = hallucination[FieldName.REASON],
+            instruction = hallucination[FieldName.REASON], #TODO: convert reason into better mitigation instruction
+            detection_type = hallucination[FieldName.DETECTION_TYPE],
+            sentence_id = hallucination.get(FieldName.SENTENCE_ID),
+        )
+        for hallucination in hallucinations
+    ]
 
+# [start, end) of the first occurrence of sentence in text at or after start, whatever the whitespace between
+# its words. The occurrence must start and end at word boundaries, so "is 5." is not found in "is 5.5".
+# (-1, -1) if there is none
+def locate_sentence(text : str, sentence : str, start : int = 0) -> Tuple[int, int]:
+    words = sentence.split()
+    if len(words) == 0:
+        return -1, -1
+    match = re.compile(r'(?<!\S)' + r'\s+'.join(re.escape(w) for w in words) + r'(?!\S)').search(text, start)
+    return (match.start(), match.end()) if match else (-1, -1)
 
 class HallucinationMitigator :
     def __init__(
@@ -31,14 +76,18 @@ class HallucinationMitigator :
             openai_args : OpenaiArguments = OpenaiArguments(),
             mitigation_args : MitigationArguments = MitigationArguments(),
             config_file: str = (Path(__file__).absolute()).parent.parent/"configs"/"aoai_config.json",
+            request_timeout: float = None,
+            max_retry_wait: float = 60,
             ) -> None:
         
         self._mitigation_args = mitigation_args
         self._openai_args = openai_args 
+        # the api key is read from config_file by AOAIUtil
         self.aoaiUtil = AOAIUtil(
             config_setting=openai_args.config_setting,
-            api_key=self._openai_args.api_key,
             config_file=config_file,
+            request_timeout=request_timeout,
+            max_retry_wait=max_retry_wait,
             )
         self._prompt_util = hallucination_mitigation_prompt(use_chat_completions = openai_args.use_chat_completions)
 
@@ -48,60 +97,233 @@ class HallucinationMitigator :
             raw_responses: Dict[str, str],
             sources: Dict[str, str],
             hd_results: Dict[str, List[HdResult]],
+            on_result: Callable[[HmResult], None] = None,
             ) -> List[HmResult]:
+        # on_result(result) is called for every data as soon as its result is known, in the calling thread
         max_parallelism = self._openai_args.max_parallelism
 
         items, results = [], []
+        def add_result(result : HmResult) -> None:
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+
         for data_id in data_ids:
             raw_response = raw_responses[data_id]
-            source = sources[data_id]
             hd_result = hd_results[data_id]
 
             if len(hd_result) == 0:
-                results.append(HmResult(data_id, raw_response, raw_response))
+                add_result(HmResult(data_id, raw_response, raw_response))
                 continue
-            
-            instructions: str = HallucinationMitigator.get_instructions_by_hd_results(hd_result)
-
-            # sending one request per data
-            request = {
-                'data_id': data_id,
-                'source': source,
-                'raw_response': raw_response,
-                'rewrite_instructions': instructions,
-                }
-            items.append(request)
-            
-        gpt_request_payloads = [
-            self.create_payload(
-                item = items[i],
-                promptUtil = self._prompt_util,
-            )
-            for i in range(len(items))
-        ]
+
+            items.append(self.create_item(data_id, raw_response, sources[data_id], hd_result))
+
+        # one request per data, or per pack of short data when pack_token_budget is set
+        with profiling.stage(profiling.PROMPT_CONSTRUCTION):
+            gpt_request_payloads = [
+                self.create_payload(
+                    item = pack[0],
+                    promptUtil = self._prompt_util,
+                    max_tokens = self._mitigation_args.max_tokens,
+                )
+                if len(pack) == 1 else
+                self.create_packed_payload(
+                    items = pack,
+                    promptUtil = self._prompt_util,
+                    max_tokens = self._mitigation_args.max_tokens,
+                )
+                for pack in self.pack_items(items)
+            ]
 
         if len(gpt_request_payloads) > 0:
-            gpt_results_raw = list()
             max_workers = min(max(max_parallelism, 1), len(gpt_request_payloads))
-            with tqdm(total=len(gpt_request_payloads)) as pbar:
+            with tqdm(total=len(items)) as pbar:
                 with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                    futures = {
-                        executor.submit(
+                    def submit(payload):
+                        return executor.submit(
                             self.process_payload_by_GPT,
                             payload,
                             self.aoaiUtil,
                             self._openai_args,
-                            self._mitigation_args): payload
-                        for payload in gpt_request_payloads
-                    }
-                    
-                    for future in as_completed(futures):
-                        gpt_results_raw.append(future.result())
-                        pbar.update(1)
-            results += HallucinationMitigator.parse_gpt_result(gpt_results_raw)
-            
+                            self._mitigation_args)
+                    pending = set(submit(payload) for payload in gpt_request_payloads)
+                    while len(pending) > 0:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            payload = future.result()
+                            with profiling.stage(profiling.PARSING):
+                                parsed = HallucinationMitigator.parse_gpt_result([payload])
+                            for result in parsed:
+                                add_result(result)
+                                pbar.update(1)
+                            # the data of a pack whose answer could not be split are sent again, one request each
+                            parsed_ids = set(result.data_id for result in parsed)
+                            for item in payload.get('items', []):
+                                if item['data_id'] not in parsed_ids:
+                                    logging.info(f"No answer for {item['data_id']} in its packed request, sending it alone")
+                                    with profiling.stage(profiling.PROMPT_CONSTRUCTION):
+                                        single_payload = self.create_payload(item, self._prompt_util, self._mitigation_args.max_tokens)
+                                    pending.add(submit(single_payload))
+
         return results
+
+    # groups the document mode items, in order, into packs whose sources, responses and instructions fit in
+    # pack_token_budget and whose rewrites fit in max_tokens. Sentence mode items and items too large to share
+    # a request are packs of their own
+    def pack_items(self, items: List[Dict]) -> List[List[Dict]]:
+        budget = self._mitigation_args.pack_token_budget
+        if budget <= 0:
+            return [[item] for item in items]
+        packs, current, current_in, current_out = [], [], 0, 0
+        for item in items:
+            if 'sentences' in item:
+                packs.append([item])
+                continue
+            # the response is in the prompt and, rewritten, in the answer
+            response_tokens = estimate_tokens(item['raw_response']) + PACK_SECTION_TOKENS
+            item_in = estimate_tokens(item['source']) + estimate_tokens(item['rewrite_instructions']) + response_tokens
+            if len(current) > 0 and (
+                    current_in + item_in > budget
+                    or current_out + response_tokens > self._mitigation_args.max_tokens
+                    or len(current) >= self._mitigation_args.pack_max_documents):
+                packs.append(current)
+                current, current_in, current_out = [], 0, 0
+            current.append(item)
+            current_in += item_in
+            current_out += response_tokens
+        if len(current) > 0:
+            packs.append(current)
+        return packs
     
+    # rewrites a single data in the calling thread, as soon as its hallucinations are known. A data without
+    # hallucinations is passed through without a GPT call
+    def mitigate_one(
+            self,
+            data_id: str,
+            raw_response: str,
+            source: str,
+            hd_result: List[HdResult],
+            ) -> HmResult:
+        if len(hd_result) == 0:
+            return HmResult(data_id, raw_response, raw_response)
+        with profiling.stage(profiling.PROMPT_CONSTRUCTION):
+            payload = self.create_payload(
+                item = self.create_item(data_id, raw_response, source, hd_result),
+                promptUtil = self._prompt_util,
+                max_tokens = self._mitigation_args.max_tokens,
+            )
+        gpt_result_raw = self.process_payload_by_GPT(payload, self.aoaiUtil, self._openai_args, self._mitigation_args)
+        with profiling.stage(profiling.PARSING):
+            return HallucinationMitigator.parse_gpt_result([gpt_result_raw])[0]
+
+    # the request of a data. In sentence mode it holds the flagged sentences and their offsets in raw_response,
+    # unless one of them cannot be found there, then the whole response is rewritten
+    def create_item(self, data_id: str, raw_response: str, source: str, hd_result: List[HdResult]) -> Dict:
+        item = {
+            'data_id': data_id,
+            'source': source,
+            'raw_response': raw_response,
+            }
+        if self._mitigation_args.mode == MitigationMode.SENTENCE:
+            sentences = HallucinationMitigator.locate_flagged_sentences(raw_response, hd_result)
+            if sentences is not None:
+                item['sentences'] = sentences
+                item['context_chars'] = self._mitigation_args.context_chars
+                return item
+            logging.info(f'Flagged sentences of {data_id} not found in its response, rewriting the whole response')
+        item['rewrite_instructions'] = HallucinationMitigator.get_instructions_by_hd_results(hd_result)
+        return item
+
+    # the distinct flagged sentences in order of their offsets in raw_response, with the instructions of every
+    # detection of the sentence. None if a sentence is not found in raw_response.
+    # Sentences are located in sentence_id order, each searched from the end of the previous one, so a sentence
+    # repeated in the response is matched to the right occurrence
+    @staticmethod
+    def locate_flagged_sentences(raw_response: str, hd_results: List[HdResult]) -> List[Dict]:
+        # sentence (its sentence_id, or its text when there is none) -> instructions of its detections
+        detections = {}
+        for hd_result in hd_results:
+            key = hd_result.sentence_id if hd_result.sentence_id is not None else hd_result.hallucinated_sentence
+            span_instructions = detections.setdefault(key, (hd_result.hallucinated_sentence, []))[1]
+            if hd_result.instruction not in span_instructions:
+                span_instructions.append(hd_result.instruction)
+        keys = list(detections.keys())
+        if all(isinstance(key, int) for key in keys):
+            keys = sorted(keys)
+        instructions = {}
+        search_from = 0
+        for key in keys:
+            hallucinated_sentence, span_instructions = detections[key]
+            sentence = HallucinationMitigator.clean_span(hallucinated_sentence)
+            # entity-level hypotheses tag the entity as "[ entity ]"
+            candidates = [sentence, re.sub(r'\[ (.*?) \]', r'\1', sentence)]
+            start, end = -1, -1
+            # searching from the start again only when the sentences are not in response order
+            for candidate, offset in [(c, o) for o in (search_from, 0) for c in candidates]:
+                start, end = locate_sentence(raw_response, candidate, offset)
+                if start >= 0:
+                    break
+            if start < 0:
+                return None
+            search_from = end
+            for instruction in span_instructions:
+                if instruction not in instructions.setdefault((start, end), []):
+                    instructions[(start, end)].append(instruction)
+        located = []
+        for (start, end), span_instructions in sorted(instructions.items()):
+            # a sentence found inside an earlier one is rewritten with it
+            if len(located) > 0 and start < located[-1]['end']:
+                continue
+            located.append({'start': start, 'end': end, 'text': raw_response[start:end], 'instruction': ' '.join(span_instructions)})
+        return located
+
+    # the numbered flagged sentences, each with the text around it and the reason for the rewrite
+    @staticmethod
+    def format_flagged_sentences(raw_response: str, sentences: List[Dict], context_chars: int) -> str:
+        def one_line(text):
+            return ' '.join(text.split())
+        blocks = []
+        for i, sentence in enumerate(sentences):
+            before = raw_response[max(sentence['start'] - context_chars, 0):sentence['start']]
+            after = raw_response[sentence['end']:sentence['end'] + context_chars]
+            # cut the context at word boundaries
+            if sentence['start'] > context_chars and ' ' in before:
+                before = '... ' + before.split(' ', 1)[1]
+            if sentence['end'] + context_chars < len(raw_response) and ' ' in after:
+                after = after.rsplit(' ', 1)[0] + ' ...'
+            blocks.append(
+                f"({i}). Sentence: {one_line(sentence['text'])}\n" + \
+                f"Context: {one_line(before + SENTENCE_PLACEHOLDER + after)}\n" + \
+                f"Reason for rewrite the sentence: {one_line(sentence['instruction'])}")
+        return '\n'.join(blocks)
+
+    # the rewrite of each of n_sentences in a sentence mode answer: None where the answer has none
+    @staticmethod
+    def parse_sentence_rewrites(gpt_raw_output: str, n_sentences: int) -> List[str]:
+        answer = gpt_raw_output.replace('<|im_end|>', '').split('Answer:', 1)[-1]
+        rewrites = [None] * n_sentences
+        for no, text in re.findall(r'^\s*\((\d+)\)\.\s?(.*)$', answer, flags=re.MULTILINE):
+            i = int(no)
+            if i < n_sentences and rewrites[i] is None and len(text.strip()) > 0:
+                rewrites[i] = text.strip()
+        return rewrites
+
+    # replaces each sentence by its rewrite in raw_response, from the last one backwards so that the offsets
+    # of the earlier ones stay valid. Deleted sentences take the whitespace after them along
+    @staticmethod
+    def splice_sentences(raw_response: str, sentences: List[Dict], rewrites: List[str]) -> str:
+        refined = raw_response
+        for sentence, rewrite in reversed(list(zip(sentences, rewrites))):
+            start, end = sentence['start'], sentence['end']
+            if rewrite is None:
+                continue
+            if rewrite == DELETE_MARKER:
+                while end < len(refined) and refined[end] in ' \t':
+                    end += 1
+                rewrite = ''
+            refined = refined[:start] + rewrite + refined[end:]
+        return refined
+
     @staticmethod
     def clean_span(x):
         return " ".join(re.sub("[\\<].*?[\\>]", "", x).split())
@@ -127,8 +349,17 @@ class HallucinationMitigator :
         return final_instructions
 
     @staticmethod
-    def create_payload(item, promptUtil : hallucination_mitigation_prompt) -> Dict:
-        GPT_OUTPUT_LENGTH_EXPECTATION = 4096 # TODO: make it configurable
+    def create_payload(item, promptUtil : hallucination_mitigation_prompt, max_tokens : int = 1024) -> Dict:
+        if 'sentences' in item:
+            # the answer is about as long as the flagged sentences, not the whole response
+            sentences = item['sentences']
+            max_tokens = min(max_tokens, 16 + sum(8 + len(s['text']) // 2 for s in sentences))
+            prompt_to_send_to_gpt = promptUtil.create_sentence_prompt(
+                source = item['source'],
+                sentences = HallucinationMitigator.format_flagged_sentences(item['raw_response'], sentences, item['context_chars']),
+                max_tokens = max_tokens,
+                )
+            return {'prompt': prompt_to_send_to_gpt, 'item': item, 'max_tokens': max_tokens}
         prompt_to_send_to_gpt = promptUtil.create_prompt(
             source = item['source'], 
             raw_response = item['raw_response'], 
@@ -137,45 +368,87 @@ class HallucinationMitigator :
             )
         return {'prompt': prompt_to_send_to_gpt, 'item': item}
 
+    # one request for several document mode items, each in its numbered section
+    @staticmethod
+    def create_packed_payload(items: List[Dict], promptUtil : hallucination_mitigation_prompt, max_tokens : int = 1024) -> Dict:
+        documents = '\n\n'.join(
+            f"{PACKED_DOCUMENT_START.format(i)}\n" + \
+            f"DOCUMENT:\n{item['source']}\nEnd DOCUMENT.\n" + \
+            f"CLAIM:\n{item['raw_response']}\nEnd CLAIM.\n" + \
+            f"Rewrite instructions:\n{item['rewrite_instructions']}" + \
+            f"{PACKED_DOCUMENT_END.format(i)}"
+            for i, item in enumerate(items))
+        prompt_to_send_to_gpt = promptUtil.create_packed_prompt(
+            documents = documents,
+            max_tokens = max(GPT_OUTPUT_LENGTH_EXPECTATION, max_tokens),
+            )
+        return {'prompt': prompt_to_send_to_gpt, 'items': items, 'max_tokens': max_tokens}
+
+    # the rewrite of each of n_items in a packed answer: None where the answer has no complete section for it.
+    # A section ends at its end marker, or at the start of the next section; a last section without its end
+    # marker may be truncated and is not used. An empty section closed by its end marker is a rewrite that
+    # removed every sentence, as the prompt allows, and is kept
+    @staticmethod
+    def split_packed_rewrites(gpt_raw_output: str, n_items: int) -> List[str]:
+        answer = gpt_raw_output.replace('<|im_end|>', '')
+        starts = list(re.finditer(r'^[ \t]*=== Corrected CLAIM (\d+) ===[ \t]*$', answer, flags=re.MULTILINE))
+        rewrites = [None] * n_items
+        for k, start in enumerate(starts):
+            i = int(start.group(1))
+            if i >= n_items or rewrites[i] is not None:
+                continue
+            section = answer[start.end():starts[k + 1].start() if k + 1 < len(starts) else len(answer)]
+            end = re.search(r'^[ \t]*' + re.escape(PACKED_ANSWER_END.format(i)), section, flags=re.MULTILINE)
+            if end is not None:
+                section = section[:end.start()]
+            elif k + 1 == len(starts):
+                continue
+            section = section.strip()
+            if len(section) > 0 or end is not None:
+                rewrites[i] = section
+        return rewrites
+
     # send payload to GPT endpoint and get back the results
     @staticmethod
     def process_payload_by_GPT(payload, aoaiUtil : AOAIUtil, openai_args : OpenaiArguments, mitigation_args : MitigationArguments) -> Dict:
 
-        outputs = []
-        try:
-            logging.info(f"Start to call GPT to process the data")
-            if openai_args.use_chat_completions:
-                gpt_response = aoaiUtil.get_chat_completion(
-                    messages = payload['prompt'],
-                    temperature = mitigation_args.temp,
-                    top_p = mitigation_args.top_p, 
-                    max_tokens = mitigation_args.max_tokens,
-                    frequency_penalty = mitigation_args.freq_penalty,
-                    presence_penalty = mitigation_args.presence_penalty,
-                    generations=mitigation_args.generations)
-                choices = gpt_response['choices']
-                for choice in choices:
-                    outputs.append(choice['message']['content'])
-                payload['gpt_raw_output'] = outputs
-            else:
-                gpt_response = aoaiUtil.get_completion(
-                    prompt = payload['prompt'],
-                    max_tokens = mitigation_args.max_tokens,
-                    temperature = mitigation_args.temp,
-                    top_p = mitigation_args.top_p,
-                    frequency_penalty = mitigation_args.freq_penalty,
-                    presence_penalty = mitigation_args.presence_penalty,
-                    logprobs = mitigation_args.log_prob,
-                    generations=mitigation_args.generations)
-                choices = gpt_response['choices']
-                for choice in choices:
-                    outputs.append(choice['text'])
-                payload['gpt_raw_output'] = outputs
-            logging.info(f"Completed calling GPT to process the data")
-        except Exception as exc:
-            logging.warning(f"Failed to call GPT: output format wrong!")
-            logging.warning(f'Exception: {exc}')
-            payload['gpt_raw_output'] = [ 'the format of gpt output is wrong' ]
+        with profiling.stage(profiling.GPT_ROUND_TRIP):
+            outputs = []
+            try:
+                logging.info(f"Start to call GPT to process the data")
+                if openai_args.use_chat_completions:
+                    gpt_response = aoaiUtil.get_chat_completion(
+                        messages = payload['prompt'],
+                        temperature = mitigation_args.temp,
+                        top_p = mitigation_args.top_p, 
+                        max_tokens = payload.get('max_tokens', mitigation_args.max_tokens),
+                        frequency_penalty = mitigation_args.freq_penalty,
+                        presence_penalty = mitigation_args.presence_penalty,
+                        generations=mitigation_args.generations)
+                    choices = gpt_response['choices']
+                    for choice in choices:
+                        outputs.append(choice['message']['content'])
+                    payload['gpt_raw_output'] = outputs
+                else:
+                    gpt_response = aoaiUtil.get_completion(
+                        prompt = payload['prompt'],
+                        max_tokens = payload.get('max_tokens', mitigation_args.max_tokens),
+                        temperature = mitigation_args.temp,
+                        top_p = mitigation_args.top_p,
+                        frequency_penalty = mitigation_args.freq_penalty,
+                        presence_penalty = mitigation_args.presence_penalty,
+                        logprobs = mitigation_args.log_prob,
+                        generations=mitigation_args.generations)
+                    choices = gpt_response['choices']
+                    for choice in choices:
+                        outputs.append(choice['text'])
+                    payload['gpt_raw_output'] = outputs
+                logging.info(f"Completed calling GPT to process the data")
+            except Exception as exc:
+                logging.warning(f"Failed to call GPT: output format wrong!")
+                logging.warning(f'Exception: {exc}')
+                payload['gpt_raw_output'] = [ 'the format of gpt output is wrong' ]
+                payload['failed'] = True
 
         return payload
 
@@ -195,17 +468,38 @@ class HallucinationMitigator :
         rewrite_result = rewrite_result.strip()
         return rewrite_result
 
-    # parse gpt result per data
+    # parse gpt result per data. The data of a packed request without an answer in it are left out
     @staticmethod
     def parse_gpt_result(gpt_results_raw) -> List[HmResult]:
         results = []
         for gpt_result_raw in gpt_results_raw:
             gpt_raw_output = gpt_result_raw["gpt_raw_output"][0]
+            if 'items' in gpt_result_raw:
+                items = gpt_result_raw['items']
+                rewrites = HallucinationMitigator.split_packed_rewrites(gpt_raw_output, len(items))
+                for item, rewrite in zip(items, rewrites):
+                    if rewrite is not None:
+                        results.append(
+                            HmResult(
+                                data_id = item['data_id'],
+                                raw_response = item['raw_response'],
+                                refined_response = HallucinationMitigator.postprocess_rewrite_result('Answer:\n' + rewrite),
+                            )
+                        )
+                continue
+            item = gpt_result_raw['item']
+            if 'sentences' in item:
+                # sentences without a usable rewrite are kept as they are
+                rewrites = HallucinationMitigator.parse_sentence_rewrites(gpt_raw_output, len(item['sentences']))
+                refined_response = HallucinationMitigator.splice_sentences(item['raw_response'], item['sentences'], rewrites)
+            else:
+                refined_response = HallucinationMitigator.postprocess_rewrite_result(gpt_raw_output)
             results.append(
                 HmResult(
-                    data_id = gpt_result_raw['item']['data_id'],
-                    raw_response = gpt_result_raw['item']['raw_response'],
-                    refined_response = HallucinationMitigator.postprocess_rewrite_result(gpt_raw_output),
+                    data_id = item['data_id'],
+                    raw_response = item['raw_response'],
+                    refined_response = refined_response,
+                    failed = gpt_result_raw.get('failed', False),
                 )
             )
         return results
\ No newline at end of file
@@ -18,3 +18,9 @@ class AllHallucinations:
     HALLUCINATIONS = 'hallucinations'
     NUM_TOTAL_SENTENCES = 'num_total_sentences'
     NUM_TOTAL_HALLUCINATIONS = 'num_total_hallucinations'
+    TIMED_OUT = 'timed_out'
+
+# how HallucinationMitigator rewrites a response
+class MitigationMode:
+    DOCUMENT = 'document' # regenerate the whole response
+    SENTENCE = 'sentence' # rewrite only the flagged sentences and splice them back into the response
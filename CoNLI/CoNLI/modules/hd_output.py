@@ -0,0 +1,71 @@
+# writers of the hallucination detection outputs: hallucinations/allhallucinations.jsonl and intermediate/HallucinationFinal.tsv
+
+import json
+import os
+from typing import Dict, List
+
+from CoNLI.modules.hd_constants import AllHallucinations, FieldName
+
+def get_optional_field(hallucination, field_name, default_value = ''):
+    if field_name in hallucination:
+        return str(hallucination[field_name])
+    else:
+        return default_value
+
+def get_required_field(hallucination, field_name):
+    return str(hallucination[field_name])
+
+def save_hallucinations(hallucinations, output_folder : str):
+    hallucination_finalresults = os.path.join(output_folder, 'HallucinationFinal.tsv')
+    
+    # Sort all of the hallucinations by data and sentence id
+    # hallucinations contextual order before passing to requester
+    hallucinations = sorted(
+            hallucinations,
+            key=lambda d: (
+                d[FieldName.DATA_ID],
+                d[FieldName.SENTENCE_ID],
+                d[FieldName.DETECTION_TYPE],
+                d[FieldName.SENTENCE_TEXT]
+            )
+        )
+    
+    with open(hallucination_finalresults, 'w', encoding='utf-8') as outFinal:
+        outFinal.write('data_id\tsentenceid\tdetectiontype\tspan\treason\tname\ttype\n')
+    
+        required_field_names = [
+                        FieldName.DATA_ID,
+                        FieldName.SENTENCE_ID,
+                        FieldName.DETECTION_TYPE,
+                        FieldName.SENTENCE_TEXT,
+                        FieldName.REASON
+                        ]
+        optional_field_names = [
+                        FieldName.NAME,
+                        FieldName.TYPE
+                        ]
+        for h in hallucinations:
+            field_values = [get_required_field(h, fn) for fn in required_field_names] + [get_optional_field(h, fn) for fn in optional_field_names]
+            outFinal.write('\t'.join(field_values) + '\n')
+
+# the allhallucinations.jsonl record of a data
+def to_output_record(data_id : str, num_sentences : int, hallucinations : List[Dict], timed_out : bool = False) -> Dict:
+    num_hallucinations = len(hallucinations)
+    return {
+        AllHallucinations.DATA_ID: data_id,
+        AllHallucinations.HALLUCINATED: num_hallucinations > 0,
+        AllHallucinations.HALLUCINATION_SCORE: num_hallucinations / num_sentences if num_sentences > 0 else 0.0,
+        AllHallucinations.HALLUCINATIONS: hallucinations,
+        AllHallucinations.NUM_TOTAL_SENTENCES: num_sentences,
+        AllHallucinations.NUM_TOTAL_HALLUCINATIONS: num_hallucinations,
+        AllHallucinations.TIMED_OUT: timed_out,
+    }
+
+# one line per data, sorted by data id
+def save_all_hallucinations_jsonl(retval_jsonl : List[Dict], output_folder : str) -> str:
+    retval_jsonl = sorted(retval_jsonl, key=lambda d: (d[AllHallucinations.DATA_ID]))
+    outputFilePath = os.path.join(output_folder, 'allhallucinations.jsonl')
+    with open(outputFilePath, 'w') as hallucinationOutputF:
+        for kvp in retval_jsonl:
+            hallucinationOutputF.write(json.dumps(kvp) + '\n')
+    return outputFilePath
@@ -0,0 +1,62 @@
+# run-wide in-flight dedup table for hallucination detection requests
+
+import hashlib
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Tuple
+
+
+# the owner of a key got no usable verdict (failed call or unparseable output), waiters check the hypothesis themselves
+class UnverifiedHypothesis(Exception):
+    pass
+
+
+class HypothesisMemo:
+    """
+    Maps (source hash, hypothesis) to a future holding the GPT verdict for that pair.
+    The first caller to claim a key owns it and must resolve the future; every later
+    caller (another sentence id, another summary of the same source, another detection
+    type) waits on the same future instead of sending the hypothesis to GPT again.
+    The resolved value is the list of hallucination reasons, one per flagged generation,
+    so an empty list means the hypothesis was judged as not hallucinated.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._table : Dict[Tuple[str, str], Future] = {}
+        self.n_hits = 0
+        self.n_misses = 0
+
+    @staticmethod
+    def source_key(source : str) -> str:
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    # returns (is_owner, future). The owner is responsible for resolving the future.
+    def claim(self, key : Tuple[str, str]) -> Tuple[bool, Future]:
+        with self._lock:
+            future = self._table.get(key)
+            if future is not None:
+                self.n_hits += 1
+                return False, future
+            future = Future()
+            self._table[key] = future
+            self.n_misses += 1
+            return True, future
+
+    # drop a key whose owner failed, so that a later caller can retry it
+    def forget(self, key : Tuple[str, str]) -> None:
+        with self._lock:
+            self._table.pop(key, None)
+
+    @staticmethod
+    def resolve(future : Future, reasons : List[str]) -> None:
+        if not future.done():
+            future.set_result(reasons)
+
+    def fail(self, key : Tuple[str, str], future : Future, exc : BaseException) -> None:
+        self.forget(key)
+        if not future.done():
+            future.set_exception(exc)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._table)
@@ -0,0 +1,90 @@
+# coalesces the GPT work of concurrent callers that check hypotheses against the same source
+
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, List, Tuple
+
+from CoNLI.modules.utils.deadline import Deadline
+from CoNLI.modules.utils import tracing
+
+# verify(source, items, perf_counters, deadline, n_callers) -> (verdicts, timed_out_items, unverified_items), see
+# HallucinationDetector._verify_items. n_callers is the number of callers whose items are verified together
+VerifyFn = Callable[[str, List[Dict], dict, Deadline, int], Tuple[list, list, list]]
+
+
+class _Group:
+    def __init__(self) -> None:
+        self.items : List[Dict] = []
+        self.deadlines : List[Deadline] = []
+        self.n_members = 0
+        self.full = threading.Event()
+        self.future = Future()
+
+
+class MicroBatcher:
+    """
+    The first caller for a source opens a group and waits up to window seconds (or until the group holds
+    max_items) for other callers with the same source to add their items, then sends all of them to GPT
+    in shared payloads and hands every caller the verdicts of its own items. A service receiving one
+    response per request thus fills its prompts with the hypotheses of several requests, instead of
+    paying one call per request for a partly filled batch.
+    """
+    def __init__(self, verify : VerifyFn, window : float, max_items : int) -> None:
+        self._verify = verify
+        self._window = window
+        self._max_items = max(max_items, 1)
+        self._lock = threading.Lock()
+        self._open : Dict[str, _Group] = {}
+        self.stats = {'n_groups': 0, 'n_shared_groups': 0, 'n_items': 0}
+
+    # the latest of the members' deadlines, so that no member loses work because of another one's deadline
+    @staticmethod
+    def _group_deadline(deadlines : List[Deadline]) -> Deadline:
+        if any(d is None for d in deadlines):
+            return None
+        return max(deadlines, key=lambda d: d.remaining() if d.remaining() is not None else float('inf'))
+
+    def submit(self, source_key : str, source : str, items : List[Dict], perf_counters : dict, deadline : Deadline = None) -> Tuple[list, list, list]:
+        if len(items) == 0:
+            return [], [], []
+        with self._lock:
+            group = self._open.get(source_key)
+            is_leader = group is None
+            if is_leader:
+                group = self._open[source_key] = _Group()
+            group.items += items
+            group.deadlines.append(deadline)
+            group.n_members += 1
+            if len(group.items) >= self._max_items:
+                # closed to new members, the leader sends it right away
+                del self._open[source_key]
+                group.full.set()
+
+        if is_leader:
+            with tracing.span('micro_batch_wait'):
+                group.full.wait(deadline.clamp(self._window) if deadline is not None else self._window)
+            with self._lock:
+                if self._open.get(source_key) is group:
+                    del self._open[source_key]
+                self.stats['n_groups'] += 1
+                self.stats['n_shared_groups'] += int(group.n_members > 1)
+                self.stats['n_items'] += len(group.items)
+            try:
+                with tracing.span('micro_batch', n_members=group.n_members, n_items=len(group.items)):
+                    group.future.set_result(self._verify(source, group.items, perf_counters, MicroBatcher._group_deadline(group.deadlines), group.n_members))
+            except BaseException as exc:
+                group.future.set_exception(exc)
+                raise
+        try:
+            verdicts, timed_out_items, unverified_items = group.future.result(timeout=deadline.remaining() if deadline is not None else None)
+        except FutureTimeoutError:
+            deadline.mark_timed_out()
+            return [], list(items), []
+
+        own = set(id(item) for item in items)
+        verdicts = [(item, reasons) for item, reasons in verdicts if id(item) in own]
+        timed_out_items = [item for item in timed_out_items if id(item) in own]
+        unverified_items = [item for item in unverified_items if id(item) in own]
+        if len(timed_out_items) > 0 and deadline is not None:
+            deadline.mark_timed_out()
+        return verdicts, timed_out_items, unverified_items
@@ -0,0 +1,73 @@
+# record of the mitigation outputs already written, so that an interrupted or incremental mitigation run only
+# rewrites the data that are missing or whose inputs changed
+
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List
+
+from CoNLI.modules.hallucination_mitigator import HdResult
+
+MANIFEST_FILE = 'mitigation_manifest.jsonl'
+
+
+# stable hash of everything a rewrite depends on: source, response, the flagged sentences with their
+# instructions and the mitigation mode
+def mitigation_input_hash(source : str, raw_response : str, hd_result : List[HdResult], mode : str) -> str:
+    key = json.dumps([
+        source,
+        raw_response,
+        [[h.hallucinated_sentence, h.instruction, h.detection_type] for h in hd_result],
+        mode])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+# writes text to path through a temporary file, so that a crash never leaves a partial output behind
+def write_output_atomic(path : str, text : str) -> None:
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as outF:
+        outF.write(text)
+    os.replace(tmp_path, path)
+
+
+class MitigationManifest:
+    """
+    Append-only jsonl of {"data_id", "input_hash", "output"} lines, one per output written, flushed as it
+    is written. The last line of a data id wins. A data is done if its output file exists and was written
+    from inputs with the same hash.
+    """
+    def __init__(self, output_folder : str, resume : bool) -> None:
+        self._output_folder = output_folder
+        self._path = os.path.join(output_folder, MANIFEST_FILE)
+        self._done : Dict[str, str] = {}
+        ends_with_newline = True
+        if resume and os.path.exists(self._path):
+            with open(self._path) as f:
+                for line in f:
+                    ends_with_newline = line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue # the last line of a crashed run may be partial
+                    self._done[entry['data_id']] = entry['input_hash']
+        self._lock = threading.Lock()
+        self._file = open(self._path, 'a' if resume else 'w')
+        if not ends_with_newline:
+            self._file.write('\n')
+
+    def output_path(self, data_id : str) -> str:
+        return os.path.join(self._output_folder, f'{data_id}.txt')
+
+    def is_done(self, data_id : str, input_hash : str) -> bool:
+        return self._done.get(data_id) == input_hash and os.path.exists(self.output_path(data_id))
+
+    def write(self, data_id : str, input_hash : str, refined_response : str) -> None:
+        write_output_atomic(self.output_path(data_id), refined_response)
+        with self._lock:
+            self._done[data_id] = input_hash
+            self._file.write(json.dumps({'data_id': data_id, 'input_hash': input_hash, 'output': f'{data_id}.txt'}) + '\n')
+            self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
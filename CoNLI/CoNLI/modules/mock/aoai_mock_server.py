@@ -0,0 +1,167 @@
+# local stand-in for the Azure OpenAI (chat) completions endpoints used by AOAIUtil.
+# Answers are deterministic and follow the formats parsed by gpt_output_utils.parse_gpt_batch
+# (hallucination detection), HallucinationMitigator.postprocess_rewrite_result (mitigation) and
+# HallucinationMitigator.parse_sentence_rewrites (sentence-local mitigation) and
+# HallucinationMitigator.split_packed_rewrites (packed mitigation).
+
+import random
+import re
+import time
+from typing import Dict, List, Tuple
+
+from CoNLI.modules.mock.mock_server_base import MockEndpointConfig, MockEndpointState, MockServer, count_tokens
+
+STOP_WORDS = frozenset([
+    'a', 'an', 'the', 'and', 'or', 'but', 'of', 'to', 'in', 'on', 'at', 'for', 'by', 'with', 'from',
+    'as', 'is', 'are', 'was', 'were', 'be', 'been', 'has', 'have', 'had', 'it', 'its', 'this', 'that',
+    'he', 'she', 'they', 'his', 'her', 'their', 'will', 'would', 'not', 'said', 'after', 'before'])
+
+
+def _content_words(text : str) -> List[str]:
+    return [w for w in re.findall(r'\w+', text.lower()) if w not in STOP_WORDS]
+
+
+# deterministic stand-in for the NLI judgement: a hypothesis is entailed if (the tagged entity, or)
+# most of its content words appear in the premise
+def judge_hypothesis(premise : str, hypothesis : str) -> Tuple[bool, str]:
+    premise_words = set(_content_words(premise))
+    tagged = re.findall(r'\[\s*(.*?)\s*\]', hypothesis)
+    words = _content_words(' '.join(tagged)) if tagged else _content_words(hypothesis)
+    if len(words) == 0:
+        return True, 'premise reference: None. The hypothesis has no content words to verify. It\'s entailment.'
+    missing = [w for w in words if w not in premise_words]
+    if tagged:
+        supported = len(missing) == 0
+    else:
+        supported = len(missing) <= 0.2 * len(words)
+    if supported:
+        return True, f'premise reference: the premise mentions {", ".join(words[:5])}. It\'s entailment.'
+    return False, f'premise reference: None. The premise does not mention {", ".join(missing[:5])}. It\'s neutral.'
+
+
+def _section(text : str, start_marker : str, end_marker : str) -> str:
+    start = text.rfind(start_marker)
+    if start < 0:
+        return ''
+    start += len(start_marker)
+    end = text.find(end_marker, start) if end_marker else -1
+    return text[start:end if end >= 0 else len(text)].strip()
+
+
+def answer_detection(prompt : str) -> str:
+    premise = _section(prompt, 'Premise:\n', '\nHypothesis:')
+    hypotheses = _section(prompt, 'Hypothesis:\n', 'Begin your answer')
+    lines = []
+    for no, hypothesis in re.findall(r'^\((\d+)\)\.\s?(.*)$', hypotheses, flags=re.MULTILINE):
+        entailed, reason = judge_hypothesis(premise, hypothesis)
+        lines.append(f'({no}). {hypothesis} <reason> {reason} </reason> {"[C]" if entailed else "[I]"}')
+    return 'Answer:\n' + '\n'.join(lines)
+
+
+def answer_mitigation(prompt : str) -> str:
+    # drop the sentences the instructions ask to rewrite, keep the rest of the claim unchanged
+    claim = _section(prompt, '\nCLAIM:\n', 'End CLAIM.')
+    flagged = re.findall(r'Rrwrite sentence in raw_response: (.*)', prompt)
+    for sentence in flagged:
+        claim = claim.replace(sentence.strip(), '')
+    return 'Answer:\n' + ' '.join(claim.split())
+
+
+def answer_sentence_mitigation(prompt : str) -> str:
+    # drop the words of each sentence whose content words the document does not mention, or the whole
+    # sentence if nothing of it is left. The rewrite is then judged entailed by answer_detection
+    document_words = set(_content_words(_section(prompt, '\nDOCUMENT:\n', 'End DOCUMENT.')))
+    sentences = _section(prompt, '\nSENTENCES:\n', 'End SENTENCES.')
+    lines = []
+    for no, sentence in re.findall(r'^\((\d+)\)\. Sentence: (.*)$', sentences, flags=re.MULTILINE):
+        kept = ' '.join(w for w in sentence.split() if all(cw in document_words for cw in _content_words(w)))
+        if len(_content_words(kept)) == 0:
+            lines.append(f'({no}). [DELETE]')
+        else:
+            lines.append(f'({no}). {kept.rstrip(".!?")}{sentence[-1] if sentence[-1] in ".!?" else ""}')
+    return 'Answer:\n' + '\n'.join(lines)
+
+
+def answer_packed_mitigation(prompt : str) -> str:
+    # every numbered section is answered as a mitigation prompt of its own
+    sections = re.findall(r'^=== Document (\d+) ===\n(.*?)^=== End of document \1 ===', prompt, flags=re.MULTILINE | re.DOTALL)
+    answers = []
+    for no, section in sections:
+        claim = answer_mitigation(section)[len('Answer:\n'):]
+        answers.append(f'=== Corrected CLAIM {no} ===\n{claim}\n=== End of CLAIM {no} ===')
+    return 'Answer:\n' + '\n'.join(answers)
+
+
+def answer_prompt(prompt : str) -> str:
+    if 'Hypothesis:' in prompt and 'Premise:' in prompt:
+        return answer_detection(prompt)
+    if '\n=== Document 0 ===\n' in prompt:
+        return answer_packed_mitigation(prompt)
+    if '\nSENTENCES:\n' in prompt:
+        return answer_sentence_mitigation(prompt)
+    if '\nCLAIM:\n' in prompt:
+        return answer_mitigation(prompt)
+    return 'Answer:\n'
+
+
+def malform(answer : str, rng : random.Random) -> str:
+    # either drop the "Answer:\n" prefix (AOAIUtil resends) or truncate the last item (parse error)
+    if rng.random() < 0.5 or '\n' not in answer.strip():
+        return answer.replace('Answer:\n', '', 1)
+    return answer[:answer.rfind('\n')]
+
+
+class AoaiMockRoutes:
+    def __init__(self, state : MockEndpointState) -> None:
+        self._state = state
+
+    @staticmethod
+    def _prompt_text(path : str, request : Dict) -> str:
+        if 'messages' in request:
+            return '\n'.join(m.get('content', '') for m in request['messages'])
+        prompt = request.get('prompt', '')
+        return '\n'.join(prompt) if isinstance(prompt, list) else prompt
+
+    def __call__(self, path : str, request : Dict, rng : random.Random):
+        route = path.split('?')[0].rstrip('/')
+        is_chat = route.endswith('/chat/completions')
+        if not (is_chat or route.endswith('/completions')):
+            return 404, {'error': {'code': '404', 'message': f'Resource not found: {path}'}}, {}
+
+        prompt = AoaiMockRoutes._prompt_text(path, request)
+        answer = answer_prompt(prompt)
+        prompt_tokens = count_tokens(prompt)
+        completion_tokens = min(count_tokens(answer), int(request.get('max_tokens') or 1 << 30))
+        n = int(request.get('n') or 1)
+
+        retry_after = self._state.admit(rng, prompt_tokens + n * completion_tokens)
+        if retry_after is not None:
+            message = f'Requests to the Creates a completion for the chat message Operation have exceeded call rate limit of your current OpenAI S0 pricing tier. Please retry after {retry_after} seconds. Please go here: https://aka.ms/oai/quotaincrease if you would like to further increase the default rate limit.'
+            return 429, {'error': {'code': '429', 'message': message}}, {'Retry-After': str(retry_after)}
+        try:
+            time.sleep(self._state.sample_latency(rng, completion_tokens))
+            if self._state.is_malformed(rng):
+                answer = malform(answer, rng)
+        finally:
+            self._state.done()
+
+        if is_chat:
+            choices = [{'index': i, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': answer}} for i in range(n)]
+        else:
+            choices = [{'index': i, 'finish_reason': 'stop', 'text': answer, 'logprobs': None} for i in range(n)]
+        return 200, {
+            'id': f'mock-{rng.getrandbits(64):016x}',
+            'object': 'chat.completion' if is_chat else 'text_completion',
+            'created': int(time.time()),
+            'model': route.split('/deployments/')[1].split('/')[0] if '/deployments/' in route else request.get('model', 'mock'),
+            'choices': choices,
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': n * completion_tokens,
+                'total_tokens': prompt_tokens + n * completion_tokens},
+        }, {}
+
+
+def create_aoai_mock_server(config : MockEndpointConfig = MockEndpointConfig(), host : str = '127.0.0.1', port : int = 0) -> MockServer:
+    state = MockEndpointState(config)
+    return MockServer('aoai', state, AoaiMockRoutes(state), host=host, port=port)
@@ -0,0 +1,190 @@
+# shared pieces of the local stand-in servers for AOAI and Text Analytics:
+# configurable latency / throttling / token quota, deterministic randomness and JSON over HTTP
+
+import hashlib
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Tuple
+
+
+@dataclass
+class MockEndpointConfig:
+    """
+    Behaviour of a mock endpoint. All random decisions are drawn from a generator seeded by
+    (seed, request body, attempt number), so a given request sequence always sees the same
+    latencies, throttles and malformed outputs, while retries of the same request can succeed.
+    """
+    latency_median_ms: float = field(
+        default=200, metadata={"help": "Median of the log-normal latency of a call"}
+    )
+    latency_sigma: float = field(
+        default=0.5, metadata={"help": "Sigma of the log-normal latency (0 for constant latency)"}
+    )
+    latency_per_output_token_ms: float = field(
+        default=0, metadata={"help": "Extra latency per generated token"}
+    )
+    throttle_rate: float = field(
+        default=0, metadata={"help": "Probability that a call is rejected with 429"}
+    )
+    retry_after_seconds: int = field(
+        default=1, metadata={"help": "Retry-after value returned with random 429s"}
+    )
+    tokens_per_minute: int = field(
+        default=0, metadata={"help": "Token quota over a sliding minute, 0 for unlimited. Calls over quota get 429 with the matching retry-after"}
+    )
+    max_concurrency: int = field(
+        default=0, metadata={"help": "Calls above this many in flight get 429, 0 for unlimited"}
+    )
+    malformed_rate: float = field(
+        default=0, metadata={"help": "Probability that a successful call returns malformed output"}
+    )
+    seed: int = field(
+        default=1234, metadata={"help": "Seed of all random decisions"}
+    )
+
+
+def count_tokens(text : str) -> int:
+    # cheap, deterministic stand-in for the model tokenizer
+    return len(re.findall(r'\w+|[^\w\s]', text))
+
+
+class MockEndpointState:
+    def __init__(self, config : MockEndpointConfig) -> None:
+        self.config = config
+        self._lock = threading.Lock()
+        self._attempts : Dict[str, int] = {}
+        self._token_window : deque = deque()
+        self._tokens_in_window = 0
+        self._in_flight = 0
+        self.stats = {'n_requests': 0, 'n_throttled': 0, 'n_malformed': 0, 'n_tokens': 0}
+
+    # a generator deterministic in (seed, body, attempt)
+    def rng_for(self, body : bytes) -> random.Random:
+        digest = hashlib.sha256(body).hexdigest()
+        with self._lock:
+            attempt = self._attempts.get(digest, 0)
+            self._attempts[digest] = attempt + 1
+            self.stats['n_requests'] += 1
+        return random.Random(f'{self.config.seed}-{digest}-{attempt}')
+
+    def sample_latency(self, rng : random.Random, output_tokens : int = 0) -> float:
+        cfg = self.config
+        latency_ms = cfg.latency_median_ms * math.exp(rng.gauss(0, cfg.latency_sigma)) if cfg.latency_sigma > 0 else cfg.latency_median_ms
+        return (latency_ms + cfg.latency_per_output_token_ms * output_tokens) / 1000.0
+
+    # returns the retry-after in seconds if the call must be throttled, None otherwise
+    def admit(self, rng : random.Random, tokens : int) -> Optional[int]:
+        cfg = self.config
+        if cfg.throttle_rate > 0 and rng.random() < cfg.throttle_rate:
+            with self._lock:
+                self.stats['n_throttled'] += 1
+            return cfg.retry_after_seconds
+        with self._lock:
+            if cfg.max_concurrency > 0 and self._in_flight >= cfg.max_concurrency:
+                self.stats['n_throttled'] += 1
+                return cfg.retry_after_seconds
+            if cfg.tokens_per_minute > 0:
+                now = time.monotonic()
+                while self._token_window and self._token_window[0][0] <= now - 60:
+                    self._tokens_in_window -= self._token_window.popleft()[1]
+                if self._tokens_in_window + tokens > cfg.tokens_per_minute and self._token_window:
+                    # wait until enough of the window has expired
+                    needed = self._tokens_in_window + tokens - cfg.tokens_per_minute
+                    freed = 0
+                    retry_after = 1
+                    for t, n in self._token_window:
+                        freed += n
+                        retry_after = max(int(math.ceil(t + 60 - now)), 1)
+                        if freed >= needed:
+                            break
+                    self.stats['n_throttled'] += 1
+                    return retry_after
+                self._token_window.append((now, tokens))
+                self._tokens_in_window += tokens
+            self._in_flight += 1
+            self.stats['n_tokens'] += tokens
+        return None
+
+    def done(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+    def is_malformed(self, rng : random.Random) -> bool:
+        if self.config.malformed_rate > 0 and rng.random() < self.config.malformed_rate:
+            with self._lock:
+                self.stats['n_malformed'] += 1
+            return True
+        return False
+
+
+# handler(path, body_json, rng) -> (status, response_json, extra_headers)
+RouteHandler = Callable[[str, Dict, random.Random], Tuple[int, Dict, Dict[str, str]]]
+
+
+def make_request_handler(name : str, state : MockEndpointState, route : RouteHandler):
+    class MockRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            logging.debug(f'[{name}] ' + format % args)
+
+        def _send_json(self, status : int, payload : Dict, headers : Dict[str, str] = None) -> None:
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip('/') in ('/health', '/healthz'):
+                self._send_json(200, {'status': 'ok', 'stats': dict(state.stats)})
+            else:
+                self._send_json(404, {'error': {'code': '404', 'message': f'Resource not found: {self.path}'}})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length) if length > 0 else b'{}'
+            try:
+                request = json.loads(body)
+            except json.JSONDecodeError:
+                self._send_json(400, {'error': {'code': '400', 'message': 'request body is not valid json'}})
+                return
+            status, payload, headers = route(self.path, request, state.rng_for(body))
+            self._send_json(status, payload, headers)
+
+    return MockRequestHandler
+
+
+class MockServer:
+    def __init__(self, name : str, state : MockEndpointState, route : RouteHandler, host : str = '127.0.0.1', port : int = 0) -> None:
+        self.name = name
+        self.state = state
+        self._httpd = ThreadingHTTPServer((host, port), make_request_handler(name, state, route))
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def start(self) -> 'MockServer':
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name=f'{self.name}-mock', daemon=True)
+        self._thread.start()
+        logging.info(f'{self.name} mock server listening on {self.url}')
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
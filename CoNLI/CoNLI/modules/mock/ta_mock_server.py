@@ -0,0 +1,88 @@
+# local stand-in for the Text Analytics / Language "recognize entities" endpoints used by GenTAEntityDetector.
+# Entities are found with deterministic regular expressions, so the same text always yields the same entities.
+
+import random
+import re
+import time
+from typing import Dict, List, Tuple
+
+from CoNLI.modules.mock.mock_server_base import MockEndpointConfig, MockEndpointState, MockServer
+
+MODEL_VERSION = '2023-04-15-mock'
+
+_MONTHS = 'january|february|march|april|may|june|july|august|september|october|november|december'
+_WEEKDAYS = 'monday|tuesday|wednesday|thursday|friday|saturday|sunday'
+_DURATION_UNITS = 'seconds?|minutes?|hours?|days?|weeks?|months?|years?|decades?'
+_PERSON_TYPES = 'president|minister|doctor|officer|spokesman|spokeswoman|chairman|manager|coach|player|police|teacher|senator|judge'
+
+# (category, subcategory, pattern), in priority order: earlier patterns win on overlaps.
+# If a pattern has a group, the entity is the group rather than the whole match.
+_ENTITY_PATTERNS : List[Tuple[str, str, re.Pattern]] = [
+    ('Quantity', 'Currency', re.compile(r'[$£€]\s?\d[\d,]*(?:\.\d+)?(?:\s(?:million|billion))?', re.IGNORECASE)),
+    ('DateTime', 'Duration', re.compile(rf'\b\d+(?:\.\d+)?\s(?:{_DURATION_UNITS})\b', re.IGNORECASE)),
+    ('DateTime', 'DateRange', re.compile(rf'\b(?:(?:{_MONTHS})(?:\s\d{{1,2}})?(?:,?\s\d{{4}})?|(?:{_WEEKDAYS})|(?:19|20)\d{{2}})\b', re.IGNORECASE)),
+    ('Quantity', 'Number', re.compile(r'\b\d[\d,]*(?:\.\d+)?\b')),
+    ('PersonType', None, re.compile(rf'\b(?:{_PERSON_TYPES})s?\b', re.IGNORECASE)),
+    ('Location', None, re.compile(r'\b(?:in|at|from|to|near) ([A-Z][a-z]+(?:\s[A-Z][a-z]+)*)')),
+    ('Person', None, re.compile(r'(?<=[a-z,] )[A-Z][a-z]+(?:\s[A-Z][a-z]+)+')),
+]
+
+
+def recognize_entities(text : str) -> List[Dict]:
+    entities, taken = [], []
+    for category, subcategory, pattern in _ENTITY_PATTERNS:
+        for m in pattern.finditer(text):
+            group = 1 if pattern.groups > 0 else 0
+            start, end = m.start(group), m.end(group)
+            if any(start < t_end and t_start < end for t_start, t_end in taken):
+                continue
+            taken.append((start, end))
+            entity = {'text': m.group(group), 'category': category, 'offset': start, 'length': end - start, 'confidenceScore': 0.9}
+            if subcategory:
+                entity['subcategory'] = subcategory
+            entities.append(entity)
+    return sorted(entities, key=lambda e: e['offset'])
+
+
+class TaMockRoutes:
+    """
+    Serves both the Text Analytics v3.x route (POST /text/analytics/v3.x/entities/recognition/general)
+    and the Language route used by newer SDKs (POST /language/:analyze-text, kind=EntityRecognition).
+    """
+    def __init__(self, state : MockEndpointState) -> None:
+        self._state = state
+
+    def __call__(self, path : str, request : Dict, rng : random.Random):
+        route = path.split('?')[0].rstrip('/')
+        if route.endswith('/entities/recognition/general'):
+            documents = request.get('documents', [])
+            wrap = lambda results: results
+        elif route.endswith('/language/:analyze-text') and request.get('kind') == 'EntityRecognition':
+            documents = request.get('analysisInput', {}).get('documents', [])
+            wrap = lambda results: {'kind': 'EntityRecognitionResults', 'results': results}
+        else:
+            return 404, {'error': {'code': '404', 'message': f'Resource not found: {path}'}}, {}
+
+        retry_after = self._state.admit(rng, len(documents))
+        if retry_after is not None:
+            message = f'Rate limit is exceeded. Try again in {retry_after} seconds.'
+            return 429, {'error': {'code': '429', 'message': message}}, {'Retry-After': str(retry_after)}
+        try:
+            time.sleep(self._state.sample_latency(rng))
+            malformed = self._state.is_malformed(rng)
+        finally:
+            self._state.done()
+
+        results, errors = [], []
+        for document in documents:
+            if malformed:
+                # a per-document error, which GenTAEntityDetector treats as a failed batch and retries
+                errors.append({'id': document['id'], 'error': {'code': 'InvalidArgument', 'message': 'Invalid document in request.', 'innererror': {'code': 'InvalidDocument', 'message': 'Document text is empty.'}}})
+                continue
+            results.append({'id': document['id'], 'entities': recognize_entities(document.get('text', '')), 'warnings': []})
+        return 200, wrap({'documents': results, 'errors': errors, 'modelVersion': MODEL_VERSION}), {}
+
+
+def create_ta_mock_server(config : MockEndpointConfig = MockEndpointConfig(), host : str = '127.0.0.1', port : int = 0) -> MockServer:
+    state = MockEndpointState(config)
+    return MockServer('ta', state, TaMockRoutes(state), host=host, port=port)
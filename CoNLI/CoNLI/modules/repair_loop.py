@@ -0,0 +1,130 @@
+# verify-and-repair: after a rewrite, only the sentences the rewrite changed are detected again, and the
+# ones still flagged are rewritten again, until they pass or a round or token budget runs out
+
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from CoNLI.modules.data.record_input import create_response_preprocess
+from CoNLI.modules.hallucination_detector import HallucinationDetector, count_tokens
+from CoNLI.modules.hallucination_mitigator import HallucinationMitigator, HdResult, to_hd_results
+from CoNLI.modules.hd_constants import FieldName
+from CoNLI.modules.utils.deadline import Deadline
+
+# why the loop of a data stopped
+class RepairStop:
+    VERIFIED = 'verified' # the last verification flagged nothing
+    UNCHANGED = 'unchanged' # the last rewrite changed no sentence, there is nothing new to verify
+    MAX_ROUNDS = 'max_rounds'
+    TOKEN_BUDGET = 'token_budget'
+    TIMED_OUT = 'timed_out'
+    FAILED = 'failed' # a GPT call of a rewrite failed, the last successful rewrite is kept
+
+@dataclass
+class RepairResult:
+    data_id: str
+    raw_response: str
+    refined_response: str
+    stop_reason: str
+    n_rounds: int = 0 # verification rounds run
+    n_verified_sentences: int = 0 # sentences detected again, over all rounds
+    n_repaired_sentences: int = 0 # sentences rewritten again, over all rounds
+    n_tokens: int = 0 # content tokens of the rewritten and verified sentences, source and prompt excluded
+    remaining_hallucinations: List[Dict] = field(default_factory=list) # flagged by the last verification and left as they are
+    failed: bool = False # the first rewrite failed, refined_response is not a rewrite
+
+    def to_record(self) -> Dict:
+        return {
+            'data_id': self.data_id,
+            'stop_reason': self.stop_reason,
+            'n_rounds': self.n_rounds,
+            'n_verified_sentences': self.n_verified_sentences,
+            'n_repaired_sentences': self.n_repaired_sentences,
+            'n_tokens': self.n_tokens,
+            'remaining_hallucinations': self.remaining_hallucinations,
+        }
+
+
+class VerifyRepairLoop:
+    """
+    Rewrites a data with the mitigator, then for up to max_rounds rounds splits the rewrite into sentences,
+    detects again only the sentences that are not in the previous version, and rewrites again the ones that are
+    still flagged. The GPT work of a round is proportional to what the previous rewrite changed. token_budget
+    (0 for none) bounds the content tokens of all the rewritten and verified sentences of a data.
+    """
+    def __init__(self,
+                 detector : HallucinationDetector,
+                 mitigator : HallucinationMitigator,
+                 max_rounds : int = 2,
+                 token_budget : int = 0) -> None:
+        self._detector = detector
+        self._mitigator = mitigator
+        self._max_rounds = max(max_rounds, 1)
+        self._token_budget = token_budget
+        self._preprocess = create_response_preprocess()
+
+    @staticmethod
+    def _normalize(text : str) -> str:
+        return ' '.join(text.split())
+
+    # the sentences of after that are not sentences of before, numbered by their position in after
+    def changed_sentences(self, before : str, after : str) -> List[Dict]:
+        before_sentences = set(VerifyRepairLoop._normalize(s[FieldName.SENTENCE_TEXT]) for s in self._preprocess.preprocess(before))
+        return [s for s in self._preprocess.preprocess(after) if VerifyRepairLoop._normalize(s[FieldName.SENTENCE_TEXT]) not in before_sentences]
+
+    def _over_budget(self, n_tokens : int) -> bool:
+        return self._token_budget > 0 and n_tokens > self._token_budget
+
+    def run(self, data_id : str, source : str, raw_response : str, hd_result : List[HdResult], deadline : Deadline = None) -> RepairResult:
+        result = RepairResult(data_id, raw_response, raw_response, RepairStop.VERIFIED)
+        if len(hd_result) == 0:
+            return result
+        previous = raw_response
+        rewrite = self._mitigator.mitigate_one(data_id, raw_response, source, hd_result)
+        if rewrite.failed:
+            result.stop_reason = RepairStop.FAILED
+            result.failed = True
+            return result
+        result.refined_response = rewrite.refined_response
+        result.n_tokens = sum(count_tokens(h.hallucinated_sentence) for h in hd_result)
+        while True:
+            if deadline is not None and deadline.expired():
+                result.stop_reason = RepairStop.TIMED_OUT
+                return result
+            changed = self.changed_sentences(previous, result.refined_response)
+            if len(changed) == 0:
+                result.stop_reason = RepairStop.UNCHANGED
+                return result
+            verify_tokens = sum(count_tokens(s[FieldName.SENTENCE_TEXT]) for s in changed)
+            if self._over_budget(result.n_tokens + verify_tokens):
+                result.stop_reason = RepairStop.TOKEN_BUDGET
+                return result
+            result.n_rounds += 1
+            result.n_verified_sentences += len(changed)
+            result.n_tokens += verify_tokens
+            hallucinations = self._detector.detect_hallucinations(data_id, source, changed, deadline=deadline)
+            result.remaining_hallucinations = hallucinations
+            # a verification cut short by the deadline may have dropped flagged sentences, it verifies nothing
+            if deadline is not None and deadline.timed_out:
+                result.stop_reason = RepairStop.TIMED_OUT
+                return result
+            if len(hallucinations) == 0:
+                result.stop_reason = RepairStop.VERIFIED
+                return result
+            if result.n_rounds >= self._max_rounds:
+                result.stop_reason = RepairStop.MAX_ROUNDS
+                return result
+            hd_result = to_hd_results(hallucinations)
+            repair_tokens = sum(count_tokens(h.hallucinated_sentence) for h in hd_result)
+            if self._over_budget(result.n_tokens + repair_tokens):
+                result.stop_reason = RepairStop.TOKEN_BUDGET
+                return result
+            logging.info(f'data_id: {data_id}, round {result.n_rounds}: {len(hallucinations)} of {len(changed)} rewritten sentences still flagged, rewriting them again')
+            rewrite = self._mitigator.mitigate_one(data_id, result.refined_response, source, hd_result)
+            if rewrite.failed:
+                result.stop_reason = RepairStop.FAILED
+                return result
+            previous = result.refined_response
+            result.refined_response = rewrite.refined_response
+            result.n_repaired_sentences += len(hd_result)
+            result.n_tokens += repair_tokens
@@ -0,0 +1,205 @@
+# resident HTTP/JSON hallucination detection service around a warm HallucinationDetector.
+#   POST /detect   {"source": ..., "response": ... | "sentences": [...], "data_id": optional, "timeout": optional}
+#   GET  /health   liveness, 200 as long as the process serves requests
+#   GET  /ready    readiness, 200 once warmed up and until draining starts, 503 otherwise
+#   GET  /metrics  Prometheus text format
+
+import itertools
+import json
+import logging
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+from CoNLI.modules.data.record_input import RecordError, create_response_preprocess, record_sentences
+from CoNLI.modules.hallucination_detector import HallucinationDetector
+from CoNLI.modules.hd_constants import FieldName
+from CoNLI.modules.hd_output import to_output_record
+from CoNLI.modules.utils.deadline import Deadline
+from CoNLI.modules.utils.metrics import MetricsRegistry
+from CoNLI.modules.utils import tracing
+
+WARM_UP_TEXT = 'The patient was admitted on Monday. He was discharged two days later.'
+
+
+class RequestError(Exception):
+    def __init__(self, status : int, message : str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class DetectionService:
+    """
+    Owns the detector (tokenizer, sentence splitter and GPT/TA clients stay loaded between requests),
+    admits up to max_inflight concurrent requests and answers each with the record an offline run writes
+    to allhallucinations.jsonl. The hypotheses of concurrent requests for the same source are coalesced
+    by the detector's micro-batcher.
+    """
+    def __init__(self,
+                 detector : HallucinationDetector,
+                 metrics : MetricsRegistry,
+                 request_timeout : float = 0,
+                 max_inflight : int = 64) -> None:
+        self._detector = detector
+        self._metrics = metrics
+        self._request_timeout = request_timeout
+        self._slots = threading.BoundedSemaphore(max(max_inflight, 1))
+        self._ids = itertools.count(1)
+        self._preprocess = create_response_preprocess()
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self._requests = metrics.counter('service_requests_total', 'Detection requests, by http status')
+        self._latency = metrics.histogram('service_request_seconds', 'End-to-end latency of detection requests, by http status')
+        metrics.gauge('service_in_flight_requests', 'Detection requests being processed').set_function(lambda: self.in_flight)
+        metrics.gauge('service_ready', '1 while the service accepts requests').set_function(lambda: int(self._ready.is_set()))
+
+    # loads the sentence splitter and the prompt tokenizer before the first request is admitted
+    def warm_up(self) -> None:
+        t0 = time.monotonic()
+        sentences = self._preprocess.preprocess(WARM_UP_TEXT)
+        self._detector._sentence_splitter.split_into_sentences(WARM_UP_TEXT)
+        self._detector.create_payload(
+            items=[{'Hypothesis': s[FieldName.SENTENCE_TEXT], 'SentenceId': s[FieldName.SENTENCE_ID]} for s in sentences],
+            src=WARM_UP_TEXT,
+            promptUtil=self._detector._prompt_util)
+        logging.info(f'Service warmed up in {time.monotonic() - t0:.2f} seconds')
+        self._ready.set()
+
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    # stop admitting requests (readiness turns 503), the in-flight ones complete
+    def drain(self) -> None:
+        self._ready.clear()
+
+    def wait_idle(self, timeout : float = None) -> bool:
+        end = time.monotonic() + timeout if timeout is not None else None
+        while self.in_flight > 0:
+            if end is not None and time.monotonic() >= end:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _parse_request(self, request : Dict) -> Tuple[str, str, List[Dict], float]:
+        try:
+            sentences = record_sentences(request, self._preprocess)
+        except RecordError as e:
+            raise RequestError(400, str(e))
+        data_id = str(request.get('data_id') or f'request-{next(self._ids)}')
+        try:
+            timeout = float(request.get('timeout') or self._request_timeout)
+        except (TypeError, ValueError):
+            raise RequestError(400, f"timeout must be a number of seconds, got {request.get('timeout')!r}")
+        if not math.isfinite(timeout) or timeout < 0:
+            raise RequestError(400, f"timeout must be a finite, non-negative number of seconds, got {request.get('timeout')!r}")
+        return data_id, request['source'], sentences, timeout
+
+    def detect(self, request : Dict) -> Dict:
+        data_id, source, sentences, timeout = self._parse_request(request)
+        deadline = Deadline(timeout)
+        with tracing.span('document', data_id=data_id, n_sentences=len(sentences)):
+            hallucinations = self._detector.detect_hallucinations(data_id, source, sentences, deadline=deadline)
+        return to_output_record(data_id, len(sentences), hallucinations, deadline.timed_out)
+
+    # returns (http status, response json)
+    def handle(self, request : Dict) -> Tuple[int, Dict]:
+        start = time.monotonic()
+        if not self._ready.is_set():
+            status, payload = 503, {'error': 'service is not ready'}
+        elif not self._slots.acquire(blocking=False):
+            status, payload = 429, {'error': 'too many requests in flight'}
+        else:
+            with self._lock:
+                self.in_flight += 1
+            try:
+                status, payload = 200, self.detect(request)
+            except RequestError as e:
+                status, payload = e.status, {'error': str(e)}
+            except Exception as e:
+                logging.exception('Detection request failed')
+                status, payload = 500, {'error': f'{type(e).__name__}: {e}'}
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                self._slots.release()
+        self._requests.inc(status=status)
+        self._latency.observe(time.monotonic() - start, status=status)
+        return status, payload
+
+
+def make_request_handler(service : DetectionService):
+    class DetectionRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            logging.debug('[detection-service] ' + format % args)
+
+        def _send(self, status : int, body : bytes, content_type : str, headers : Dict[str, str] = None) -> None:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, status : int, payload : Dict) -> None:
+            headers = {'Retry-After': '1'} if status in (429, 503) else None
+            self._send(status, json.dumps(payload).encode('utf-8'), 'application/json', headers)
+
+        def do_GET(self):
+            path = self.path.rstrip('/')
+            if path in ('/health', '/healthz'):
+                self._send_json(200, {'status': 'ok'})
+            elif path in ('/ready', '/readyz'):
+                ready = service.ready()
+                self._send_json(200 if ready else 503, {'status': 'ready' if ready else 'not ready', 'in_flight': service.in_flight})
+            elif path == '/metrics':
+                self._send(200, service._metrics.to_prometheus().encode('utf-8'), 'text/plain; version=0.0.4')
+            else:
+                self._send_json(404, {'error': f'Resource not found: {self.path}'})
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/detect':
+                self._send_json(404, {'error': f'Resource not found: {self.path}'})
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length) if length > 0 else b'{}'
+            try:
+                request = json.loads(body)
+            except json.JSONDecodeError:
+                self._send_json(400, {'error': 'request body is not valid json'})
+                return
+            self._send_json(*service.handle(request))
+
+    return DetectionRequestHandler
+
+
+class DetectionServer:
+    def __init__(self, service : DetectionService, host : str = '127.0.0.1', port : int = 8080) -> None:
+        self.service = service
+        self._httpd = ThreadingHTTPServer((host, port), make_request_handler(service))
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def start(self) -> 'DetectionServer':
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='detection-service', daemon=True)
+        self._thread.start()
+        logging.info(f'Detection service listening on {self.url}')
+        return self
+
+    # readiness turns 503 first, in-flight requests get up to drain_timeout seconds to complete
+    def stop(self, drain_timeout : float = 30) -> None:
+        self.service.drain()
+        if not self.service.wait_idle(drain_timeout):
+            logging.warning(f'{self.service.in_flight} requests still in flight after {drain_timeout} seconds, stopping anyway')
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,79 @@
+# content-hash interning of source documents and of the artifacts derived from them
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict
+
+from CoNLI.modules.hypothesis_memo import HypothesisMemo
+
+
+class _SourceEntry:
+    def __init__(self, text : str, key : str) -> None:
+        self.text = text
+        self.key = key
+        self.artifacts : Dict[str, object] = {}
+
+
+class SourceStore:
+    """
+    One entry per distinct source content, holding its hash key and the artifacts computed from it
+    (token count, prompt with the source filled in, ...), so that data ids sharing a source (several
+    summaries of one article, responses grounded on the same reference document) compute them once.
+    A source object seen before is found by identity without rehashing it, so callers intern() the source
+    once per document and pass the interned object on. At most max_sources entries are kept, least
+    recently used first out, so a long-running service stays bounded.
+    """
+    def __init__(self, max_sources : int = 10000) -> None:
+        self._max_sources = max(max_sources, 1)
+        self._lock = threading.Lock()
+        self._by_key : 'OrderedDict[str, _SourceEntry]' = OrderedDict()
+        self._by_id : Dict[int, _SourceEntry] = {}
+        self.stats = {'n_lookups': 0, 'n_hashed': 0, 'n_artifacts_computed': 0, 'n_artifacts_reused': 0}
+
+    def _entry(self, source : str) -> _SourceEntry:
+        with self._lock:
+            self.stats['n_lookups'] += 1
+            entry = self._by_id.get(id(source))
+            if entry is not None and entry.text is source:
+                self._by_key.move_to_end(entry.key)
+                return entry
+        # hashed outside the lock, sources can be long
+        key = HypothesisMemo.source_key(source)
+        with self._lock:
+            self.stats['n_hashed'] += 1
+            entry = self._by_key.get(key)
+            if entry is None:
+                entry = self._by_key[key] = _SourceEntry(source, key)
+                self._by_id[id(source)] = entry
+                while len(self._by_key) > self._max_sources:
+                    _, evicted = self._by_key.popitem(last=False)
+                    self._by_id.pop(id(evicted.text), None)
+            self._by_key.move_to_end(key)
+            return entry
+
+    # the first seen str object with the content of source. Later lookups of that object skip the hashing,
+    # and the caller's copy can be freed
+    def intern(self, source : str) -> str:
+        return self._entry(source).text
+
+    def key(self, source : str) -> str:
+        return self._entry(source).key
+
+    # the artifact name of the source, computed by compute(source) on first use. Concurrent first uses
+    # may both compute it, the artifacts are pure functions of the source.
+    def artifact(self, source : str, name : str, compute : Callable[[str], object]):
+        entry = self._entry(source)
+        if name in entry.artifacts:
+            with self._lock:
+                self.stats['n_artifacts_reused'] += 1
+            return entry.artifacts[name]
+        value = compute(entry.text)
+        with self._lock:
+            self.stats['n_artifacts_computed'] += 1
+            entry.artifacts.setdefault(name, value)
+        return entry.artifacts[name]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._by_key)
+
@@ -1,27 +1,51 @@
 import datetime
 import json
 import re
-from azure.identity import AzureCliCredential, ManagedIdentityCredential
 import logging
 import os
-import openai
 import time
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Callable, Dict, List
 
 from CoNLI.modules.utils.gpt_output_utils import certified_gpt_output_prefix
+from CoNLI.modules.utils.deadline import Deadline, DeadlineExceeded
+from CoNLI.modules.utils.concurrency import AdaptiveConcurrencyLimiter, CallOutcome, optional_slot
+from CoNLI.modules.utils.cassette import Cassette, CassetteMiss
+from CoNLI.modules.utils import tracing
+
+# observer(kind, latency_seconds, outcome, usage): called after every http attempt, where kind is
+# 'completion' or 'chat_completion', outcome a CallOutcome and usage the token usage of the response (or None)
+CallObserver = Callable[[str, float, str, Dict], None]
 
 class AOAIUtil:
 
     def __init__(
             self,
             config_setting: str = "gpt-4-32k",
-            config_file: str = (Path(__file__).absolute()).parent.parent/"configs"/"aoai_config.json") -> None:
+            config_file: str = (Path(__file__).absolute()).parent.parent/"configs"/"aoai_config.json",
+            request_timeout: float = None,
+            max_retry_wait: float = 60,
+            concurrency_limiter: AdaptiveConcurrencyLimiter = None,
+            call_observers: List[CallObserver] = None,
+            cassette: Cassette = None) -> None:
         self.auth_token = None
+        # optional record / replay of every GPT call
+        self.cassette = cassette
+        self.call_observers = list(call_observers) if call_observers else []
+        # optional AIMD limit on in-flight calls, shared by every thread using this instance
+        self.concurrency_limiter = concurrency_limiter
+        # per-call HTTP timeout in seconds (None keeps the openai default)
+        self.request_timeout = request_timeout
+        # upper bound on a single back-off sleep, whatever the retry-after in the error says
+        self.max_retry_wait = max_retry_wait
         self.default_credential = None
         self.config_setting = config_setting
         with open(config_file, "r") as config_file:
             config = json.load(config_file)
         self.default_engine = str(config[config_setting]["DEFAULT_ENGINE"])
+        # openai is imported by the first AOAIUtil, not by importing this module
+        import openai
         openai.api_type = str(config[config_setting]["API_TYPE"])
         openai.api_base = str(config[config_setting]["OPENAI_API_BASE"])
         openai.api_version = str(config[config_setting]["OPENAI_API_VERSION"])
@@ -37,6 +61,67 @@ class AOAIUtil:
         else:
             return self.default_engine
 
+    # returns False if the deadline expired during (or before) the back-off
+    def _backoff(self, seconds: float, deadline: Deadline = None) -> bool:
+        seconds = min(seconds, self.max_retry_wait) if self.max_retry_wait else seconds
+        # a replayed 429 or error came from the cassette, not from the service, so there is nothing to wait for
+        if self.cassette is not None and self.cassette.replaying:
+            return deadline is None or not deadline.expired()
+        with tracing.span('backoff', seconds=seconds):
+            if deadline is None:
+                time.sleep(seconds)
+                return True
+            return deadline.sleep(seconds)
+
+    def _check_deadline(self, deadline: Deadline = None) -> bool:
+        if deadline is not None and deadline.expired():
+            logging.warning('Deadline expired or request cancelled, aborting GPT request')
+            deadline.mark_timed_out()
+            return False
+        return True
+
+    @staticmethod
+    def _abort_on_deadline(deadline: Deadline) -> None:
+        logging.warning('Deadline expired or request cancelled while waiting to retry GPT request')
+        deadline.mark_timed_out()
+        return None
+
+    def _request_timeout(self, deadline: Deadline = None) -> float:
+        return deadline.clamp(self.request_timeout) if deadline is not None else self.request_timeout
+
+    # one http attempt: holds a concurrency slot and reports latency, outcome and usage to the observers
+    @contextmanager
+    def _track_call(self, kind: str, deadline: Deadline = None):
+        with tracing.span('gpt_attempt', kind=kind) as attempt_span:
+            wait_start = time.monotonic()
+            with optional_slot(self.concurrency_limiter, deadline):
+                call = {'usage': None}
+                start = time.monotonic()
+                attempt_span.set(slot_wait_seconds=start - wait_start)
+                try:
+                    yield call
+                except Exception as e:
+                    outcome = CallOutcome.from_error(e)
+                    attempt_span.set(outcome=outcome, retry_reason=str(e)[:200])
+                    self._notify_observers(kind, time.monotonic() - start, outcome, call['usage'])
+                    raise
+                else:
+                    attempt_span.set(outcome=CallOutcome.SUCCESS, **(call['usage'] or {}))
+                    self._notify_observers(kind, time.monotonic() - start, CallOutcome.SUCCESS, call['usage'])
+
+    def _notify_observers(self, kind: str, latency: float, outcome: str, usage: Dict) -> None:
+        for observer in self.call_observers:
+            try:
+                observer(kind, latency, outcome, usage)
+            except Exception as e:
+                logging.warning(f'GPT call observer failed: {e}')
+
+    # calls openai, or records / replays the call when a cassette is set
+    def _create(self, kind: str, create_fn, request_timeout: float = None, **request):
+        if self.cassette is None:
+            return create_fn(request_timeout=request_timeout, **request)
+        return self.cassette.call(kind, request, lambda: create_fn(request_timeout=request_timeout, **request))
+
     def get_completion(
             self,
             prompt: str,
@@ -49,33 +134,56 @@ class AOAIUtil:
             logprobs: int = None,
             stop: list() = ["<|im_end|>"],
             generations: int = 1,
-            should_retry: bool = True):
+            should_retry: bool = True,
+            max_retry_count: int = 10,
+            deadline: Deadline = None):
+        import openai
+        retry_count = 0
         while True:
+            if retry_count > max_retry_count:
+                logging.error(f"Max retry count exceeded, aborting")
+                return None
+            if not self._check_deadline(deadline):
+                return None
             try:
-                response = openai.Completion.create(
-                    engine=self.get_engine(engine),
-                    prompt=prompt,
-                    temperature=temperature,
-                    top_p=top_p,
-                    max_tokens=max_tokens,
-                    frequency_penalty=frequency_penalty,
-                    presence_penalty=presence_penalty,
-                    logprobs=logprobs,
-                    stop=stop,
-                    n=generations)
-                if not certified_gpt_output_prefix(response['choices'][0]['text']):
-                    raise Exception('GPT undesired output due to rpm limit reached, resending current request')
+                with self._track_call('completion', deadline) as call:
+                    response = self._create(
+                        'completion',
+                        openai.Completion.create,
+                        engine=self.get_engine(engine),
+                        prompt=prompt,
+                        temperature=temperature,
+                        top_p=top_p,
+                        max_tokens=max_tokens,
+                        frequency_penalty=frequency_penalty,
+                        presence_penalty=presence_penalty,
+                        logprobs=logprobs,
+                        stop=stop,
+                        n=generations,
+                        request_timeout=self._request_timeout(deadline))
+                    call['usage'] = response.get('usage')
+                    if not certified_gpt_output_prefix(response['choices'][0]['text']):
+                        raise Exception('GPT undesired output due to rpm limit reached, resending current request')
                 break
+            except DeadlineExceeded:
+                return self._abort_on_deadline(deadline)
+            except CassetteMiss as e:
+                logging.error(f'Unrecoverable error - {e}')
+                return None
             except Exception as e:
                 errStr = str(e).lower()
                 if should_retry and (
                         "rate limit" in errStr or "server is currently overloaded" in errStr or "server is overloaded" in errStr):
                     logging.info("Retrying after rate limit error")
-                    time.sleep(5)
+                    retry_count += 1
+                    if not self._backoff(5, deadline):
+                        return self._abort_on_deadline(deadline)
                     continue
-                elif should_retry and ("no healthy upstream" in errStr or "error communicating with openai" in errStr):
+                elif should_retry and ("no healthy upstream" in errStr or "error communicating with openai" in errStr or "timed out" in errStr):
                     logging.info(f'Unexpected, retryable error: {errStr}')
-                    time.sleep(5)
+                    retry_count += 1
+                    if not self._backoff(5, deadline):
+                        return self._abort_on_deadline(deadline)
                     continue
                 else:
                     logging.error(f'Unexpected, unrecoverable error: {errStr}')
@@ -93,46 +201,59 @@ class AOAIUtil:
             presence_penalty: float = 0,
             generations: int = 1,
             stop: list() = ["<|im_end|>"],
-            max_retry_count: int = 10):
-
+            max_retry_count: int = 10,
+            deadline: Deadline = None):
+        import openai
         retry_count = 0
         while True:
             if retry_count > max_retry_count:
                 logging.error(f"Max retry count exceeded, aborting")
                 return None
+            if not self._check_deadline(deadline):
+                return None
             try:
-                response = openai.ChatCompletion.create(
-                    engine=self.get_engine(engine),
-                    messages=messages,
-                    temperature=temperature,
-                    top_p=top_p,
-                    max_tokens=max_tokens,
-                    frequency_penalty=frequency_penalty,
-                    presence_penalty=presence_penalty,
-                    stop=stop,
-                    n=generations)
-                raw_output = response['choices'][0]['message']['content']
-                if not certified_gpt_output_prefix(raw_output):
-                    raise Exception(f'GPT undesired output due to rpm limit reached, resending current request. \n<GPT_OUTPUT>\n{raw_output}\n</GPT_OUTPUT>')
+                with self._track_call('chat_completion', deadline) as call:
+                    response = self._create(
+                        'chat_completion',
+                        openai.ChatCompletion.create,
+                        engine=self.get_engine(engine),
+                        messages=messages,
+                        temperature=temperature,
+                        top_p=top_p,
+                        max_tokens=max_tokens,
+                        frequency_penalty=frequency_penalty,
+                        presence_penalty=presence_penalty,
+                        stop=stop,
+                        n=generations,
+                        request_timeout=self._request_timeout(deadline))
+                    call['usage'] = response.get('usage')
+                    raw_output = response['choices'][0]['message']['content']
+                    if not certified_gpt_output_prefix(raw_output):
+                        raise Exception(f'GPT undesired output due to rpm limit reached, resending current request. \n<GPT_OUTPUT>\n{raw_output}\n</GPT_OUTPUT>')
                 break
+            except DeadlineExceeded:
+                return self._abort_on_deadline(deadline)
+            except CassetteMiss as e:
+                logging.error(f'Unrecoverable error - {e}')
+                return None
             except Exception as e:
-                already_slept = False
                 errStr = str(e).lower()
                 if 'rate limit' in errStr or 'overloaded with other requests' in errStr:
                     logging.warning(f"Retrying after rate limit error, retry count: {retry_count}")
                     retry_count += 1
+                    wait_seconds = 5
                     for w in errStr.split(' '):
                         if w.isdigit():
-                            time.sleep(int(w))
-                            already_slept = True
+                            wait_seconds = int(w)
                             break
-                    if not already_slept:
-                        time.sleep(5)
+                    if not self._backoff(wait_seconds, deadline):
+                        return self._abort_on_deadline(deadline)
                     continue
                 elif 'unauthorized' in errStr:
                     logging.error(f'Unauthorized error seen: {errStr}')
-                    time.sleep(5)
                     retry_count += 1
+                    if not self._backoff(5, deadline):
+                        return self._abort_on_deadline(deadline)
                     continue
                 # This error means that content filtering is on, it is not a
                 # recoverable error
@@ -147,8 +268,9 @@ class AOAIUtil:
                     return None
                 else:
                     logging.error(f'Unexpected, retryable error: {errStr}. retry count: {retry_count}')
-                    time.sleep(5)
                     retry_count += 1
+                    if not self._backoff(5, deadline):
+                        return self._abort_on_deadline(deadline)
                     continue
         return response
 
@@ -0,0 +1,135 @@
+# record / replay of GPT and Text Analytics traffic.
+# In record mode every call is appended (request hash, response or error, latency) to a gzip jsonl cassette.
+# In replay mode calls are served from the cassette, with the recorded latency scaled by latency_scale,
+# so a run can be reproduced offline and python-side overhead profiled without network time.
+
+import atexit
+import gzip
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Callable, Dict
+
+from CoNLI.modules.utils.concurrency import CallOutcome
+
+
+class CassetteMiss(Exception):
+    pass
+
+
+# a recorded error, with the http status and exception type name of the original so that it is classified
+# (CallOutcome.from_error) the same way on replay
+class RecordedError(Exception):
+    def __init__(self, message : str, http_status : int = None, error_type : str = None) -> None:
+        super().__init__(message)
+        self.http_status = http_status
+        self.error_type = error_type
+
+
+class Cassette:
+    OFF = 'off'
+    RECORD = 'record'
+    REPLAY = 'replay'
+
+    def __init__(self, path : str, mode : str, latency_scale : float = 1.0) -> None:
+        if mode not in (Cassette.RECORD, Cassette.REPLAY):
+            raise ValueError(f'Unknown cassette mode: {mode}')
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self._lock = threading.Lock()
+        self.stats = {'n_recorded': 0, 'n_replayed': 0, 'n_misses': 0}
+        self._file = None
+        # (kind, key) -> recorded entries not replayed yet, in recording order
+        self._entries : Dict[tuple, deque] = defaultdict(deque)
+        # (kind, key) -> last replayed successful entry, served again once the recorded ones are used up
+        self._last : Dict[tuple, Dict] = {}
+        if mode == Cassette.RECORD:
+            self._file = gzip.open(path, 'wt', encoding='utf-8')
+            atexit.register(self.close)
+        else:
+            self._load()
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == Cassette.RECORD
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == Cassette.REPLAY
+
+    @staticmethod
+    def request_key(kind : str, request : Dict) -> str:
+        canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(f'{kind}\n{canonical}'.encode('utf-8')).hexdigest()
+
+    def _load(self) -> None:
+        n = 0
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self._entries[(entry['kind'], entry['key'])].append(entry)
+                n += 1
+        logging.info(f'Loaded {n} recorded calls from cassette {self.path}')
+
+    def record(self, kind : str, request : Dict, response : Any = None, error : BaseException = None, latency : float = 0.0) -> None:
+        entry = {'kind': kind, 'key': Cassette.request_key(kind, request), 'latency': round(latency, 4), 'response': response, 'error': None}
+        if error is not None:
+            entry.update(error=str(error), error_status=CallOutcome.http_status(error), error_type=type(error).__name__)
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line)
+            self.stats['n_recorded'] += 1
+
+    def replay(self, kind : str, request : Dict) -> Any:
+        slot = (kind, Cassette.request_key(kind, request))
+        with self._lock:
+            if self._entries[slot]:
+                entry = self._entries[slot].popleft()
+                if entry['error'] is None:
+                    self._last[slot] = entry
+            elif slot in self._last:
+                entry = self._last[slot]
+            else:
+                self.stats['n_misses'] += 1
+                raise CassetteMiss(f'No recorded {kind} call for request {slot[1][:12]} in cassette {self.path}')
+            self.stats['n_replayed'] += 1
+        if self.latency_scale > 0:
+            time.sleep(entry['latency'] * self.latency_scale)
+        if entry['error'] is not None:
+            raise RecordedError(entry['error'], entry.get('error_status'), entry.get('error_type'))
+        return entry['response']
+
+    # replays fn() or records its (encoded) response or error together with its latency
+    def call(self, kind : str, request : Dict, fn : Callable[[], Any], encode : Callable[[Any], Any] = None, decode : Callable[[Any], Any] = None) -> Any:
+        if self.replaying:
+            response = self.replay(kind, request)
+            return decode(response) if decode else response
+        start = time.monotonic()
+        try:
+            response = fn()
+        except Exception as e:
+            self.record(kind, request, error=e, latency=time.monotonic() - start)
+            raise
+        self.record(kind, request, response=encode(response) if encode else response, latency=time.monotonic() - start)
+        return response
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                logging.info(f"Recorded {self.stats['n_recorded']} calls to cassette {self.path}")
+
+
+def create_cassette(path : str, mode : str, latency_scale : float = 1.0) -> Cassette:
+    if not path or mode == Cassette.OFF:
+        return None
+    return Cassette(path, mode, latency_scale)
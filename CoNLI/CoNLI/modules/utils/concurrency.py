@@ -0,0 +1,167 @@
+# adaptive (AIMD) concurrency limit for calls to throttled endpoints (GPT, Text Analytics)
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from CoNLI.modules.utils.deadline import Deadline, DeadlineExceeded
+
+
+class CallOutcome:
+    SUCCESS = 'success'
+    THROTTLED = 'throttled'
+    TIMEOUT = 'timeout'
+    ERROR = 'error'
+
+    # 503 is how openai reports an overloaded deployment, which should cut the limit like a 429
+    THROTTLED_STATUSES = (429, 503)
+    TIMEOUT_STATUSES = (408, 504)
+    # exception class names (openai, azure-core, requests and the builtins), matched against the whole mro
+    THROTTLED_ERRORS = ('RateLimitError', 'ServiceUnavailableError')
+    TIMEOUT_ERRORS = ('Timeout', 'TimeoutError', 'APITimeoutError', 'ServiceRequestTimeoutError', 'ServiceResponseTimeoutError')
+
+    # http status of an openai (http_status) or azure-core (status_code) error, None if it has none
+    @staticmethod
+    def http_status(error : BaseException) -> Optional[int]:
+        for status in (getattr(error, 'http_status', None), getattr(error, 'status_code', None)):
+            if isinstance(status, int):
+                return status
+        return None
+
+    # classified from the http status or the exception type only, never from the message text
+    @staticmethod
+    def from_error(error : BaseException) -> str:
+        status = CallOutcome.http_status(error)
+        if status in CallOutcome.THROTTLED_STATUSES:
+            return CallOutcome.THROTTLED
+        if status in CallOutcome.TIMEOUT_STATUSES:
+            return CallOutcome.TIMEOUT
+        # a replayed error carries the type name of the recorded one
+        names = set(cls.__name__ for cls in type(error).__mro__) | set([getattr(error, 'error_type', None)])
+        if names.intersection(CallOutcome.THROTTLED_ERRORS):
+            return CallOutcome.THROTTLED
+        if names.intersection(CallOutcome.TIMEOUT_ERRORS):
+            return CallOutcome.TIMEOUT
+        return CallOutcome.ERROR
+
+
+class _Slot:
+    def __init__(self, epoch : int) -> None:
+        self.epoch = epoch
+        self.start = time.monotonic()
+        self.outcome = None
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Caps the number of in-flight calls to an endpoint with an AIMD limit, shared by all worker threads.
+    The limit grows additively (by `increase` per `limit` healthy calls, i.e. about +1 per round trip)
+    while calls succeed with healthy latency, and is cut multiplicatively on throttles or timeouts.
+    A call is healthy if its latency stays under latency_tolerance x the smoothed latency of past
+    successful calls. Only throttles of calls started after the last cut trigger another cut, so a
+    single burst of 429s halves the limit once instead of once per in-flight call.
+    """
+    def __init__(self,
+                 name : str,
+                 initial_limit : float = 2,
+                 min_limit : float = 1,
+                 max_limit : float = 64,
+                 increase : float = 1.0,
+                 decrease_factor : float = 0.5,
+                 latency_tolerance : float = 2.0,
+                 ) -> None:
+        if not 0 < decrease_factor < 1:
+            raise ValueError(f'decrease_factor must be in (0, 1), got {decrease_factor}')
+        self.name = name
+        self._min_limit = max(min_limit, 1)
+        self._max_limit = max(max_limit, self._min_limit)
+        self._limit = min(max(initial_limit, self._min_limit), self._max_limit)
+        self._increase = increase
+        self._decrease_factor = decrease_factor
+        self._latency_tolerance = latency_tolerance
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._epoch = 0
+        self._latency_ewma = None
+        self.peak_in_flight = 0
+        self.counts = {CallOutcome.SUCCESS: 0, CallOutcome.THROTTLED: 0, CallOutcome.TIMEOUT: 0, CallOutcome.ERROR: 0}
+        self.history : List[Tuple[float, float]] = [(time.time(), self._limit)]
+
+    @property
+    def current_limit(self) -> float:
+        return self._limit
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def acquire(self, deadline : Deadline = None) -> _Slot:
+        with self._cond:
+            while self._in_flight >= int(self._limit):
+                timeout = None
+                if deadline is not None:
+                    if deadline.expired():
+                        raise DeadlineExceeded(f'deadline expired while waiting for a {self.name} concurrency slot')
+                    timeout = min(deadline.remaining() or Deadline._POLL_INTERVAL, Deadline._POLL_INTERVAL)
+                self._cond.wait(timeout)
+            self._in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self._in_flight)
+            return _Slot(self._epoch)
+
+    def release(self, slot : _Slot, outcome : str) -> None:
+        latency = time.monotonic() - slot.start
+        with self._cond:
+            self._in_flight -= 1
+            self.counts[outcome] += 1
+            if outcome == CallOutcome.SUCCESS:
+                healthy = self._latency_ewma is None or latency <= self._latency_tolerance * self._latency_ewma
+                self._latency_ewma = latency if self._latency_ewma is None else 0.8 * self._latency_ewma + 0.2 * latency
+                if healthy and self._limit < self._max_limit:
+                    self._set_limit(min(self._limit + self._increase / self._limit, self._max_limit))
+            elif outcome in (CallOutcome.THROTTLED, CallOutcome.TIMEOUT) and slot.epoch == self._epoch:
+                self._epoch += 1
+                self._set_limit(max(self._limit * self._decrease_factor, self._min_limit))
+                logging.info(f'[{self.name}] {outcome}, concurrency limit cut to {int(self._limit)}')
+            self._cond.notify_all()
+
+    def _set_limit(self, limit : float) -> None:
+        if int(limit) != int(self._limit):
+            self.history.append((time.time(), limit))
+        self._limit = limit
+
+    # with limiter.slot(deadline) as slot: ... ; exceptions are classified with CallOutcome.from_error
+    @contextmanager
+    def slot(self, deadline : Deadline = None):
+        slot = self.acquire(deadline)
+        try:
+            yield slot
+        except BaseException as e:
+            self.release(slot, slot.outcome or CallOutcome.from_error(e))
+            raise
+        else:
+            self.release(slot, slot.outcome or CallOutcome.SUCCESS)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                'name': self.name,
+                'current_limit': int(self._limit),
+                'min_limit': self._min_limit,
+                'max_limit': self._max_limit,
+                'in_flight': self._in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'latency_ewma': self._latency_ewma,
+                'counts': dict(self.counts),
+                'limit_history': [(round(t, 3), int(limit)) for t, limit in self.history],
+            }
+
+
+@contextmanager
+def optional_slot(limiter : Optional[AdaptiveConcurrencyLimiter], deadline : Deadline = None):
+    if limiter is None:
+        yield None
+    else:
+        with limiter.slot(deadline) as slot:
+            yield slot
@@ -0,0 +1,81 @@
+# deadlines and cancellation shared by the run, each data and each GPT request
+
+import threading
+import time
+from typing import Optional
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """
+    A point in time after which work should be abandoned, plus a cancellation flag.
+    Deadlines form a tree (run -> data): a child expires when its own timeout passes or
+    when any ancestor expires or is cancelled, so cancelling the run deadline from the
+    CLI stops every in-flight data and request.
+    timed_out is set when some work was actually dropped because of this deadline, and is
+    used to mark partial results.
+    """
+    _POLL_INTERVAL = 0.25
+
+    def __init__(self, timeout : Optional[float] = None, parent : 'Deadline' = None) -> None:
+        self._expires_at = time.monotonic() + timeout if timeout is not None and timeout > 0 else None
+        self._parent = parent
+        self._cancelled = threading.Event()
+        self.timed_out = False
+
+    def child(self, timeout : Optional[float] = None) -> 'Deadline':
+        return Deadline(timeout, parent=self)
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set() or (self._parent is not None and self._parent.cancelled())
+
+    # seconds left before expiry, None if unbounded
+    def remaining(self) -> Optional[float]:
+        remaining = None
+        if self._expires_at is not None:
+            remaining = max(self._expires_at - time.monotonic(), 0.0)
+        if self._parent is not None:
+            parent_remaining = self._parent.remaining()
+            if parent_remaining is not None:
+                remaining = parent_remaining if remaining is None else min(remaining, parent_remaining)
+        return remaining
+
+    def expired(self) -> bool:
+        if self.cancelled():
+            return True
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    # clamp a per-call timeout to what is left of the deadline
+    def clamp(self, timeout : Optional[float]) -> Optional[float]:
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+    # sleep for the given seconds unless the deadline expires first. Returns False if it expired.
+    def sleep(self, seconds : float) -> bool:
+        end = time.monotonic() + seconds
+        while True:
+            if self.expired():
+                return False
+            left = end - time.monotonic()
+            if left <= 0:
+                return True
+            wait = min(left, Deadline._POLL_INTERVAL)
+            remaining = self.remaining()
+            if remaining is not None:
+                wait = min(wait, remaining)
+            self._cancelled.wait(wait)
+
+    def mark_timed_out(self) -> None:
+        deadline = self
+        while deadline is not None:
+            deadline.timed_out = True
+            deadline = deadline._parent
@@ -36,6 +36,7 @@ def parse_gpt_batch(gpt_out: str, n_item: int):
             parse_successful = False
 
         item_result['Response_Sentence'] = q_out
+        item_result['ParseSuccessful'] = parse_successful
 
         if parse_successful:
             if q_out.lower().__contains__('<reason>') and q_out.lower().__contains__('</reason>'):
@@ -1,9 +1,9 @@
 
-from azure.keyvault.secrets import SecretClient
-from azure.identity import ManagedIdentityCredential, DefaultAzureCredential
 import os
 
 def load_secret_from_keyvault(keyvault_url : str, secret_name : str, managed_identity_client_env_var : str = None):
+    from azure.keyvault.secrets import SecretClient
+    from azure.identity import ManagedIdentityCredential, DefaultAzureCredential
     try:
         credential = DefaultAzureCredential()
         secret_client = SecretClient(
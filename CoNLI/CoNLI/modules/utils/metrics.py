@@ -0,0 +1,271 @@
+# in-process metrics (counters, gauges, latency histograms) with Prometheus textfile and JSON export
+
+import bisect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+DEFAULT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels : Dict) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key : LabelKey, extra : Dict = None) -> str:
+    pairs = list(key) + sorted((extra or {}).items())
+    if len(pairs) == 0:
+        return ''
+    escaped = [f'{k}="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for k, v in pairs]
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(v : float) -> str:
+    if v == math.inf:
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name : str, help : str, lock : threading.Lock) -> None:
+        self.name = name
+        self.help = help
+        self._lock = lock
+        self._values : Dict[LabelKey, object] = {}
+
+    def samples(self) -> List[Tuple[str, LabelKey, Dict, float]]:
+        raise NotImplementedError
+
+    def summary(self) -> list:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, value : float = 1, **labels) -> None:
+        if value < 0:
+            raise ValueError(f'counter {self.name} can only increase')
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self):
+        return [(self.name, key, None, v) for key, v in self._values.items()]
+
+    def summary(self):
+        return [{'labels': dict(key), 'value': v} for key, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name : str, help : str, lock : threading.Lock) -> None:
+        super().__init__(name, help, lock)
+        self._callbacks : Dict[LabelKey, Callable[[], float]] = {}
+
+    def set(self, value : float, **labels) -> None:
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    # the value is read from fn() at export time
+    def set_function(self, fn : Callable[[], float], **labels) -> None:
+        with self._lock:
+            self._callbacks[_label_key(labels)] = fn
+
+    def _current(self) -> Dict[LabelKey, float]:
+        values = dict(self._values)
+        for key, fn in self._callbacks.items():
+            try:
+                values[key] = fn()
+            except Exception as e:
+                logging.warning(f'Failed to read gauge {self.name}: {e}')
+        return values
+
+    def samples(self):
+        return [(self.name, key, None, v) for key, v in self._current().items()]
+
+    def summary(self):
+        return [{'labels': dict(key), 'value': v} for key, v in self._current().items()]
+
+
+class _HistogramValue:
+    def __init__(self, n_buckets : int) -> None:
+        self.bucket_counts = [0] * (n_buckets + 1) # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name : str, help : str, lock : threading.Lock, buckets : Tuple[float, ...] = DEFAULT_LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, lock)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value : float, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            h = self._values.get(key)
+            if h is None:
+                h = self._values[key] = _HistogramValue(len(self.buckets))
+            h.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+            h.count += 1
+            h.sum += value
+
+    def samples(self):
+        samples = []
+        for key, h in self._values.items():
+            cumulative = 0
+            for le, n in zip(self.buckets + (math.inf,), h.bucket_counts):
+                cumulative += n
+                samples.append((f'{self.name}_bucket', key, {'le': _format_value(le)}, cumulative))
+            samples.append((f'{self.name}_sum', key, None, h.sum))
+            samples.append((f'{self.name}_count', key, None, h.count))
+        return samples
+
+    # quantile estimated by linear interpolation inside the bucket, as promql histogram_quantile does
+    def _quantile(self, h : _HistogramValue, q : float) -> float:
+        if h.count == 0:
+            return None
+        rank = q * h.count
+        cumulative = 0
+        for i, n in enumerate(h.bucket_counts):
+            if cumulative + n >= rank and n > 0:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / n
+            cumulative += n
+        return self.buckets[-1]
+
+    def summary(self):
+        return [{
+            'labels': dict(key),
+            'count': h.count,
+            'sum': h.sum,
+            'mean': h.sum / h.count if h.count else None,
+            'p50': self._quantile(h, 0.5),
+            'p95': self._quantile(h, 0.95),
+            'p99': self._quantile(h, 0.99),
+        } for key, h in self._values.items()]
+
+
+class MetricsRegistry:
+    """
+    Thread-safe registry of labelled counters, gauges and histograms. Metrics are created on first use
+    and exported in the Prometheus text format (e.g. for the node_exporter textfile collector) or as a
+    JSON summary with histogram quantiles.
+    """
+    def __init__(self, namespace : str = 'conli', const_labels : Dict[str, str] = None) -> None:
+        self.namespace = namespace
+        self.const_labels = dict(const_labels or {})
+        self._lock = threading.Lock()
+        self._metrics : Dict[str, _Metric] = {}
+        self.start_time = time.time()
+
+    def _get(self, cls, name : str, help : str, **kwargs) -> _Metric:
+        full_name = f'{self.namespace}_{name}' if self.namespace else name
+        with self._lock:
+            metric = self._metrics.get(full_name)
+            if metric is None:
+                metric = self._metrics[full_name] = cls(full_name, help, threading.Lock(), **kwargs)
+        if not isinstance(metric, cls):
+            raise ValueError(f'metric {full_name} is already registered as a {metric.kind}')
+        return metric
+
+    def counter(self, name : str, help : str = '') -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name : str, help : str = '') -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name : str, help : str = '', buckets : Tuple[float, ...] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        for metric in metrics:
+            with metric._lock:
+                samples = metric.samples()
+            if len(samples) == 0:
+                continue
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, key, extra, value in sorted(samples, key=lambda s: (s[1], s[0])):
+                labels = dict(self.const_labels, **(extra or {}))
+                lines.append(f'{name}{_format_labels(key, labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self) -> Dict:
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        summary = {'labels': self.const_labels, 'start_time': self.start_time, 'elapsed_seconds': time.time() - self.start_time, 'metrics': {}}
+        for metric in metrics:
+            with metric._lock:
+                summary['metrics'][metric.name] = {'type': metric.kind, 'help': metric.help, 'values': metric.summary()}
+        return summary
+
+    # written to a temp file and renamed, so that a collector never reads a partial file
+    def write_prometheus_textfile(self, path : str) -> None:
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def write_json(self, path : str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f, indent=2)
+
+
+class PeriodicTextfileWriter:
+    """Rewrites the Prometheus textfile every interval seconds while a run is in progress."""
+    def __init__(self, registry : MetricsRegistry, path : str, interval : float = 15) -> None:
+        self._registry = registry
+        self._path = path
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-textfile', daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            try:
+                self._registry.write_prometheus_textfile(self._path)
+            except Exception as e:
+                logging.warning(f'Failed to write metrics textfile {self._path}: {e}')
+
+    def start(self) -> 'PeriodicTextfileWriter':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self._registry.write_prometheus_textfile(self._path)
+
+
+# CallObserver (see AOAIUtil) feeding per-endpoint call counts, latencies and token usage into the registry
+def endpoint_call_observer(registry : MetricsRegistry, endpoint : str):
+    calls = registry.counter('endpoint_calls_total', 'Http calls to an endpoint, by call kind and outcome (success, throttled, timeout, error). Every non-success call is retried or aborted')
+    latency = registry.histogram('endpoint_call_seconds', 'Latency of http calls to an endpoint, by call kind and outcome')
+    tokens = registry.counter('endpoint_tokens_total', 'Tokens reported in the usage of endpoint responses, by direction (prompt, completion)')
+
+    def observe(kind : str, seconds : float, outcome : str, usage : Dict) -> None:
+        calls.inc(endpoint=endpoint, kind=kind, outcome=outcome)
+        latency.observe(seconds, endpoint=endpoint, kind=kind, outcome=outcome)
+        if usage:
+            for direction in ('prompt', 'completion'):
+                n = usage.get(f'{direction}_tokens', 0)
+                if n:
+                    tokens.inc(n, endpoint=endpoint, direction=direction)
+    return observe
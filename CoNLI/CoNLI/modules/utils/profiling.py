@@ -0,0 +1,290 @@
+# opt-in per-stage profiling (cProfile, a sampling profiler and tracemalloc) with one report per stage.
+# Stages are named code regions: with profiling.stage('parsing'): ... . With profiling off, stage()
+# returns a shared no-op object.
+
+import argparse
+import cProfile
+import io
+import linecache
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+CPROFILE = 'cprofile'
+SAMPLING = 'sampling'
+TRACEMALLOC = 'tracemalloc'
+PROFILE_MODES = (CPROFILE, SAMPLING, TRACEMALLOC)
+
+# stage names used by the pipelines
+DATA_LOADING = 'data_loading'
+ENTITY_DETECTION = 'entity_detection'
+PROMPT_CONSTRUCTION = 'prompt_construction'
+GPT_ROUND_TRIP = 'gpt_round_trip'
+PARSING = 'parsing'
+OUTPUT_WRITING = 'output_writing'
+EVALUATION = 'evaluation'
+
+_profiler = None
+
+
+class StageProfiler:
+    """
+    cProfile keeps one profile per (stage, thread), enabled only while the thread is inside the stage;
+    a nested stage pauses the outer one. The sampling profiler records the stack of every thread that is
+    inside a stage each interval, so time spent in worker threads and waiting on I/O is visible too.
+    tracemalloc diffs snapshots taken around the first max_snapshots runs of each stage.
+    """
+    def __init__(self, output_folder : str, modes : List[str], sampling_interval : float = 0.005, max_snapshots : int = 1) -> None:
+        unknown = set(modes) - set(PROFILE_MODES)
+        if unknown:
+            raise ValueError(f'Unknown profile modes: {unknown}, expected some of {PROFILE_MODES}')
+        self.output_folder = output_folder
+        self.modes = set(modes)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # thread id -> stack of stage names, read by the sampler
+        self._thread_stages : Dict[int, List[str]] = {}
+        self._profiles : Dict[tuple, cProfile.Profile] = {}
+        self._wall_time = defaultdict(float)
+        self._calls = Counter()
+        self._samples : Dict[str, Counter] = defaultdict(Counter)
+        self._sampling_interval = sampling_interval
+        self._sampler = None
+        self._stop = threading.Event()
+        self._max_snapshots = max_snapshots
+        self._snapshot_diffs : Dict[str, list] = defaultdict(list)
+        self._peak_memory : Dict[str, int] = {}
+        self._warned = False
+
+    def start(self) -> 'StageProfiler':
+        if TRACEMALLOC in self.modes:
+            tracemalloc.start(25)
+        if SAMPLING in self.modes:
+            self._sampler = threading.Thread(target=self._sample_loop, name='stage-sampler', daemon=True)
+            self._sampler.start()
+        return self
+
+    def _stack(self) -> List[str]:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+            with self._lock:
+                self._thread_stages[threading.get_ident()] = stack
+        return stack
+
+    def _profile_for(self, stage : str) -> cProfile.Profile:
+        key = (stage, threading.get_ident())
+        with self._lock:
+            profile = self._profiles.get(key)
+            if profile is None:
+                profile = self._profiles[key] = cProfile.Profile()
+        return profile
+
+    def _enable(self, profile : cProfile.Profile) -> None:
+        try:
+            profile.enable()
+        except ValueError as e:
+            # python >= 3.12 allows a single active cProfile per process, the other threads go unprofiled
+            if not self._warned:
+                self._warned = True
+                logging.warning(f'cProfile not enabled in some threads: {e}')
+
+    def enter(self, stage : str) -> tuple:
+        stack = self._stack()
+        if CPROFILE in self.modes and stack:
+            self._profile_for(stack[-1]).disable()
+        snapshot = None
+        if TRACEMALLOC in self.modes:
+            with self._lock:
+                take = self._calls[stage] < self._max_snapshots
+            if take:
+                snapshot = tracemalloc.take_snapshot()
+        with self._lock:
+            self._calls[stage] += 1
+        stack.append(stage)
+        # enabled last, so that the profile of the stage does not include the snapshot
+        if CPROFILE in self.modes:
+            self._enable(self._profile_for(stage))
+        return time.perf_counter(), snapshot
+
+    def exit(self, stage : str, token : tuple) -> None:
+        start, snapshot = token
+        stack = self._stack()
+        stack.pop()
+        if CPROFILE in self.modes:
+            self._profile_for(stage).disable()
+            if stack:
+                self._enable(self._profile_for(stack[-1]))
+        with self._lock:
+            self._wall_time[stage] += time.perf_counter() - start
+        if snapshot is not None:
+            diff = tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')
+            _, peak = tracemalloc.get_traced_memory()
+            with self._lock:
+                self._snapshot_diffs[stage].append(diff)
+                self._peak_memory[stage] = max(self._peak_memory.get(stage, 0), peak)
+
+    def _sample_loop(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self._sampling_interval):
+            frames = sys._current_frames()
+            with self._lock:
+                stages = {tid: stack[-1] for tid, stack in self._thread_stages.items() if stack}
+            for tid, stage in stages.items():
+                frame = frames.get(tid)
+                if frame is None or tid == own_id:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                self._samples[stage][';'.join(reversed(names))] += 1
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if TRACEMALLOC in self.modes:
+            tracemalloc.stop()
+
+    def write_reports(self) -> None:
+        os.makedirs(self.output_folder, exist_ok=True)
+        stages = sorted(self._calls)
+        summary = [f'{"stage":<24}{"calls":>10}{"wall_seconds":>16}']
+        for stage in stages:
+            summary.append(f'{stage:<24}{self._calls[stage]:>10}{self._wall_time[stage]:>16.3f}')
+        with open(os.path.join(self.output_folder, 'stages_summary.txt'), 'w') as f:
+            f.write('\n'.join(summary) + '\n')
+            f.write('\nwall_seconds adds up the time of every run of a stage, in all threads, including nested stages\n')
+
+        for stage in stages:
+            profiles = [p for (s, _), p in self._profiles.items() if s == stage]
+            if profiles:
+                self._write_cprofile_report(stage, profiles)
+            if stage in self._samples:
+                self._write_sampling_report(stage, self._samples[stage])
+            if stage in self._snapshot_diffs:
+                self._write_tracemalloc_report(stage, self._snapshot_diffs[stage])
+        logging.info(f'Profile reports written to {self.output_folder}')
+
+    def _write_cprofile_report(self, stage : str, profiles : List[cProfile.Profile]) -> None:
+        stats = None
+        for profile in profiles:
+            try:
+                stats = pstats.Stats(profile) if stats is None else stats.add(profile)
+            except TypeError:
+                # a profile that was never enabled has no stats
+                continue
+        if stats is None:
+            return
+        stats.dump_stats(os.path.join(self.output_folder, f'{stage}.pstats'))
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats('cumulative').print_stats(60)
+        stats.sort_stats('tottime').print_stats(30)
+        with open(os.path.join(self.output_folder, f'{stage}.cprofile.txt'), 'w') as f:
+            f.write(out.getvalue())
+
+    def _write_sampling_report(self, stage : str, samples : Counter) -> None:
+        # folded stacks, for flamegraph.pl or speedscope
+        with open(os.path.join(self.output_folder, f'{stage}.folded'), 'w') as f:
+            for stack, n in samples.most_common():
+                f.write(f'{stack} {n}\n')
+        total = sum(samples.values())
+        self_counts, inclusive_counts = Counter(), Counter()
+        for stack, n in samples.items():
+            frames = stack.split(';')
+            self_counts[frames[-1]] += n
+            for name in set(frames):
+                inclusive_counts[name] += n
+        lines = [f'{total} samples every {self._sampling_interval * 1000:.1f}ms', '', 'self %   function']
+        lines += [f'{100.0 * n / total:6.2f}  {name}' for name, n in self_counts.most_common(40)]
+        lines += ['', 'inclusive %   function']
+        lines += [f'{100.0 * n / total:6.2f}  {name}' for name, n in inclusive_counts.most_common(40)]
+        with open(os.path.join(self.output_folder, f'{stage}.sampling.txt'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def _write_tracemalloc_report(self, stage : str, diffs : list) -> None:
+        lines = [f'peak traced memory during the stage: {self._peak_memory.get(stage, 0) / 2**20:.1f} MiB']
+        for i, diff in enumerate(diffs):
+            lines += ['', f'run #{i + 1}: top allocations (size diff)']
+            for stat in diff[:25]:
+                frame = stat.traceback[0]
+                lines.append(f'{stat.size_diff / 1024:10.1f} KiB {stat.count_diff:8d} blocks  {frame.filename}:{frame.lineno}  {linecache.getline(frame.filename, frame.lineno).strip()}')
+        with open(os.path.join(self.output_folder, f'{stage}.tracemalloc.txt'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+class _Stage:
+    def __init__(self, profiler : StageProfiler, name : str) -> None:
+        self._profiler = profiler
+        self._name = name
+        self._token = None
+
+    def __enter__(self) -> '_Stage':
+        self._token = self._profiler.enter(self._name)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self._profiler.exit(self._name, self._token)
+        return False
+
+
+class _NoopStage:
+    def __enter__(self) -> '_NoopStage':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+_NOOP_STAGE = _NoopStage()
+
+
+# with stage(PARSING): ...
+def stage(name : str):
+    if _profiler is None:
+        return _NOOP_STAGE
+    return _Stage(_profiler, name)
+
+
+def enable_profiling(output_folder : str, modes : List[str], sampling_interval : float = 0.005) -> StageProfiler:
+    global _profiler
+    _profiler = StageProfiler(output_folder, modes, sampling_interval).start()
+    return _profiler
+
+
+# stops the profilers and writes one report per stage
+def finish_profiling() -> None:
+    global _profiler
+    if _profiler is not None:
+        profiler, _profiler = _profiler, None
+        profiler.stop()
+        profiler.write_reports()
+
+
+def add_profile_arguments(parser : argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--profile',
+        default='',
+        help=f'Comma separated profilers to run around the pipeline stages: {",".join(PROFILE_MODES)}. Reports are written per stage to <output folder>/profile',
+        type=str)
+    parser.add_argument(
+        '--profile_interval_ms',
+        default=5,
+        help='Sampling interval of the sampling profiler',
+        type=float)
+
+
+def enable_profiling_from_args(args, output_folder : str) -> StageProfiler:
+    modes = [m.strip() for m in args.profile.split(',') if m.strip()]
+    if len(modes) == 0:
+        return None
+    return enable_profiling(os.path.join(output_folder, 'profile'), modes, args.profile_interval_ms / 1000.0)
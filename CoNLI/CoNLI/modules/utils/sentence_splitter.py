@@ -1,17 +1,37 @@
 # split a text string into sentences
 
-from nltk.tokenize import sent_tokenize
-import nltk
+import os
+import threading
 
-try:
-    nltk.download("punkt", quiet=True)
-except FileExistsError:  # multiprocessing race condition
-    pass
+PUNKT_RESOURCE = "tokenizers/punkt/english.pickle"
+
+_punkt = None
+_punkt_lock = threading.Lock()
+
+# the punkt sentence tokenizer, loaded once per process from the local nltk data. It is never downloaded
+# unless CONLI_NLTK_DOWNLOAD is set, otherwise a missing punkt fails with how to install it.
+def load_punkt():
+    global _punkt
+    with _punkt_lock:
+        if _punkt is None:
+            # nltk is imported on first use, importing this module stays cheap
+            import nltk
+            try:
+                _punkt = nltk.data.load(PUNKT_RESOURCE)
+            except LookupError:
+                if os.environ.get('CONLI_NLTK_DOWNLOAD', '').lower() not in ('1', 'true', 'yes'):
+                    raise LookupError(f'{PUNKT_RESOURCE} is not in the nltk data path ({nltk.data.path}). Install it with: python -m nltk.downloader punkt, or set CONLI_NLTK_DOWNLOAD=1 to download it on first use')
+                try:
+                    nltk.download("punkt", quiet=True)
+                except FileExistsError:  # multiprocessing race condition
+                    pass
+                _punkt = nltk.data.load(PUNKT_RESOURCE)
+    return _punkt
 
 class SentenceSplitter:
     def __init__(self):
         pass
 
-    # use NLTK to split a text string into sentences for now
+    # use NLTK to split a text string into sentences for now, same as nltk.sent_tokenize(text) in english
     def split_into_sentences(self, text):
-        return sent_tokenize(text)
+        return load_punkt().tokenize(text)
@@ -0,0 +1,113 @@
+# deterministic partitioning of data ids into shards, and merging of the per-shard detection outputs.
+# A shard writes the usual output layout to <output_folder>/shards/shard-<i>-of-<n>/ and a shard.json
+# marker once it has finished, so shards can run as local processes or on several nodes sharing a filesystem.
+# The marker of a previous run is removed when a shard starts, and a cancelled shard is marked incomplete.
+
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List
+
+from CoNLI.modules.hd_constants import AllHallucinations
+from CoNLI.modules.hd_output import save_all_hallucinations_jsonl, save_hallucinations
+
+SHARD_MARKER = 'shard.json'
+
+
+# stable across processes and machines, unlike hash()
+def shard_of(data_id : str, num_shards : int) -> int:
+    digest = hashlib.sha1(str(data_id).encode('utf-8')).hexdigest()
+    return int(digest[:16], 16) % num_shards
+
+
+def in_shard(data_id : str, num_shards : int, shard_index : int) -> bool:
+    return num_shards <= 1 or shard_of(data_id, num_shards) == shard_index
+
+
+def validate_shard(num_shards : int, shard_index : int) -> None:
+    if num_shards < 1:
+        raise ValueError(f'num_shards must be >= 1, got {num_shards}')
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f'shard_index must be in [0, {num_shards}), got {shard_index}')
+
+
+def shard_folder(output_folder : str, num_shards : int, shard_index : int) -> str:
+    return os.path.join(output_folder, 'shards', f'shard-{shard_index}-of-{num_shards}')
+
+
+# per-shard variant of a user given file path (trace, cassette, metrics textfile): name.shard-<i>-of-<n>.ext
+def shard_path(path : str, num_shards : int, shard_index : int) -> str:
+    if not path or num_shards <= 1:
+        return path
+    name, ext = os.path.splitext(path)
+    if ext == '.gz':
+        name, inner_ext = os.path.splitext(name)
+        ext = inner_ext + ext
+    return f'{name}.shard-{shard_index}-of-{num_shards}{ext}'
+
+
+# removes the marker of an earlier run of the shard, so that its outputs are not merged until this run finishes
+def clear_shard_marker(folder : str) -> None:
+    path = os.path.join(folder, SHARD_MARKER)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def write_shard_marker(folder : str, num_shards : int, shard_index : int, data_ids : List[str], n_timed_out : int = 0, complete : bool = True) -> None:
+    marker = {
+        'num_shards': num_shards,
+        'shard_index': shard_index,
+        'n_data': len(data_ids),
+        'n_timed_out': n_timed_out,
+        'complete': complete,
+        'finished_at': time.time(),
+    }
+    with open(os.path.join(folder, SHARD_MARKER), 'w') as f:
+        json.dump(marker, f, indent=2)
+
+
+def read_shard_marker(folder : str) -> Dict:
+    path = os.path.join(folder, SHARD_MARKER)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+# combines the shard outputs into <output_folder>/hallucinations/allhallucinations.jsonl and
+# <output_folder>/intermediate/HallucinationFinal.tsv, sorted as an unsharded run writes them. Shards without a
+# marker, or whose run was cancelled, are missing: an error, or left out with allow_incomplete
+def merge_shards(output_folder : str, num_shards : int, allow_incomplete : bool = False) -> Dict:
+    missing = []
+    retval_jsonl = []
+    seen = set()
+    for shard_index in range(num_shards):
+        folder = shard_folder(output_folder, num_shards, shard_index)
+        marker = read_shard_marker(folder)
+        if marker is None or not marker.get('complete', True) or marker.get('num_shards') != num_shards:
+            missing.append(shard_index)
+            continue
+        with open(os.path.join(folder, 'hallucinations', 'allhallucinations.jsonl')) as f:
+            for line in f:
+                record = json.loads(line)
+                if record[AllHallucinations.DATA_ID] in seen:
+                    raise ValueError(f'data_id {record[AllHallucinations.DATA_ID]} found in more than one shard')
+                seen.add(record[AllHallucinations.DATA_ID])
+                retval_jsonl.append(record)
+    if missing and not allow_incomplete:
+        raise ValueError(f'Shards {missing} of {num_shards} in {output_folder} are not complete (no {SHARD_MARKER}, or the shard run was cancelled)')
+
+    hallucination_result_folder = os.path.join(output_folder, 'hallucinations')
+    intermediate_result_folder = os.path.join(output_folder, 'intermediate')
+    os.makedirs(hallucination_result_folder, exist_ok=True)
+    os.makedirs(intermediate_result_folder, exist_ok=True)
+    jsonl_path = save_all_hallucinations_jsonl(retval_jsonl, hallucination_result_folder)
+    save_hallucinations([h for r in retval_jsonl for h in r[AllHallucinations.HALLUCINATIONS]], intermediate_result_folder)
+    return {
+        'num_shards': num_shards,
+        'missing_shards': missing,
+        'n_data': len(retval_jsonl),
+        'n_timed_out': sum(1 for r in retval_jsonl if r.get(AllHallucinations.TIMED_OUT, False)),
+        'output': jsonl_path,
+    }
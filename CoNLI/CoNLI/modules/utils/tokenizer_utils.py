@@ -0,0 +1,15 @@
+# the gpt2 tokenizer used to check prompt lengths
+
+import threading
+
+_gpt2_tokenizer = None
+_gpt2_tokenizer_lock = threading.Lock()
+
+# loaded once per process on first use, transformers is only imported by runs that count prompt tokens
+def load_gpt2_tokenizer():
+    global _gpt2_tokenizer
+    with _gpt2_tokenizer_lock:
+        if _gpt2_tokenizer is None:
+            from transformers import GPT2TokenizerFast
+            _gpt2_tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
+    return _gpt2_tokenizer
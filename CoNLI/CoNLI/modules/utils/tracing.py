@@ -0,0 +1,153 @@
+# opt-in span tracing (run -> document -> round -> batch -> attempt) written as a Chrome trace
+# (chrome://tracing, https://ui.perfetto.dev). With tracing off, span() returns a shared no-op object.
+
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict
+
+_current_span : contextvars.ContextVar = contextvars.ContextVar('conli_current_span', default=None)
+_tracer = None
+
+
+class Tracer:
+    def __init__(self, path : str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._events = []
+        self._ids = itertools.count(1)
+        self._pid = os.getpid()
+        self._origin = time.perf_counter()
+        self._thread_names : Dict[int, str] = {}
+
+    def now_us(self) -> float:
+        return (time.perf_counter() - self._origin) * 1e6
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    def add(self, event : Dict) -> None:
+        event['pid'] = self._pid
+        tid = threading.get_ident()
+        event['tid'] = tid
+        with self._lock:
+            if tid not in self._thread_names:
+                self._thread_names[tid] = threading.current_thread().name
+            self._events.append(event)
+
+    def write(self) -> None:
+        with self._lock:
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid, 'args': {'name': name}} for tid, name in self._thread_names.items()]
+            events = metadata + sorted(self._events, key=lambda e: e['ts'])
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class Span:
+    def __init__(self, tracer : Tracer, name : str, attrs : Dict) -> None:
+        self._tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.span_id = tracer.next_id()
+        self.parent_id = None
+        self._token = None
+        self._start = None
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def __enter__(self) -> 'Span':
+        parent = _current_span.get()
+        self.parent_id = parent.span_id if parent is not None else None
+        self._token = _current_span.set(self)
+        self._start = self._tracer.now_us()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        end = self._tracer.now_us()
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attrs['error'] = f'{exc_type.__name__}: {str(exc)[:200]}'
+        self._tracer.add({
+            'name': self.name,
+            'ph': 'X',
+            'ts': self._start,
+            'dur': end - self._start,
+            'args': dict(self.attrs, span_id=self.span_id, parent_id=self.parent_id)})
+        return False
+
+
+class _NoopSpan:
+    def set(self, **attrs) -> None:
+        pass
+
+    def __enter__(self) -> '_NoopSpan':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def enable_tracing(path : str) -> Tracer:
+    global _tracer
+    _tracer = Tracer(path)
+    return _tracer
+
+
+# writes the trace file and turns tracing off
+def finish_tracing() -> None:
+    global _tracer
+    if _tracer is not None:
+        _tracer.write()
+        _tracer = None
+
+
+def tracing_enabled() -> bool:
+    return _tracer is not None
+
+
+# with span('batch', n_items=5) as s: ... s.set(prompt_tokens=n)
+def span(name : str, **attrs):
+    if _tracer is None:
+        return _NOOP_SPAN
+    return Span(_tracer, name, attrs)
+
+
+# attributes on the innermost open span of the calling context
+def set_attributes(**attrs) -> None:
+    if _tracer is None:
+        return
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attrs)
+
+
+# a span that already happened, e.g. the time a document waited in the thread pool queue.
+# start and end are time.perf_counter() values
+def record_span(name : str, start : float, end : float, **attrs) -> None:
+    if _tracer is None:
+        return
+    parent = _current_span.get()
+    ts = (start - _tracer._origin) * 1e6
+    _tracer.add({
+        'name': name,
+        'ph': 'X',
+        'ts': ts,
+        'dur': (end - start) * 1e6,
+        'args': dict(attrs, span_id=_tracer.next_id(), parent_id=parent.span_id if parent is not None else None)})
+
+
+# thread pools do not carry context variables: traced(fn) runs fn in the submitting thread's context,
+# so that spans opened in the worker are children of the span open at submission
+def traced(fn : Callable) -> Callable:
+    if _tracer is None:
+        return fn
+    context = contextvars.copy_context()
+    # a context can only be entered by one thread at a time, so each call runs in its own copy
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
@@ -0,0 +1,149 @@
+# near-duplicate verdict cache for hallucination detection, based on MinHash + LSH
+
+import hashlib
+import re
+import threading
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+STOP_WORDS = frozenset([
+    'a', 'an', 'the', 'and', 'or', 'but', 'of', 'to', 'in', 'on', 'at', 'for', 'by', 'with', 'from',
+    'as', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'has', 'have', 'had', 'it', 'its',
+    'this', 'that', 'these', 'those', 'also', 'very', 'just', 'then', 'there', 'so'])
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+@dataclass
+class VerdictCacheHit:
+    reasons: List[str] # one reason per flagged generation, empty when the hypothesis was judged correct
+    matched_hypothesis: str # the cached hypothesis whose verdict is reused
+    similarity: float # exact jaccard similarity between the normalized hypotheses
+
+
+class NearDuplicateVerdictCache:
+    """
+    Reuses a [C]/[I] verdict (plus reason) for hypotheses that differ from an already judged
+    hypothesis of the same source only by whitespace, punctuation or stop words.
+    Hypotheses are normalized into word shingles, MinHash signatures are indexed in a
+    banded LSH table per source hash, and LSH candidates are verified with the exact jaccard
+    similarity before their verdict is reused.
+    Tagged entities ("[ entity ]") are kept as distinct tokens, so two entity-level hypotheses
+    of the same sentence tagging different entities never share a verdict.
+    """
+    def __init__(self, threshold : float = 0.9, num_perm : int = 64, bands : int = 16, shingle_size : int = 2) -> None:
+        if not 0 < threshold <= 1:
+            raise ValueError(f'verdict cache threshold must be in (0, 1], got {threshold}')
+        if num_perm % bands != 0:
+            raise ValueError(f'num_perm ({num_perm}) must be a multiple of bands ({bands})')
+        self._threshold = threshold
+        self._num_perm = num_perm
+        self._bands = bands
+        self._rows = num_perm // bands
+        self._shingle_size = shingle_size
+        # fixed seeds so that signatures are reproducible across runs
+        self._permutations = []
+        for i in range(num_perm):
+            seed = hashlib.sha256(f'CoNLI-verdict-cache-{i}'.encode('utf-8')).digest()
+            self._permutations.append((int.from_bytes(seed[:8], 'little') | 1, int.from_bytes(seed[8:16], 'little')))
+        self._lock = threading.Lock()
+        # source hash -> list of (hypothesis, shingles, reasons)
+        self._entries : Dict[str, List[Tuple[str, FrozenSet[str], List[str]]]] = {}
+        # source hash -> band index -> band hash -> entry indexes
+        self._lsh : Dict[str, List[Dict[int, List[int]]]] = {}
+        self.n_lookups = 0
+        self.n_hits = 0
+        self.reuse_log : List[Dict] = []
+
+    # an entity tagged by the TA stage, f'{text[:offset]}[ {entity.text} ]{text[end:]}'
+    _ENTITY_TAG = re.compile(r'\[ (.+?) \]')
+
+    @staticmethod
+    def normalize(hypothesis : str) -> List[str]:
+        # keep tagged entities whole (punctuation included, e.g. "U.S." or "O'Neil") as single marked tokens,
+        # drop punctuation and stop words from the rest
+        tokens = []
+        pos = 0
+        for m in NearDuplicateVerdictCache._ENTITY_TAG.finditer(hypothesis):
+            tokens += [t for t in re.findall(r'\w+', hypothesis[pos:m.start()].lower()) if t not in STOP_WORDS]
+            tokens.append('@' + ' '.join(m.group(1).lower().split()))
+            pos = m.end()
+        tokens += [t for t in re.findall(r'\w+', hypothesis[pos:].lower()) if t not in STOP_WORDS]
+        return tokens
+
+    def shingles(self, hypothesis : str) -> FrozenSet[str]:
+        tokens = NearDuplicateVerdictCache.normalize(hypothesis)
+        n = self._shingle_size
+        if len(tokens) <= n:
+            return frozenset([' '.join(tokens)])
+        return frozenset(' '.join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+
+    def signature(self, shingles : FrozenSet[str]) -> List[int]:
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little') for s in shingles]
+        return [
+            min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self._permutations]
+
+    def _band_keys(self, signature : List[int]) -> List[int]:
+        return [hash(tuple(signature[i * self._rows: (i + 1) * self._rows])) for i in range(self._bands)]
+
+    @staticmethod
+    def jaccard(a : FrozenSet[str], b : FrozenSet[str]) -> float:
+        if not a and not b:
+            return 1.0
+        return len(a & b) / len(a | b)
+
+    def lookup(self, source_key : str, hypothesis : str) -> Optional[VerdictCacheHit]:
+        shingles = self.shingles(hypothesis)
+        band_keys = self._band_keys(self.signature(shingles))
+        with self._lock:
+            self.n_lookups += 1
+            entries = self._entries.get(source_key)
+            if not entries:
+                return None
+            candidates = set()
+            for band, key in zip(self._lsh[source_key], band_keys):
+                candidates.update(band.get(key, []))
+            best, best_similarity = None, 0.0
+            for index in candidates:
+                similarity = NearDuplicateVerdictCache.jaccard(shingles, entries[index][1])
+                if similarity > best_similarity:
+                    best, best_similarity = index, similarity
+            if best is None or best_similarity < self._threshold:
+                return None
+            self.n_hits += 1
+            matched, _, reasons = entries[best]
+            return VerdictCacheHit(list(reasons), matched, best_similarity)
+
+    def add(self, source_key : str, hypothesis : str, reasons : List[str]) -> None:
+        shingles = self.shingles(hypothesis)
+        band_keys = self._band_keys(self.signature(shingles))
+        with self._lock:
+            entries = self._entries.setdefault(source_key, [])
+            lsh = self._lsh.setdefault(source_key, [dict() for _ in range(self._bands)])
+            entries.append((hypothesis, shingles, list(reasons)))
+            for band, key in zip(lsh, band_keys):
+                band.setdefault(key, []).append(len(entries) - 1)
+
+    def record_reuse(self, data_id : str, sentence_id, hypothesis : str, hit : VerdictCacheHit) -> None:
+        with self._lock:
+            self.reuse_log.append({
+                'data_id': data_id,
+                'sentence_id': sentence_id,
+                'hypothesis': hypothesis,
+                'matched_hypothesis': hit.matched_hypothesis,
+                'similarity': round(hit.similarity, 4),
+                'is_hallucination': len(hit.reasons) > 0,
+            })
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'threshold': self._threshold,
+                'n_sources': len(self._entries),
+                'n_entries': sum(len(x) for x in self._entries.values()),
+                'n_lookups': self.n_lookups,
+                'n_hits': self.n_hits,
+                'hit_rate': self.n_hits / self.n_lookups if self.n_lookups > 0 else 0.0,
+            }
@@ -0,0 +1,360 @@
+import argparse
+import itertools
+import json
+import logging
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List
+
+from CoNLI.modules.arguments import DetectionArguments, create_openai_arguments, create_ta_arguments
+from CoNLI.modules.data.data_loader import DataLoader
+from CoNLI.modules.entity_detector import EntityDetectorFactory
+from CoNLI.modules.sentence_selector import SentenceSelectorFactory
+from CoNLI.modules.hallucination_detector import HallucinationDetector
+from CoNLI.modules.mock.mock_server_base import MockEndpointConfig
+from CoNLI.modules.mock.aoai_mock_server import create_aoai_mock_server
+from CoNLI.modules.mock.ta_mock_server import create_ta_mock_server
+from CoNLI.modules.utils.concurrency import CallOutcome
+from CoNLI.modules.utils.cassette import Cassette, create_cassette
+from CoNLI.modules.utils.conversion_utils import str2bool
+from CoNLI.modules.utils.logging_utils import init_logging
+from CoNLI.modules.utils import tracing
+
+# Throughput benchmark of hallucination detection over the test_suite datasets.
+# Sweeps the parallelism / batching / detector settings against a mock or a real backend, and writes
+# one JSON line per configuration so that runs of different commits can be compared with --baseline.
+
+TASKS = {
+    'qags_cnndm': ('test_suite/qags_cnndm/qags_cnndm_raw_response.tsv', 'test_suite/qags_cnndm/src/'),
+    'qags_xsum': ('test_suite/qags_xsum/qags_xsum_raw_response.tsv', 'test_suite/qags_xsum/src/'),
+    'summeval': ('test_suite/summeval/summeval_raw_response.tsv', 'test_suite/summeval/src/'),
+}
+
+SWEEP_PARAMETERS = ['max_parallel_data', 'max_parallelism', 'gpt_batch_size', 'entity_detector_type', 'sentence_selector_type']
+
+# entry points whose import (and so whose --help) must stay within --import_time_budget and load none of
+# HEAVY_MODULES, which are imported by the code paths that use them
+IMPORT_TIME_MODULES = [
+    'CoNLI.run_hallucination_detection',
+    'CoNLI.run_hallucination_mitigation',
+    'CoNLI.run_streaming_detection',
+    'CoNLI.run_detection_service',
+    'CoNLI.run_hallucination_evaluator',
+    'CoNLI.run_hallucination_sentence_gt_evaluator',
+    'CoNLI.run_response_quality_evaluator',
+]
+HEAVY_MODULES = ['pandas', 'numpy', 'torch', 'transformers', 'openai', 'azure', 'nltk', 'yaml', 'sklearn', 'evaluate', 'rouge_score', 'sacrebleu']
+
+IMPORT_TIME_SNIPPET = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - start, 'heavy_modules': sorted(m for m in {heavy} if m in sys.modules)}}))
+"""
+
+
+def percentile(values : List[float], p : float) -> float:
+    # nearest-rank percentile
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(p / 100.0 * len(ordered)), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def latency_summary(values : List[float]) -> Dict:
+    return {
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'mean': sum(values) / len(values) if values else None,
+    }
+
+
+class CallRecorder:
+    """AOAIUtil call observer collecting per-call latency, outcome and token usage."""
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.outcomes = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def __call__(self, kind : str, latency : float, outcome : str, usage : Dict) -> None:
+        with self._lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            if outcome == CallOutcome.SUCCESS:
+                self.latencies.append(latency)
+            if usage:
+                self.prompt_tokens += usage.get('prompt_tokens', 0)
+                self.completion_tokens += usage.get('completion_tokens', 0)
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).absolute().parent, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def write_mock_configs(output_folder : str, aoai_url : str, ta_url : str):
+    # copies of the mock-gpt / ta-mock settings, pointed at the in-process servers (which listen on free ports)
+    configs_folder = Path(__file__).absolute().parent / 'configs'
+    written = []
+    for config_name, setting, url_key, url in [('aoai_config.json', 'mock-gpt', 'OPENAI_API_BASE', aoai_url), ('ta_config.json', 'ta-mock', 'ENDPOINT', ta_url)]:
+        with open(configs_folder / config_name) as f:
+            settings = json.load(f)[setting]
+        settings[url_key] = url
+        config_file = os.path.join(output_folder, f'mock_{config_name}')
+        with open(config_file, 'w') as f:
+            json.dump({setting: settings}, f, indent=4)
+        written += [config_file, setting]
+    return tuple(written)
+
+
+def measure_import_time(module : str, repeats : int) -> Dict:
+    # each import in a fresh interpreter, the best of repeats is kept
+    samples = []
+    for _ in range(max(repeats, 1)):
+        output = subprocess.check_output(
+            [sys.executable, '-c', IMPORT_TIME_SNIPPET.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=Path(__file__).absolute().parent.parent)
+        samples.append(json.loads(output.decode().strip().splitlines()[-1]))
+    best = min(samples, key=lambda s: s['seconds'])
+    return {'module': module, 'seconds': round(best['seconds'], 4), 'heavy_modules': best['heavy_modules']}
+
+
+def check_import_times(output_folder : str, budget : float, repeats : int) -> List[str]:
+    results = [measure_import_time(module, repeats) for module in IMPORT_TIME_MODULES]
+    with open(os.path.join(output_folder, 'import_times.json'), 'w') as outF:
+        json.dump({'budget_seconds': budget, 'results': results}, outF, indent=2)
+    violations = []
+    for r in results:
+        line = f"import {r['module']}: {r['seconds']:.3f}s, heavy modules loaded: {r['heavy_modules'] or 'none'}"
+        print(line)
+        if r['seconds'] > budget or r['heavy_modules']:
+            violations.append(line)
+    return violations
+
+
+def run_configuration(task : str, dataloader : DataLoader, config : Dict, args) -> Dict:
+    openai_args = create_openai_arguments(args.aoai_config_setting, config['max_parallelism'], config_file=args.aoai_config_file)
+    detector_args = DetectionArguments()
+    detector_args.batch_size = config['gpt_batch_size']
+
+    # each configuration replays the cassette from its start
+    cassette = create_cassette(args.cassette, Cassette.REPLAY, args.cassette_latency_scale) if args.backend == 'replay' else None
+
+    sentence_selector = None
+    if config['sentence_selector_type'] != 'none':
+        sentence_selector = SentenceSelectorFactory.create_sentence_selector(config['sentence_selector_type'])
+    entity_detector = None
+    if config['entity_detector_type'] != 'none':
+        ta_args = create_ta_arguments(args.ta_config_setting, ta_config_file=args.ta_config_file)
+        entity_detector = EntityDetectorFactory.create_entity_detector(config['entity_detector_type'], ta_args=ta_args, ta_cassette=cassette)
+
+    detector = HallucinationDetector(
+        sentence_selector=sentence_selector,
+        entity_detector=entity_detector,
+        openai_args=openai_args,
+        detection_args=detector_args,
+        aoai_config_file=args.aoai_config_file,
+        entity_detection_parallelism=config['max_parallelism'],
+        disable_progress_bar=True,
+        enable_hypothesis_dedup=args.dedup_hypotheses,
+        cassette=cassette)
+    recorder = CallRecorder()
+    detector.aoaiUtil.call_observers.append(recorder)
+
+    data_ids = dataloader._data_ids
+    doc_latencies, n_errors, n_hallucinations = [], 0, 0
+    def detect(data_id):
+        t0 = time.monotonic()
+        with tracing.span('document', data_id=data_id, task=task):
+            hallucinations = detector.detect_hallucinations(data_id, dataloader._src_docs[data_id], dataloader._hypothesis_preproc_sentences[data_id])
+        return time.monotonic() - t0, hallucinations
+
+    start = time.monotonic()
+    with tracing.span('run', task=task, **config), ThreadPoolExecutor(max_workers=min(config['max_parallel_data'], len(data_ids))) as executor:
+        for task_future in as_completed([executor.submit(tracing.traced(detect), data_id) for data_id in data_ids]):
+            try:
+                latency, hallucinations = task_future.result()
+            except Exception as exc:
+                logging.error(f'Error!! {type(exc).__name__}: {exc}')
+                n_errors += 1
+                continue
+            doc_latencies.append(latency)
+            n_hallucinations += len(hallucinations)
+    wall_clock = time.monotonic() - start
+
+    return {
+        'task': task,
+        'backend': args.backend,
+        'commit': args.commit,
+        **config,
+        'n_docs': len(data_ids),
+        'n_errors': n_errors,
+        'n_hallucinations': n_hallucinations,
+        'wall_clock_seconds': wall_clock,
+        'docs_per_second': len(doc_latencies) / wall_clock if wall_clock > 0 else None,
+        'n_gpt_calls': sum(recorder.outcomes.values()),
+        'gpt_call_outcomes': recorder.outcomes,
+        'input_tokens': recorder.prompt_tokens,
+        'output_tokens': recorder.completion_tokens,
+        'doc_latency': latency_summary(doc_latencies),
+        'call_latency': latency_summary(recorder.latencies),
+        'cassette': cassette.stats if cassette is not None else None,
+    }
+
+
+def config_key(result : Dict) -> tuple:
+    return (result['task'], result['backend']) + tuple(result[p] for p in SWEEP_PARAMETERS)
+
+
+def compare_with_baseline(results : List[Dict], baseline_file : str, tolerance : float) -> List[str]:
+    baseline = {}
+    with open(baseline_file) as f:
+        for line in f:
+            r = json.loads(line)
+            baseline[config_key(r)] = r
+    regressions = []
+    for r in results:
+        b = baseline.get(config_key(r))
+        if b is None or not b['docs_per_second'] or r['docs_per_second'] is None:
+            continue
+        change = r['docs_per_second'] / b['docs_per_second'] - 1
+        line = f"{config_key(r)}: {b['docs_per_second']:.3f} -> {r['docs_per_second']:.3f} docs/sec ({change:+.1%}), gpt calls {b['n_gpt_calls']} -> {r['n_gpt_calls']}"
+        print(line)
+        if change < -tolerance:
+            regressions.append(line)
+    return regressions
+
+
+def parse_list(type_fn):
+    return lambda v: [type_fn(x) for x in v.split(',')]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_folder', required=True, help='Where to write benchmark results', type=str)
+    parser.add_argument('--tasks', default=['qags_cnndm', 'qags_xsum', 'summeval'], help='Comma separated test_suite tasks to benchmark', type=parse_list(str))
+    parser.add_argument('--backend', default='mock', choices=['mock', 'real', 'replay'], help='mock: start the local mock servers in-process; real: use --aoai_config_* and --ta_config_*; replay: serve the calls from --cassette')
+    parser.add_argument('--aoai_config_file', default=(Path(__file__).absolute()).parent/"configs"/"aoai_config.json", type=str)
+    parser.add_argument('--aoai_config_setting', default='gpt-4-32k', type=str)
+    parser.add_argument('--ta_config_file', default=(Path(__file__).absolute()).parent/"configs"/"ta_config.json", type=str)
+    parser.add_argument('--ta_config_setting', default='ta-general', type=str)
+    # sweep
+    parser.add_argument('--max_parallel_data', default=[1, 2, 4], help='Comma separated values to sweep', type=parse_list(int))
+    parser.add_argument('--max_parallelism', default=[1, 2], help='Comma separated values to sweep', type=parse_list(int))
+    parser.add_argument('--gpt_batch_size', default=[1, 5], help='Comma separated values to sweep', type=parse_list(int))
+    parser.add_argument('--entity_detector_type', default=['none', 'ta-general'], help='Comma separated values to sweep, "none" disables entity-level detection', type=parse_list(str))
+    parser.add_argument('--sentence_selector_type', default=['rule_based'], help='Comma separated values to sweep, "none" disables sentence-level detection', type=parse_list(str))
+    parser.add_argument('--cassette', default=None, help='Cassette recorded by run_hallucination_detection --cassette_mode record, for --backend replay', type=str)
+    parser.add_argument('--cassette_latency_scale', default=0.0, help='Multiple of the recorded latency to sleep in replay (0 benchmarks python-side overhead only)', type=float)
+    parser.add_argument('--dedup_hypotheses', default='True', type=str)
+    parser.add_argument('--test_mode', default=20, help='Only benchmark the first <N> data of each task, 0 for all', type=int)
+    # mock backend behaviour
+    parser.add_argument('--mock_gpt_latency_ms', default=800, type=float)
+    parser.add_argument('--mock_gpt_latency_per_token_ms', default=5, type=float)
+    parser.add_argument('--mock_gpt_throttle_rate', default=0.0, type=float)
+    parser.add_argument('--mock_gpt_tokens_per_minute', default=0, type=int)
+    parser.add_argument('--mock_gpt_max_concurrency', default=0, type=int)
+    parser.add_argument('--mock_ta_latency_ms', default=100, type=float)
+    parser.add_argument('--mock_malformed_rate', default=0.0, type=float)
+    parser.add_argument('--mock_seed', default=1234, type=int)
+    # comparison
+    parser.add_argument('--import_time_budget', default=1.0, help='Seconds an entry point may take to import, checked before the sweep (0 skips the check)', type=float)
+    parser.add_argument('--import_time_repeats', default=3, type=int)
+    parser.add_argument('--baseline', default=None, help='results.jsonl of an earlier run to compare docs/sec with', type=str)
+    parser.add_argument('--regression_tolerance', default=0.1, help='Relative docs/sec drop reported as a regression', type=float)
+    parser.add_argument('--trace_file', default=None, help='Write the spans of all configurations to this Chrome trace file', type=str)
+    parser.add_argument('--log_level', default='error')
+    parser.add_argument('--logfile_name', default=None)
+    args = parser.parse_args()
+    args.dedup_hypotheses = str2bool(args.dedup_hypotheses)
+    if args.backend == 'replay' and not args.cassette:
+        parser.error('--cassette is required with --backend replay')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    os.makedirs(args.output_folder, exist_ok=True)
+    init_logging(args.log_level, args.logfile_name)
+    os.environ['TOKENIZERS_PARALLELISM'] = 'true'
+    os.environ['AZURE_CORE_COLLECT_TELEMETRY'] = 'false'
+    args.commit = get_git_commit()
+
+    if args.trace_file:
+        tracing.enable_tracing(args.trace_file)
+
+    import_violations = []
+    if args.import_time_budget > 0:
+        import_violations = check_import_times(args.output_folder, args.import_time_budget, args.import_time_repeats)
+
+    servers = []
+    if args.backend == 'mock':
+        aoai_server = create_aoai_mock_server(MockEndpointConfig(
+            latency_median_ms=args.mock_gpt_latency_ms,
+            latency_per_output_token_ms=args.mock_gpt_latency_per_token_ms,
+            throttle_rate=args.mock_gpt_throttle_rate,
+            tokens_per_minute=args.mock_gpt_tokens_per_minute,
+            max_concurrency=args.mock_gpt_max_concurrency,
+            malformed_rate=args.mock_malformed_rate,
+            seed=args.mock_seed)).start()
+        ta_server = create_ta_mock_server(MockEndpointConfig(latency_median_ms=args.mock_ta_latency_ms, seed=args.mock_seed)).start()
+        servers = [aoai_server, ta_server]
+        args.aoai_config_file, args.aoai_config_setting, args.ta_config_file, args.ta_config_setting = write_mock_configs(args.output_folder, aoai_server.url, ta_server.url)
+
+    package_root = Path(__file__).absolute().parent
+    results = []
+    results_file = os.path.join(args.output_folder, 'results.jsonl')
+    try:
+        with open(results_file, 'w') as outF:
+            for task in args.tasks:
+                hyp, src = TASKS[task]
+                dataloader = DataLoader(hypothesis=str(package_root / hyp), src_folder=str(package_root / src), test_mode=args.test_mode)
+                for values in itertools.product(*[getattr(args, p) for p in SWEEP_PARAMETERS]):
+                    config = dict(zip(SWEEP_PARAMETERS, values))
+                    result = run_configuration(task, dataloader, config, args)
+                    results.append(result)
+                    outF.write(json.dumps(result) + '\n')
+                    outF.flush()
+                    print(f"{task} {config}: {result['docs_per_second']:.3f} docs/sec, {result['n_gpt_calls']} gpt calls, "
+                          f"tokens in/out {result['input_tokens']}/{result['output_tokens']}, "
+                          f"doc p50/p95/p99 {result['doc_latency']['p50']}/{result['doc_latency']['p95']}/{result['doc_latency']['p99']}s")
+    finally:
+        for server in servers:
+            server.stop()
+        if args.trace_file:
+            tracing.finish_tracing()
+
+    print(f'Benchmark results written to {results_file}')
+    failed = False
+    if len(import_violations) > 0:
+        print(f'{len(import_violations)} entry point(s) over the {args.import_time_budget}s import budget or loading heavy modules at import:')
+        for line in import_violations:
+            print(f'  {line}')
+        failed = True
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.regression_tolerance)
+        if len(regressions) > 0:
+            print(f'{len(regressions)} configuration(s) regressed by more than {args.regression_tolerance:.0%}:')
+            for line in regressions:
+                print(f'  {line}')
+            failed = True
+    # a configuration with failed documents did not measure the path it was meant to
+    errored = [r for r in results if r['n_errors'] > 0]
+    if len(errored) > 0:
+        print(f'{len(errored)} configuration(s) had documents that failed:')
+        for r in errored:
+            print(f"  {r['task']} {dict((p, r[p]) for p in SWEEP_PARAMETERS)}: {r['n_errors']} of {r['n_docs']} documents")
+        failed = True
+    if failed:
+        exit(1)
@@ -0,0 +1,302 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from pathlib import Path
+from typing import Dict, Tuple
+
+from CoNLI.modules.arguments import DetectionArguments, MitigationArguments, create_openai_arguments, create_ta_arguments
+from CoNLI.modules.data.data_loader import DataLoader
+from CoNLI.modules.entity_detector import EntityDetectorFactory
+from CoNLI.modules.sentence_selector import SentenceSelectorFactory
+from CoNLI.modules.hallucination_detector import HallucinationDetector
+from CoNLI.modules.hallucination_mitigator import HallucinationMitigator, to_hd_results
+from CoNLI.modules.hd_constants import AllHallucinations, FieldName, MitigationMode
+from CoNLI.modules.repair_loop import VerifyRepairLoop
+from CoNLI.modules.hd_output import save_hallucinations, save_all_hallucinations_jsonl, to_output_record
+from CoNLI.modules.utils.conversion_utils import str2bool
+from CoNLI.modules.utils.deadline import Deadline
+from CoNLI.modules.utils.logging_utils import init_logging
+from CoNLI.modules.utils import profiling
+
+# Detection and mitigation in one pass: the hallucinations of each data are handed to the mitigator as soon as
+# its detection finishes, while the detection of the other data goes on, so the run takes about as long as the
+# slower of the two stages instead of their sum. Data without hallucinations are written through at once.
+# Writes the outputs of run_hallucination_detection (hallucinations/, intermediate/) and the rewritten
+# responses of run_hallucination_mitigation (mitigated/<data_id>.txt) under --output_folder. With --verify_rounds,
+# the sentences a rewrite changed are checked again (see VerifyRepairLoop).
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--output_folder',
+        required=True,
+        help='Where to output all of this runs data',
+        type=str)
+    parser.add_argument(
+        '--input_hypothesis',
+        required=True,
+        help='The folder where all of your raw responses are located, a sentence-level tsv file with columns: DataID, SentenceID, Sentence, or a packed .jsonl corpus (see run_pack_corpus)',
+        type=str)
+    parser.add_argument(
+        '--input_src',
+        default=None,
+        help='The folder where all of your source documents are located. Not needed with a packed .jsonl corpus',
+        type=str)
+    parser.add_argument(
+        '--lazy_loading',
+        default=True,
+        help='Only read each source and response when its detection starts, instead of loading the whole corpus first',
+        type=str2bool)
+    parser.add_argument(
+        '--entity_detector_type',
+        default="text_analytics",
+        help='entity detector type: pass_through, text_analytics. If ensembled, you must also specify as ensembled:type1,type2 ...',
+        type=str)
+    parser.add_argument(
+        '--sentence_selector_type',
+        default="pass_through",
+        help='entity detector type: pass_through, None. If ensembled, you must also specify as ensembled:type1,type2 ...',
+        type=str)
+    parser.add_argument(
+        '--aoai_config_file',
+        default=(Path(__file__).absolute()).parent/"configs"/"aoai_config.json",
+        help='JSON file holding the aoai endpoint configs',
+        type=str)
+    parser.add_argument(
+        '--aoai_config_setting',
+        default='gpt-4-32k',
+        help='The configuration setting to run against (aoai_config.json)',
+        type=str)
+    parser.add_argument(
+        '--ta_config_file',
+        default=(Path(__file__).absolute()).parent/"configs"/"ta_config.json",
+        help='JSON file holding the text analytics endpoint configs',
+        type=str)
+    parser.add_argument(
+        '--ta_config_setting',
+        default='ta-general',
+        help='The configuration setting to run against (ta_config.json)',
+        type=str)
+    parser.add_argument(
+        '--max_parallel_data',
+        default=2,
+        help='The maximum number of data to detect in parallel',
+        type=int)
+    parser.add_argument(
+        '--max_parallel_mitigation',
+        default=2,
+        help='The maximum number of data to rewrite in parallel, while the detection of the others goes on',
+        type=int)
+    parser.add_argument(
+        '--mitigation_mode',
+        default=MitigationMode.DOCUMENT,
+        choices=[MitigationMode.DOCUMENT, MitigationMode.SENTENCE],
+        help='document: rewrite the whole response of a data with hallucinations; sentence: rewrite only its flagged sentences, shown with the text around them, and splice them back into the response',
+        type=str)
+    parser.add_argument(
+        '--max_parallelism',
+        default=2,
+        help='The maximum number of GPT requests to send in parallel per data during detection',
+        type=int)
+    parser.add_argument(
+        '--entity_detection_parallelism',
+        default=2,
+        help='The maximum number of entity detection batches to process in parallel per data',
+        type=int)
+    parser.add_argument(
+        '--dedup_hypotheses',
+        default='True',
+        help='Send each distinct (source, hypothesis) pair to GPT once per run',
+        type=str2bool)
+    parser.add_argument(
+        '--request_timeout',
+        default=0,
+        help='Timeout in seconds of a single GPT http call. 0 keeps the openai default',
+        type=float)
+    parser.add_argument(
+        '--max_retry_wait',
+        default=60,
+        help='Upper bound in seconds on a single back-off sleep after a throttled or failed GPT call',
+        type=float)
+    parser.add_argument(
+        '--data_timeout',
+        default=0,
+        help='Deadline in seconds for detecting a single data. The hallucinations found by the deadline are still mitigated. 0 disables the deadline',
+        type=float)
+    parser.add_argument(
+        '--verify_rounds',
+        default=0,
+        help='After the rewrite of a data, detect again only the sentences the rewrite changed and rewrite again the ones still flagged, for up to this many rounds. 0 disables the verification',
+        type=int)
+    parser.add_argument(
+        '--verify_token_budget',
+        default=0,
+        help='Upper bound on the tokens of the sentences rewritten and verified for a data, over all rounds (the source and prompt are not counted). 0 for no bound',
+        type=int)
+    parser.add_argument(
+        '--test_mode',
+        default=0,
+        help='Simple iteration filter for testing.  Will run E2E but only on the first <N> data, specified by this int',
+        type=int)
+    parser.add_argument('--gpt_batch_size', default=1, type=int)
+    profiling.add_profile_arguments(parser)
+    parser.add_argument('--log_level', default='error')
+    parser.add_argument('--logfile_name', default=None)
+    args = parser.parse_args()
+
+    args.max_parallel_data = max(args.max_parallel_data, 1)
+    args.max_parallel_mitigation = max(args.max_parallel_mitigation, 1)
+    args.max_parallelism = max(args.max_parallelism, 1)
+    args.entity_detection_parallelism = max(args.entity_detection_parallelism, 1)
+    if args.input_src is None and not args.input_hypothesis.endswith('.jsonl'):
+        parser.error('--input_src is required unless --input_hypothesis is a packed .jsonl corpus')
+    print(f'Input Arguments: {args}')
+    return args
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    init_logging(args.log_level, args.logfile_name)
+    os.environ['TOKENIZERS_PARALLELISM'] = 'true'
+    os.environ['AZURE_CORE_COLLECT_TELEMETRY'] = 'false'
+
+    hallucination_result_folder = os.path.join(args.output_folder, 'hallucinations')
+    intermediate_result_folder = os.path.join(args.output_folder, 'intermediate')
+    mitigation_result_folder = os.path.join(args.output_folder, 'mitigated')
+    for folder in [hallucination_result_folder, intermediate_result_folder, mitigation_result_folder]:
+        os.makedirs(folder, exist_ok=True)
+
+    profiling.enable_profiling_from_args(args, args.output_folder)
+    start_time = time.time()
+    with profiling.stage(profiling.DATA_LOADING):
+        dataloader = DataLoader(
+            hypothesis=args.input_hypothesis,
+            src_folder=args.input_src,
+            test_mode=args.test_mode,
+            lazy=args.lazy_loading)
+    data_ids = dataloader._data_ids
+
+    openai_args = create_openai_arguments(args.aoai_config_setting, args.max_parallelism, config_file=args.aoai_config_file)
+    detector_args = DetectionArguments()
+    detector_args.batch_size = args.gpt_batch_size
+
+    sentence_selector = None
+    if args.sentence_selector_type:
+        sentence_selector = SentenceSelectorFactory.create_sentence_selector(args.sentence_selector_type)
+    entity_detector = None
+    if args.entity_detector_type:
+        if args.entity_detector_type == "text_analytics":
+            args.entity_detector_type = "ta-general"
+        ta_args = create_ta_arguments(args.ta_config_setting, ta_config_file=args.ta_config_file)
+        entity_detector = EntityDetectorFactory.create_entity_detector(args.entity_detector_type, ta_args=ta_args)
+
+    request_timeout = args.request_timeout if args.request_timeout > 0 else None
+    detector = HallucinationDetector(
+        sentence_selector=sentence_selector,
+        entity_detector=entity_detector,
+        openai_args=openai_args,
+        detection_args=detector_args,
+        aoai_config_file=args.aoai_config_file,
+        entity_detection_parallelism=args.entity_detection_parallelism,
+        disable_progress_bar=True,
+        enable_hypothesis_dedup=args.dedup_hypotheses,
+        request_timeout=request_timeout,
+        max_retry_wait=args.max_retry_wait)
+    mitigator = HallucinationMitigator(
+        openai_args=openai_args,
+        mitigation_args=MitigationArguments(mode=args.mitigation_mode),
+        config_file=args.aoai_config_file,
+        request_timeout=request_timeout,
+        max_retry_wait=args.max_retry_wait)
+
+    # the response of a data to rewrite. A sentence-level tsv input has no response text, it is rebuilt from the
+    # sentences as a packed corpus record without one is
+    def raw_response(data_id : str, sentences) -> str:
+        if data_id in dataloader._hypothesis:
+            return dataloader._hypothesis[data_id]
+        return ' '.join(s[FieldName.SENTENCE_TEXT] for s in sentences)
+
+    # the source and response read for detection are handed on to the mitigation, with lazy loading they are not read twice
+    def detect(data_id : str) -> Tuple[Dict, str, str]:
+        sentences = dataloader._hypothesis_preproc_sentences[data_id]
+        source = dataloader._src_docs[data_id]
+        deadline = Deadline(args.data_timeout)
+        hallucinations = detector.detect_hallucinations(data_id, source, sentences, deadline=deadline)
+        return to_output_record(data_id, len(sentences), hallucinations, deadline.timed_out), source, raw_response(data_id, sentences)
+
+    repair_loop = None
+    if args.verify_rounds > 0:
+        repair_loop = VerifyRepairLoop(detector, mitigator, max_rounds=args.verify_rounds, token_budget=args.verify_token_budget)
+
+    count_lock = threading.Lock()
+    n_rewritten, n_passed_through = [0], [0]
+    repair_records = []
+    def mitigate(data_id : str, record : Dict, source : str, response : str) -> None:
+        hd_result = to_hd_results(record[AllHallucinations.HALLUCINATIONS])
+        if repair_loop is not None and len(hd_result) > 0:
+            result = repair_loop.run(data_id, source, response, hd_result, deadline=Deadline(args.data_timeout))
+            with count_lock:
+                repair_records.append(result.to_record())
+        else:
+            result = mitigator.mitigate_one(data_id, response, source, hd_result)
+        if result.failed:
+            raise RuntimeError('the GPT call of the rewrite failed, no output is written')
+        with open(os.path.join(mitigation_result_folder, f'{result.data_id}.txt'), 'w') as outF:
+            outF.write(result.refined_response)
+        with count_lock:
+            (n_rewritten if len(hd_result) > 0 else n_passed_through)[0] += 1
+
+    retval_jsonl, all_hallucinations = [], []
+    detection_time = None
+    with ThreadPoolExecutor(max_workers=args.max_parallel_data) as detection_executor, \
+            ThreadPoolExecutor(max_workers=args.max_parallel_mitigation) as mitigation_executor:
+        detection_tasks = {detection_executor.submit(detect, data_id): data_id for data_id in data_ids}
+        mitigation_tasks = {}
+        for task in as_completed(detection_tasks):
+            data_id = detection_tasks[task]
+            try:
+                record, source, response = task.result()
+            except Exception as exc:
+                logging.exception(f'Detection failed for {data_id}')
+                print(f'Error!! {type(exc).__name__}: {exc}')
+                continue
+            retval_jsonl.append(record)
+            all_hallucinations += record[AllHallucinations.HALLUCINATIONS]
+            if record[AllHallucinations.HALLUCINATED]:
+                mitigation_tasks[mitigation_executor.submit(mitigate, data_id, record, source, response)] = data_id
+            else:
+                # nothing to rewrite, the response is passed through here
+                try:
+                    mitigate(data_id, record, source, response)
+                except Exception as exc:
+                    logging.exception(f'Mitigation failed for {data_id}')
+                    print(f'Error!! mitigation of {data_id} failed, {type(exc).__name__}: {exc}')
+        detection_time = time.time() - start_time
+        print(f'Detection finished after {detection_time:.1f} seconds, {len(mitigation_tasks)} of {len(retval_jsonl)} data to rewrite')
+        wait(mitigation_tasks)
+        for task, data_id in mitigation_tasks.items():
+            if task.exception() is not None:
+                print(f'Error!! mitigation of {data_id} failed, {type(task.exception()).__name__}: {task.exception()}')
+
+    with profiling.stage(profiling.OUTPUT_WRITING):
+        outputFilePath = save_all_hallucinations_jsonl(retval_jsonl, hallucination_result_folder)
+        save_hallucinations(all_hallucinations, intermediate_result_folder)
+        if repair_loop is not None:
+            with open(os.path.join(intermediate_result_folder, 'verify_repair.jsonl'), 'w') as outF:
+                for repair_record in sorted(repair_records, key=lambda r: r['data_id']):
+                    outF.write(json.dumps(repair_record) + '\n')
+    profiling.finish_profiling()
+
+    end_time = time.time() - start_time
+    print(f'Rewrote {n_rewritten[0]} data and passed {n_passed_through[0]} through to {mitigation_result_folder}')
+    if repair_loop is not None:
+        stop_reasons = {}
+        for repair_record in repair_records:
+            stop_reasons[repair_record['stop_reason']] = stop_reasons.get(repair_record['stop_reason'], 0) + 1
+        print(f"Verify and repair: stop reasons {stop_reasons}, {sum(r['n_verified_sentences'] for r in repair_records)} sentences verified again "
+              f"and {sum(r['n_repaired_sentences'] for r in repair_records)} rewritten again, details in verify_repair.jsonl")
+    print(f'Detection and mitigation have finished, detection took {detection_time:.1f} of {end_time:.1f} wall-clock seconds')
+    print(f'Hallucinations written to {outputFilePath}')
@@ -0,0 +1,188 @@
+import argparse
+import logging
+import os
+import signal
+import threading
+from pathlib import Path
+
+from CoNLI.modules.arguments import DetectionArguments, create_openai_arguments, create_ta_arguments
+from CoNLI.modules.entity_detector import EntityDetectorFactory
+from CoNLI.modules.sentence_selector import SentenceSelectorFactory
+from CoNLI.modules.hallucination_detector import HallucinationDetector
+from CoNLI.modules.service.detection_service import DetectionServer, DetectionService
+from CoNLI.modules.utils.concurrency import AdaptiveConcurrencyLimiter
+from CoNLI.modules.utils.conversion_utils import str2bool
+from CoNLI.modules.utils.logging_utils import init_logging
+from CoNLI.modules.utils.metrics import MetricsRegistry, endpoint_call_observer
+
+# Serves hallucination detection over HTTP/JSON from a resident process, so that online callers do not
+# pay the tokenizer / sentence splitter / client start-up per response. See modules/service/detection_service.py
+# for the endpoints, and run_service_load_generator.py to measure latency under load.
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument(
+        '--entity_detector_type',
+        default="text_analytics",
+        help='entity detector type: pass_through, text_analytics. If ensembled, you must also specify as ensembled:type1,type2 ...',
+        type=str)
+    parser.add_argument(
+        '--sentence_selector_type',
+        default="pass_through",
+        help='entity detector type: pass_through, None. If ensembled, you must also specify as ensembled:type1,type2 ...',
+        type=str)
+    parser.add_argument(
+        '--aoai_config_file',
+        default=(Path(__file__).absolute()).parent/"configs"/"aoai_config.json",
+        help='JSON file holding the aoai endpoint configs',
+        type=str)
+    parser.add_argument(
+        '--aoai_config_setting',
+        default='gpt-4-32k',
+        help='The configuration setting to run against (aoai_config.json)',
+        type=str)
+    parser.add_argument(
+        '--ta_config_file',
+        default=(Path(__file__).absolute()).parent/"configs"/"ta_config.json",
+        help='JSON file holding the text analytics endpoint configs',
+        type=str)
+    parser.add_argument(
+        '--ta_config_setting',
+        default='ta-general',
+        help='The configuration setting to run against (ta_config.json)',
+        type=str)
+    parser.add_argument(
+        '--max_parallelism',
+        default=2,
+        help='The maximum number of GPT requests to send in parallel per request (or micro-batch)',
+        type=int)
+    parser.add_argument(
+        '--entity_detection_parallelism',
+        default=2,
+        help='The maximum number of entity detection batches to process in parallel per request',
+        type=int)
+    parser.add_argument(
+        '--max_inflight_requests',
+        default=64,
+        help='Detection requests processed concurrently, further requests get 429',
+        type=int)
+    parser.add_argument(
+        '--micro_batch_window_ms',
+        default=20,
+        help='How long the first request for a source waits for concurrent requests with the same source to share its GPT payloads. 0 disables micro-batching, as does --gpt_batch_size 1',
+        type=float)
+    parser.add_argument(
+        '--dedup_hypotheses',
+        default=False,
+        help='Reuse the verdict of a (source, hypothesis) pair already checked by an earlier request. The table grows for the life of the process',
+        type=str2bool)
+    parser.add_argument(
+        '--request_timeout',
+        default=0,
+        help='Deadline in seconds for a detection request (a request may ask for another one with "timeout"). Work left at the deadline is dropped and the response is marked as timed out. 0 disables the deadline',
+        type=float)
+    parser.add_argument(
+        '--gpt_request_timeout',
+        default=0,
+        help='Timeout in seconds of a single GPT http call. 0 keeps the openai default',
+        type=float)
+    parser.add_argument(
+        '--max_retry_wait',
+        default=60,
+        help='Upper bound in seconds on a single back-off sleep after a throttled or failed GPT call',
+        type=float)
+    parser.add_argument(
+        '--adaptive_concurrency',
+        default=False,
+        help='Adapt the number of in-flight GPT and TA calls at runtime (AIMD), bounded by --max_inflight_requests x --max_parallelism (resp. x --entity_detection_parallelism)',
+        type=str2bool)
+    parser.add_argument(
+        '--initial_concurrency',
+        default=2,
+        help='Initial limit on in-flight calls per endpoint when --adaptive_concurrency is on',
+        type=int)
+    parser.add_argument(
+        '--drain_timeout',
+        default=30,
+        help='On SIGTERM / Ctrl-C, seconds given to in-flight requests to complete',
+        type=float)
+    parser.add_argument(
+        '--gpt_batch_size',
+        default=4,
+        help='Hypotheses per GPT payload. Above 1 so that concurrent requests with the same source can share payloads (micro-batching); 1 sends every hypothesis alone and disables micro-batching',
+        type=int)
+    parser.add_argument('--log_level', default='info')
+    parser.add_argument('--logfile_name', default=None)
+    args = parser.parse_args()
+
+    args.max_parallelism = max(args.max_parallelism, 1)
+    args.entity_detection_parallelism = max(args.entity_detection_parallelism, 1)
+    print(f'Input Arguments: {args}')
+    return args
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    init_logging(args.log_level, args.logfile_name)
+    os.environ['TOKENIZERS_PARALLELISM'] = 'true'
+    os.environ['AZURE_CORE_COLLECT_TELEMETRY'] = 'false'
+
+    openai_args = create_openai_arguments(args.aoai_config_setting, args.max_parallelism, config_file=args.aoai_config_file)
+    detector_args = DetectionArguments()
+    detector_args.batch_size = args.gpt_batch_size
+
+    metrics = MetricsRegistry(const_labels={'aoai_config_setting': args.aoai_config_setting})
+
+    gpt_limiter, ta_limiter = None, None
+    if args.adaptive_concurrency:
+        gpt_limiter = AdaptiveConcurrencyLimiter('gpt', initial_limit=args.initial_concurrency, max_limit=args.max_inflight_requests * args.max_parallelism)
+        ta_limiter = AdaptiveConcurrencyLimiter('ta', initial_limit=args.initial_concurrency, max_limit=args.max_inflight_requests * args.entity_detection_parallelism)
+        for limiter in [gpt_limiter, ta_limiter]:
+            metrics.gauge('concurrency_limit', 'Current adaptive limit on in-flight calls per endpoint').set_function(lambda l=limiter: int(l.current_limit), endpoint=limiter.name)
+            metrics.gauge('in_flight_calls', 'In-flight calls per endpoint').set_function(lambda l=limiter: l.in_flight, endpoint=limiter.name)
+
+    sentence_selector = None
+    if args.sentence_selector_type:
+        sentence_selector = SentenceSelectorFactory.create_sentence_selector(args.sentence_selector_type)
+    entity_detector = None
+    if args.entity_detector_type:
+        if args.entity_detector_type == "text_analytics":
+            args.entity_detector_type = "ta-general"
+        ta_args = create_ta_arguments(args.ta_config_setting, ta_config_file=args.ta_config_file)
+        entity_detector = EntityDetectorFactory.create_entity_detector(args.entity_detector_type, ta_args=ta_args, ta_concurrency_limiter=ta_limiter, ta_call_observers=[endpoint_call_observer(metrics, 'ta')])
+
+    detector = HallucinationDetector(
+        sentence_selector=sentence_selector,
+        entity_detector=entity_detector,
+        openai_args=openai_args,
+        detection_args=detector_args,
+        aoai_config_file=args.aoai_config_file,
+        entity_detection_parallelism=args.entity_detection_parallelism,
+        disable_progress_bar=True,
+        enable_hypothesis_dedup=args.dedup_hypotheses,
+        request_timeout=args.gpt_request_timeout if args.gpt_request_timeout > 0 else None,
+        max_retry_wait=args.max_retry_wait,
+        concurrency_limiter=gpt_limiter,
+        metrics=metrics,
+        micro_batch_window=args.micro_batch_window_ms / 1000.0)
+
+    service = DetectionService(detector, metrics, request_timeout=args.request_timeout, max_inflight=args.max_inflight_requests)
+    server = DetectionServer(service, host=args.host, port=args.port).start()
+    service.warm_up()
+    if detector._micro_batcher is not None:
+        print(f'Micro-batching on: {args.micro_batch_window_ms} ms window, GPT batch size {args.gpt_batch_size}')
+    else:
+        print(f'Micro-batching off (--micro_batch_window_ms {args.micro_batch_window_ms}, --gpt_batch_size {args.gpt_batch_size})')
+    print(f'Detection service ready on {server.url}')
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    try:
+        while not stopped.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    print('Draining the detection service ...')
+    server.stop(args.drain_timeout)
+    logging.info(f'Detection service stopped, micro-batching stats: {detector._micro_batcher.stats if detector._micro_batcher is not None else None}')
@@ -4,6 +4,7 @@ import json
 import logging
 import os
 from pathlib import Path
+import signal
 import time
 from tqdm import tqdm
 from CoNLI.modules.arguments import DetectionArguments, create_openai_arguments, create_ta_arguments
@@ -11,51 +12,34 @@ from CoNLI.modules.data.data_loader import DataLoader
 from CoNLI.modules.entity_detector import EntityDetectorFactory
 from CoNLI.modules.sentence_selector import SentenceSelectorFactory
 from CoNLI.modules.hallucination_detector import HallucinationDetector
-from CoNLI.modules.hd_constants import AllHallucinations, FieldName
+from CoNLI.modules.verdict_cache import NearDuplicateVerdictCache
+from CoNLI.modules.hd_constants import AllHallucinations
 from CoNLI.modules.utils.logging_utils import init_logging
 from CoNLI.modules.utils.conversion_utils import str2bool
+from CoNLI.modules.utils.cassette import create_cassette
+from CoNLI.modules.utils.deadline import Deadline
+from CoNLI.modules.utils.concurrency import AdaptiveConcurrencyLimiter
+from CoNLI.modules.utils.metrics import MetricsRegistry, PeriodicTextfileWriter, endpoint_call_observer
+from CoNLI.modules.utils import profiling, sharding, tracing
+from CoNLI.modules.hd_output import save_hallucinations, save_all_hallucinations_jsonl, to_output_record
 
-def get_optional_field(hallucination, field_name, default_value = ''):
-    if field_name in hallucination:
-        return str(hallucination[field_name])
-    else:
-        return default_value
-
-def get_required_field(hallucination, field_name):
-    return str(hallucination[field_name])
-
-def save_hallucinations(hallucinations, output_folder : str):
-    hallucination_finalresults = os.path.join(output_folder, 'HallucinationFinal.tsv')
-    
-    # Sort all of the hallucinations by data and sentence id
-    # hallucinations contextual order before passing to requester
-    hallucinations = sorted(
-            hallucinations,
-            key=lambda d: (
-                d[FieldName.DATA_ID],
-                d[FieldName.SENTENCE_ID],
-                d[FieldName.DETECTION_TYPE],
-                d[FieldName.SENTENCE_TEXT]
-            )
-        )
-    
-    with open(hallucination_finalresults, 'w') as outFinal:
-        outFinal.write('data_id\tsentenceid\tdetectiontype\tspan\treason\tname\ttype\n')
-    
-        required_field_names = [
-                        FieldName.DATA_ID,
-                        FieldName.SENTENCE_ID,
-                        FieldName.DETECTION_TYPE,
-                        FieldName.SENTENCE_TEXT,
-                        FieldName.REASON
-                        ]
-        optional_field_names = [
-                        FieldName.NAME,
-                        FieldName.TYPE
-                        ]
-        for h in hallucinations:
-            field_values = [get_required_field(h, fn) for fn in required_field_names] + [get_optional_field(h, fn) for fn in optional_field_names]
-            outFinal.write('\t'.join(field_values) + '\n')
+def save_verdict_cache_stats(verdict_cache : NearDuplicateVerdictCache, output_folder : str):
+    # hit rate of the near-duplicate verdict cache, plus every reuse so that the
+    # reused verdicts can be joined with the sentence-level ground truth
+    stats = verdict_cache.stats()
+    print(f'Verdict cache: {stats}')
+    with open(os.path.join(output_folder, 'verdict_cache_stats.json'), 'w') as outF:
+        json.dump(stats, outF, indent=2)
+    with open(os.path.join(output_folder, 'verdict_cache_reuse.tsv'), 'w') as outF:
+        outF.write('data_id\tsentenceid\tsimilarity\tis_hallucination\thypothesis\tmatched_hypothesis\n')
+        for r in verdict_cache.reuse_log:
+            outF.write('\t'.join([
+                str(r['data_id']),
+                str(r['sentence_id']),
+                str(r['similarity']),
+                str(r['is_hallucination']),
+                r['hypothesis'].replace('\t', ' '),
+                r['matched_hypothesis'].replace('\t', ' ')]) + '\n')
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
@@ -67,13 +51,23 @@ def parse_arguments():
     parser.add_argument(
         '--input_hypothesis',
         required=True,
-        help='The folder where all of your raw responses are located; It can also load sentence-level tsv file with columns: DataID, SentenceID, Sentence. The Sentence will be the input strings for detection',
+        help='The folder where all of your raw responses are located; It can also load sentence-level tsv file with columns: DataID, SentenceID, Sentence. The Sentence will be the input strings for detection, or a packed .jsonl corpus (see run_pack_corpus) holding the sources too',
         type=str)
     parser.add_argument(
         '--input_src',
-        required=True,
-        help='The folder where all of your source documents are located',
+        default=None,
+        help='The folder where all of your source documents are located. Not needed with a packed .jsonl corpus',
         type=str)
+    parser.add_argument(
+        '--preprocess_workers',
+        default=0,
+        help='Split the responses into sentences in this many processes. With --lazy_loading, detection of each data starts as soon as its response is split. 0 splits them in the detection threads',
+        type=int)
+    parser.add_argument(
+        '--lazy_loading',
+        default=False,
+        help='List the data ids up front and only read each source and response (and split it into sentences) when its detection starts, instead of loading the whole corpus first. Packed .jsonl corpora are always read lazily',
+        type=str2bool)
     parser.add_argument(
         '--entity_detector_type',
         default="text_analytics",
@@ -125,12 +119,94 @@ def parse_arguments():
         default='True',
         help='Shows a simplified progress bar for the entire run (data-level progress rather than split by different batches of hallucination detection requests)',
         type=str)
+    parser.add_argument(
+        '--dedup_hypotheses',
+        default='True',
+        help='Send each unique (source, hypothesis) pair to GPT only once per run and reuse its verdict for every data_id, sentence_id and detection type that repeats it',
+        type=str)
+    parser.add_argument(
+        '--verdict_cache_threshold',
+        default=0.0,
+        help='If > 0, reuse the cached verdict of a near-duplicate hypothesis of the same source whose jaccard similarity (MinHash/LSH over normalized word shingles) is at least this value. 0 disables the cache',
+        type=float)
+    parser.add_argument(
+        '--request_timeout',
+        default=0,
+        help='Timeout in seconds of a single GPT http call. 0 keeps the openai default',
+        type=float)
+    parser.add_argument(
+        '--max_retry_wait',
+        default=60,
+        help='Upper bound in seconds on a single back-off sleep after a throttled or failed GPT call',
+        type=float)
+    parser.add_argument(
+        '--data_timeout',
+        default=0,
+        help='Deadline in seconds for detecting a single data. Work left at the deadline is dropped and the data is marked as timed out. 0 disables the deadline',
+        type=float)
+    parser.add_argument(
+        '--run_timeout',
+        default=0,
+        help='Deadline in seconds for the whole run. Data not finished at the deadline are written with a timed out marker. 0 disables the deadline',
+        type=float)
+    parser.add_argument(
+        '--adaptive_concurrency',
+        default='False',
+        help='Adapt the number of in-flight GPT and TA calls at runtime (AIMD: additive increase while calls are healthy, multiplicative decrease on throttles/timeouts). --max_parallel_data x --max_parallelism (resp. x --entity_detection_parallelism) then become the upper bounds on in-flight GPT (resp. TA) calls',
+        type=str)
+    parser.add_argument(
+        '--initial_concurrency',
+        default=2,
+        help='Initial limit on in-flight calls per endpoint when --adaptive_concurrency is on',
+        type=int)
+    parser.add_argument(
+        '--cassette',
+        default=None,
+        help='Path of a gzip jsonl cassette of GPT and TA calls, used by --cassette_mode',
+        type=str)
+    parser.add_argument(
+        '--cassette_mode',
+        default='off',
+        choices=['off', 'record', 'replay'],
+        help='record: save every GPT/TA request and response with its latency to --cassette. replay: serve GPT/TA calls from --cassette instead of the endpoints',
+        type=str)
+    parser.add_argument(
+        '--cassette_latency_scale',
+        default=1.0,
+        help='In replay mode, sleep this multiple of the recorded latency before returning a response (0 to measure python-side overhead only)',
+        type=float)
+    parser.add_argument(
+        '--metrics_textfile',
+        default=None,
+        help='Prometheus textfile the run metrics are written to (e.g. in the node_exporter textfile collector directory). Defaults to <output_folder>/intermediate/metrics.prom',
+        type=str)
+    parser.add_argument(
+        '--metrics_interval',
+        default=15,
+        help='Seconds between rewrites of the metrics textfile during the run',
+        type=float)
+    parser.add_argument(
+        '--trace_file',
+        default=None,
+        help='If set, record nested spans (run, document, round, batch, attempt) and write them to this file in the Chrome trace format (chrome://tracing or ui.perfetto.dev)',
+        type=str)
     parser.add_argument(
         '--test_mode',
         default=0,
         help='Simple iteration filter for testing.  Will run E2E but only on the first <N> data, specified by this int',
         type=int)
     
+    parser.add_argument(
+        '--num_shards',
+        default=1,
+        help='Split the data into this many shards by a stable hash of the data id, and only process --shard_index. Shard outputs go to <output_folder>/shards/shard-<i>-of-<n>/ and are combined with run_merge_shards',
+        type=int)
+    parser.add_argument(
+        '--shard_index',
+        default=0,
+        help='The shard to process, in [0, --num_shards)',
+        type=int)
+    profiling.add_profile_arguments(parser)
     parser.add_argument('--gpt_batch_size', default=1, type=int)
     parser.add_argument('--log_level', default='info')
     parser.add_argument('--logfile_name', default=None)
@@ -142,6 +218,22 @@ def parse_arguments():
     args.entity_detection_parallelism = max(args.entity_detection_parallelism, 1)
     args.test_mode = max(args.test_mode, 0)
     args.simple_progress_bar = str2bool(args.simple_progress_bar)
+    args.dedup_hypotheses = str2bool(args.dedup_hypotheses)
+    args.adaptive_concurrency = str2bool(args.adaptive_concurrency)
+    if args.input_src is None and not args.input_hypothesis.endswith('.jsonl'):
+        parser.error('--input_src is required unless --input_hypothesis is a packed .jsonl corpus')
+    if args.cassette_mode != 'off' and not args.cassette:
+        parser.error('--cassette is required with --cassette_mode record or replay')
+    try:
+        sharding.validate_shard(args.num_shards, args.shard_index)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.num_shards > 1:
+        args.merged_output_folder = args.output_folder
+        args.output_folder = sharding.shard_folder(args.output_folder, args.num_shards, args.shard_index)
+        args.trace_file = sharding.shard_path(args.trace_file, args.num_shards, args.shard_index)
+        args.cassette = sharding.shard_path(args.cassette, args.num_shards, args.shard_index)
+        args.metrics_textfile = sharding.shard_path(args.metrics_textfile, args.num_shards, args.shard_index)
     
     print(f'Input Arguments: {args}')
     return args
@@ -150,6 +242,9 @@ if __name__ == '__main__':
     args = parse_arguments()
     
     os.makedirs(args.output_folder, exist_ok=True)
+    if args.num_shards > 1:
+        # the outputs of this run are not complete until it writes a new marker
+        sharding.clear_shard_marker(args.output_folder)
 
     init_logging(args.log_level, args.logfile_name)
     logging.info('Starting Hallucination Detection')
@@ -166,6 +261,8 @@ if __name__ == '__main__':
     os.environ['AZURE_CORE_COLLECT_TELEMETRY'] = 'false'
 
     start_time = time.time()
+    if args.trace_file:
+        tracing.enable_tracing(args.trace_file)
 
     hallucination_result_folder = os.path.join(args.output_folder, 'hallucinations')
     os.makedirs(hallucination_result_folder, exist_ok=True)
@@ -174,10 +271,15 @@ if __name__ == '__main__':
     
     disable_progress_bar = not args.simple_progress_bar
 
-    dataloader = DataLoader(
-        hypothesis=args.input_hypothesis,
-        src_folder=args.input_src,
-        test_mode=args.test_mode)
+    profiling.enable_profiling_from_args(args, args.output_folder)
+    with profiling.stage(profiling.DATA_LOADING):
+        dataloader = DataLoader(
+            hypothesis=args.input_hypothesis,
+            src_folder=args.input_src,
+            test_mode=args.test_mode,
+            lazy=args.lazy_loading,
+            preprocess_workers=args.preprocess_workers,
+            data_id_filter=(lambda data_id: sharding.in_shard(data_id, args.num_shards, args.shard_index)) if args.num_shards > 1 else None)
 
     hypothesis = dataloader._hypothesis  # Not used
     source_docs = dataloader._src_docs
@@ -195,11 +297,37 @@ if __name__ == '__main__':
     if args.sentence_selector_type:
         sentence_selector = SentenceSelectorFactory.create_sentence_selector(args.sentence_selector_type)
 
+    gpt_limiter, ta_limiter = None, None
+    if args.adaptive_concurrency:
+        gpt_limiter = AdaptiveConcurrencyLimiter(
+            'gpt',
+            initial_limit=args.initial_concurrency,
+            max_limit=args.max_parallel_data * args.max_parallelism)
+        ta_limiter = AdaptiveConcurrencyLimiter(
+            'ta',
+            initial_limit=args.initial_concurrency,
+            max_limit=args.max_parallel_data * args.entity_detection_parallelism)
+
+    cassette = create_cassette(args.cassette, args.cassette_mode, args.cassette_latency_scale)
+
+    metrics_labels = {'aoai_config_setting': args.aoai_config_setting}
+    if args.num_shards > 1:
+        metrics_labels['shard'] = f'{args.shard_index}-of-{args.num_shards}'
+    metrics = MetricsRegistry(const_labels=metrics_labels)
+    for limiter in [gpt_limiter, ta_limiter]:
+        if limiter is not None:
+            metrics.gauge('concurrency_limit', 'Current adaptive limit on in-flight calls per endpoint').set_function(lambda l=limiter: int(l.current_limit), endpoint=limiter.name)
+            metrics.gauge('in_flight_calls', 'In-flight calls per endpoint').set_function(lambda l=limiter: l.in_flight, endpoint=limiter.name)
+
     entity_detector = None
     if args.entity_detector_type:
         if args.entity_detector_type == "text_analytics":
             args.entity_detector_type = "ta-general"
-        entity_detector = EntityDetectorFactory.create_entity_detector(args.entity_detector_type,ta_args=ta_args)
+        entity_detector = EntityDetectorFactory.create_entity_detector(args.entity_detector_type,ta_args=ta_args, ta_concurrency_limiter=ta_limiter, ta_cassette=cassette, ta_call_observers=[endpoint_call_observer(metrics, 'ta')])
+
+    verdict_cache = None
+    if args.verdict_cache_threshold > 0:
+        verdict_cache = NearDuplicateVerdictCache(threshold=args.verdict_cache_threshold)
 
     detection_agent = HallucinationDetector(
         sentence_selector=sentence_selector,
@@ -208,55 +336,125 @@ if __name__ == '__main__':
         detection_args=detector_args,
         aoai_config_file=args.aoai_config_file,
         entity_detection_parallelism=args.entity_detection_parallelism,
-        disable_progress_bar=pbar_disabled_batch_request_level)
-
-    allHallucinations = []
-    retval_jsonl = []
-
-    max_worker_threads = min(args.max_parallel_data, len(data_ids))
-    with tqdm(total=len(data_ids), disable=pbar_disabled_data_level) as pbar:
-        with ThreadPoolExecutor(max_workers=max_worker_threads) as executor:
-            data_tasks = {
-                executor.submit(
-                    detection_agent.detect_hallucinations,
-                    data_id,
-                    source_docs[data_id],
-                    hyp_sentences_preproc[data_id],): data_id for data_id in data_ids}
-            for task in as_completed(data_tasks):
-                try:
-                    data_id = data_tasks[task]
-                    hallucinations = task.result()
-                    for h in hallucinations:
-                        allHallucinations.append(h)
-                except Exception as exc:
-                    print(f'Error!! {type(exc).__name__}: {exc}')
+        disable_progress_bar=pbar_disabled_batch_request_level,
+        enable_hypothesis_dedup=args.dedup_hypotheses,
+        verdict_cache=verdict_cache,
+        request_timeout=args.request_timeout if args.request_timeout > 0 else None,
+        max_retry_wait=args.max_retry_wait,
+        concurrency_limiter=gpt_limiter,
+        cassette=cassette,
+        metrics=metrics)
+
+    # cancelling the run deadline (SIGTERM, Ctrl-C or --run_timeout) propagates to every data and in-flight request
+    run_deadline = Deadline(args.run_timeout)
+    def cancel_run(signum, frame):
+        print(f'Received signal {signum}, cancelling the run and writing partial results ...')
+        run_deadline.cancel()
+    signal.signal(signal.SIGTERM, cancel_run)
+
+    # the per-data deadline starts when the data leaves the queue, not when it is submitted
+    data_deadlines = {}
+    # with lazy loading the sentences are only read here, once per data, unless the preprocessing pool streams them in
+    data_sentence_counts = {}
+    def detect_with_deadline(data_id : str, submitted : float, sentences : list = None):
+        tracing.record_span('queued', submitted, time.perf_counter(), data_id=data_id)
+        data_deadlines[data_id] = run_deadline.child(args.data_timeout)
+        if sentences is None:
+            sentences = hyp_sentences_preproc[data_id]
+        data_sentence_counts[data_id] = len(sentences)
+        with tracing.span('document', data_id=data_id, n_sentences=len(sentences)) as document_span:
+            hallucinations = detection_agent.detect_hallucinations(
+                data_id,
+                source_docs[data_id],
+                sentences,
+                deadline=data_deadlines[data_id])
+            document_span.set(n_hallucinations=len(hallucinations), timed_out=data_deadlines[data_id].timed_out)
+        return hallucinations
+
+    metrics_textfile = args.metrics_textfile or os.path.join(intermediate_result_folder, 'metrics.prom')
+    metrics_writer = PeriodicTextfileWriter(metrics, metrics_textfile, args.metrics_interval).start()
+
+    # the run span is the parent of every document span; it is closed before the trace is written
+    with tracing.span('run', n_data=len(data_ids), max_parallel_data=args.max_parallel_data, max_parallelism=args.max_parallelism):
+        allHallucinations = []
+        retval_jsonl = []
+
+        max_worker_threads = min(args.max_parallel_data, len(data_ids))
+        with tqdm(total=len(data_ids), disable=pbar_disabled_data_level) as pbar:
+            with ThreadPoolExecutor(max_workers=max_worker_threads) as executor:
+                if dataloader.streams_preprocessing:
+                    data_stream = dataloader.stream_hypothesis_sentences(data_ids)
                 else:
-                    num_sentences : int = len(hyp_sentences_preproc[data_id])
-                    num_hallucinations : int = len(hallucinations)
-                    hallucination_rate : float = num_hallucinations / num_sentences if num_sentences > 0 else 0.0
-                    hallucinated : bool = num_hallucinations > 0
-                    retval_jsonl.append(
-                        {
-                            AllHallucinations.DATA_ID: data_id,
-                            AllHallucinations.HALLUCINATED: hallucinated,
-                            AllHallucinations.HALLUCINATION_SCORE: hallucination_rate,
-                            AllHallucinations.HALLUCINATIONS: hallucinations,
-                            AllHallucinations.NUM_TOTAL_SENTENCES: num_sentences,
-                            AllHallucinations.NUM_TOTAL_HALLUCINATIONS: num_hallucinations,
-                        })
-                pbar.update(1)
-
-        retval_jsonl = sorted(retval_jsonl, key=lambda d: (d[AllHallucinations.DATA_ID]))
-        outputFilePath = os.path.join(
-            hallucination_result_folder,
-            'allhallucinations.jsonl')
-        with open(outputFilePath, 'w') as hallucinationOutputF:
-            for kvp in retval_jsonl:
-                hallucinationOutputF.write(json.dumps(kvp) + '\n')
-
-        #detection_agent.PrintHallucinations(allHallucinations)
-        save_hallucinations(allHallucinations, intermediate_result_folder)
-        detection_agent.SortDebugHallucinations()
+                    data_stream = ((data_id, None) for data_id in data_ids)
+                data_tasks = {executor.submit(tracing.traced(detect_with_deadline), data_id, time.perf_counter(), sentences): data_id for data_id, sentences in data_stream}
+
+                def collect(task):
+                    try:
+                        data_id = data_tasks[task]
+                        hallucinations = task.result()
+                        for h in hallucinations:
+                            allHallucinations.append(h)
+                    except Exception as exc:
+                        print(f'Error!! {type(exc).__name__}: {exc}')
+                    else:
+                        retval_jsonl.append(to_output_record(data_id, data_sentence_counts[data_id], hallucinations, data_deadlines[data_id].timed_out))
+                    pbar.update(1)
+
+                # once cancelled, queued data return immediately and in-flight ones stop at their next request,
+                # so we keep collecting whatever partial results exist
+                collected = set()
+                while len(collected) < len(data_tasks):
+                    try:
+                        for task in as_completed([t for t in data_tasks if t not in collected]):
+                            collected.add(task)
+                            collect(task)
+                    except KeyboardInterrupt:
+                        print('Interrupted, cancelling the run and writing partial results ...')
+                        run_deadline.cancel()
+                # a cancelled or expired run leaves the data it did not reach unprocessed
+                run_cancelled = run_deadline.expired()
+
+            n_timed_out = sum(1 for x in retval_jsonl if x[AllHallucinations.TIMED_OUT])
+            if n_timed_out > 0:
+                print(f'{n_timed_out} data timed out or were cancelled, their results are partial (marked with "{AllHallucinations.TIMED_OUT}": true)')
+
+            with profiling.stage(profiling.OUTPUT_WRITING):
+                outputFilePath = save_all_hallucinations_jsonl(retval_jsonl, hallucination_result_folder)
+
+                #detection_agent.PrintHallucinations(allHallucinations)
+                save_hallucinations(allHallucinations, intermediate_result_folder)
+            if verdict_cache is not None:
+                save_verdict_cache_stats(verdict_cache, intermediate_result_folder)
+            source_stats = detection_agent._sources.stats
+            print(f"Distinct sources: {len(detection_agent._sources)} of {len(data_ids)} data, derived artifacts computed {source_stats['n_artifacts_computed']} times and reused {source_stats['n_artifacts_reused']} times")
+            if args.adaptive_concurrency:
+                concurrency_stats = [gpt_limiter.stats(), ta_limiter.stats()]
+                for stats in concurrency_stats:
+                    print(f"Adaptive concurrency [{stats['name']}]: final limit {stats['current_limit']}, peak in-flight {stats['peak_in_flight']}, outcomes {stats['counts']}")
+                with open(os.path.join(intermediate_result_folder, 'concurrency_stats.json'), 'w') as outF:
+                    json.dump(concurrency_stats, outF, indent=2)
+
+    if args.trace_file:
+        tracing.finish_tracing()
+        print(f'Trace written to {args.trace_file}')
+
+    profiling.finish_profiling()
+    metrics_writer.stop()
+    metrics.write_json(os.path.join(intermediate_result_folder, 'metrics_summary.json'))
+    print(f'Metrics written to {metrics_textfile} and metrics_summary.json')
+
+    if cassette is not None:
+        cassette.close()
+        print(f'Cassette {args.cassette} ({args.cassette_mode}): {cassette.stats}')
+
+    if args.num_shards > 1:
+        # a cancelled run (SIGTERM, Ctrl-C, --run_timeout) or data that failed leave the shard incomplete
+        shard_complete = not run_cancelled and len(retval_jsonl) == len(data_ids)
+        sharding.write_shard_marker(args.output_folder, args.num_shards, args.shard_index, data_ids, n_timed_out, complete=shard_complete)
+        if shard_complete:
+            print(f'Shard {args.shard_index} of {args.num_shards} complete, merge the shards of {args.merged_output_folder} with run_merge_shards')
+        else:
+            print(f'Shard {args.shard_index} of {args.num_shards} is incomplete ({len(retval_jsonl)} of {len(data_ids)} data, run cancelled: {run_cancelled}), run it again before merging')
 
     end_time = time.time() - start_time
     print('Hallucination Detection Has Finished')
@@ -4,15 +4,17 @@ import logging
 import os
 import time
 from glob import glob
-from typing import Dict, List
+from typing import Callable, Dict, List
 from pathlib import Path
 
-from CoNLI.modules.arguments import OpenaiArguments, create_openai_arguments
-from CoNLI.modules.hallucination_mitigator import HmResult, HdResult, HallucinationMitigator
-from CoNLI.modules.hd_constants import AllHallucinations, FieldName
+from CoNLI.modules.arguments import MitigationArguments, OpenaiArguments, create_openai_arguments
+from CoNLI.modules.hallucination_mitigator import HmResult, HdResult, HallucinationMitigator, to_hd_results
+from CoNLI.modules.hd_constants import AllHallucinations, MitigationMode
+from CoNLI.modules.mitigation_manifest import MitigationManifest, mitigation_input_hash
 from CoNLI.modules.utils.logging_utils import init_logging
 from CoNLI.modules.utils.conversion_utils import str2bool
 from CoNLI.modules.data.data_loader import DataLoader
+from CoNLI.modules.utils import profiling
 
 def rewrite(
         data_ids: List[str],
@@ -21,15 +23,18 @@ def rewrite(
         hd_results: Dict[str, List[HdResult]],
         openai_args: OpenaiArguments,
         config_file: str = None,
+        mitigation_args: MitigationArguments = MitigationArguments(),
+        on_result: Callable[[HmResult], None] = None,
     ) -> List[HmResult]:
     # init hallucination mitigator
-    hallucination_mitigator = HallucinationMitigator(openai_args = openai_args, config_file = config_file)
+    hallucination_mitigator = HallucinationMitigator(openai_args = openai_args, mitigation_args = mitigation_args, config_file = config_file)
     # run hallucination mititgator against enocunters
     results = hallucination_mitigator.mitigate(
         data_ids = data_ids,
         raw_responses = raw_responses,
         sources = sources,
         hd_results = hd_results, 
+        on_result = on_result,
     )
     return results
 
@@ -38,18 +43,7 @@ def load_hd_result(file_name: str) -> Dict[str, List[HdResult]]:
     # read hd_result jsonl for hallucination mitigation use
     for line in open(file_name):
         data = json.loads(line)
-        data_id = data[AllHallucinations.DATA_ID]
-        hallucinations = data[AllHallucinations.HALLUCINATIONS]
-        hd_results[data_id] = []
-        for hallucination in hallucinations:
-            hd_results[data_id].append(
-                HdResult(
-                    hallucinated_sentence = hallucination[FieldName.SENTENCE_TEXT],
-                    reason = hallucination[FieldName.REASON],
-                    instruction = hallucination[FieldName.REASON], #TODO: convert reason into better mitigation instruction
-                    detection_type = hallucination[FieldName.DETECTION_TYPE],
-                )
-            )
+        hd_results[data[AllHallucinations.DATA_ID]] = to_hd_results(data[AllHallucinations.HALLUCINATIONS])
     return hd_results
 
 def parse_arguments():
@@ -84,11 +78,27 @@ def parse_arguments():
         required=True,
         help='The Hallucination jsonl file that was generated by detect_hallucinations.py',
         type=str)
+    parser.add_argument(
+        '--mitigation_mode',
+        default=MitigationMode.DOCUMENT,
+        choices=[MitigationMode.DOCUMENT, MitigationMode.SENTENCE],
+        help='document: rewrite the whole response of a data with hallucinations; sentence: rewrite only its flagged sentences, shown with the text around them, and splice them back into the response',
+        type=str)
+    parser.add_argument(
+        '--pack_token_budget',
+        default=0,
+        help='Pack the document mode rewrites of short data into one request while their sources, responses and instructions fit in about this many tokens. Data whose answer cannot be split out of a pack are sent again alone. 0 disables packing',
+        type=int)
     parser.add_argument(
         '--max_parallel_data',
         default=5,
         help='The maximum number of data to process in parallel.  If set to 1, will run sequentially',
         type=int)
+    parser.add_argument(
+        '--resume',
+        default=False,
+        help='Skip the data whose output was already written by an earlier run from the same source, response and hallucinations (see mitigation_manifest.jsonl in --outputfolder)',
+        type=str2bool)
     parser.add_argument(
         '--testmode',
         default=0,
@@ -104,7 +114,7 @@ def parse_arguments():
         default='True',
         help='whether run a evaluation against ground truth sumamry after mitigation',
         type=str)
-    
+    profiling.add_profile_arguments(parser)
     parser.add_argument('--log_level', default='error')
     parser.add_argument('--logfile_name', default=None)
     args = parser.parse_args()
@@ -120,11 +130,15 @@ if __name__ == "__main__":
     os.makedirs(args.outputfolder, exist_ok=True)
 
     init_logging(args.log_level, args.logfile_name)
-    dataloader = DataLoader(
-        hypothesis=args.input_hypothesis,
-        src_folder=args.input_src,
-        # testmode=args.testmode
-    )
+    profiling.enable_profiling_from_args(args, args.outputfolder)
+    with profiling.stage(profiling.DATA_LOADING):
+        dataloader = DataLoader(
+            hypothesis=args.input_hypothesis,
+            src_folder=args.input_src,
+            # testmode=args.testmode
+            # only the raw responses and sources of the data being rewritten are read
+            lazy=True,
+        )
 
     if args.do_mitigate:
         logging.info('Starting Hallucination Detection')
@@ -139,21 +153,49 @@ if __name__ == "__main__":
         start_time = time.time()
         if os.path.isdir(args.hallucinationjsonl):
             args.hallucinationjsonl = glob(f"{args.hallucinationjsonl}/**/allhallucinations.jsonl", recursive=True)[0]
-        hd_results = load_hd_result(args.hallucinationjsonl)
+        with profiling.stage(profiling.DATA_LOADING):
+            hd_results = load_hd_result(args.hallucinationjsonl)
+        data_ids = list(hd_results.keys())[0:args.testmode] if args.testmode >0 else list(hd_results.keys())
+
+        # every output is written as soon as it is rewritten, and recorded with the hash of its inputs
+        manifest = MitigationManifest(args.outputfolder, resume=args.resume)
+        with profiling.stage(profiling.DATA_LOADING):
+            # the source of a data without hallucinations is not needed to pass it through
+            input_hashes = {
+                data_id: mitigation_input_hash(
+                    dataloader._src_docs[data_id] if len(hd_results[data_id]) > 0 else '',
+                    dataloader._hypothesis[data_id],
+                    hd_results[data_id],
+                    args.mitigation_mode)
+                for data_id in data_ids}
+        # a failed rewrite is neither written nor recorded, a resumed run tries it again
+        n_failed = [0]
+        def write_result(result : HmResult) -> None:
+            if result.failed:
+                n_failed[0] += 1
+                return
+            manifest.write(result.data_id, input_hashes[result.data_id], result.refined_response)
+
+        todo_data_ids = [data_id for data_id in data_ids if not manifest.is_done(data_id, input_hashes[data_id])]
+        if args.resume:
+            print(f'Resuming: {len(data_ids) - len(todo_data_ids)} of {len(data_ids)} data already rewritten from the same inputs')
+
         results = rewrite(
-            data_ids = list(hd_results.keys())[0:args.testmode] if args.testmode >0 else list(hd_results.keys()),
+            data_ids = todo_data_ids,
             raw_responses = dataloader._hypothesis,
             sources = dataloader._src_docs,
             hd_results = hd_results,
             openai_args = openai_args,
-            config_file=args.config_file
+            config_file=args.config_file,
+            mitigation_args = MitigationArguments(mode=args.mitigation_mode, pack_token_budget=args.pack_token_budget),
+            on_result = write_result,
         )
-
-        for result in results:
-            fname = f"{result.data_id}.txt"
-            with open(os.path.join(args.outputfolder, fname), 'w') as outF:
-                outF.write(result.refined_response)
+        manifest.close()
+        if n_failed[0] > 0:
+            print(f'Error!! the GPT call failed for {n_failed[0]} data, their outputs are not written. Rerun with --resume to retry them')
 
         end_time = time.time() - start_time
         print('Hallucination mitigation Has Finished')
-        print(f'Total wall-clock time: {end_time} seconds')
\ No newline at end of file
+        print(f'Total wall-clock time: {end_time} seconds')
+
+    profiling.finish_profiling()
\ No newline at end of file
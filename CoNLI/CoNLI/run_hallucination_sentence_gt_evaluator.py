@@ -1,14 +1,51 @@
 import argparse
-import pandas as pd
 import os
-from sklearn.metrics import classification_report
+from CoNLI.modules.utils import profiling
+
+
+# the classification report of a binary confusion matrix ([[tn, fp], [fn, tp]], rows are the ground truth), in the
+# layout of sklearn.metrics.classification_report. Undefined precision, recall or f1 are reported as 0
+def format_classification_report(confusion, target_names, digits=4):
+    confusion = [[int(c) for c in row] for row in confusion]
+    def ratio(a, b):
+        return a / b if b > 0 else 0.0
+    rows = []
+    for label in range(2):
+        tp = confusion[label][label]
+        predicted = confusion[0][label] + confusion[1][label]
+        support = sum(confusion[label])
+        precision, recall = ratio(tp, predicted), ratio(tp, support)
+        rows.append((target_names[label], precision, recall, ratio(2 * precision * recall, precision + recall), support))
+    total = rows[0][4] + rows[1][4]
+    accuracy = ratio(confusion[0][0] + confusion[1][1], total)
+    macro = [sum(row[k] for row in rows) / 2 for k in (1, 2, 3)]
+    weighted = [ratio(sum(row[k] * row[4] for row in rows), total) for k in (1, 2, 3)]
+
+    width = max(max(len(name) for name in target_names), len('weighted avg'), digits)
+    headers = ['precision', 'recall', 'f1-score', 'support']
+    row_fmt = '{:>{width}s} ' + ' {:>9.{digits}f}' * 3 + ' {:>9}\n'
+    report = ('{:>{width}s} ' + ' {:>9}' * len(headers)).format('', *headers, width=width) + '\n\n'
+    for row in rows:
+        report += row_fmt.format(*row, width=width, digits=digits)
+    report += '\n'
+    report += ('{:>{width}s} ' + ' {:>9.{digits}}' * 2 + ' {:>9.{digits}f}' + ' {:>9}\n').format('accuracy', '', '', accuracy, total, width=width, digits=digits)
+    report += row_fmt.format('macro avg', *macro, total, width=width, digits=digits)
+    report += row_fmt.format('weighted avg', *weighted, total, width=width, digits=digits)
+    return report
+
+
 class SentenceLevelEvaluator:
 
     def __init__(self, args, gtfile, hdfile) -> None:
+        # pandas is imported on use rather than at module level, so that --help stays fast
+        import pandas as pd
+        # HallucinationFinal.tsv is written as utf-8. Keys are read as strings so both files match whatever they hold
+        key_dtypes = {'DataID': str, 'SentenceID': str, 'data_id': str, 'sentenceid': str}
         self._gt_df = pd.read_csv(
-            gtfile, sep='\t', encoding='ISO-8859-1', header=0)
+            gtfile, sep='\t', encoding=args.gt_encoding, header=0, dtype=key_dtypes)
         self._hd_df = pd.read_csv(
-            hdfile, sep='\t', encoding='ISO-8859-1', header=0)
+            hdfile, sep='\t', encoding='utf-8', header=0, dtype=key_dtypes,
+            usecols=['data_id', 'sentenceid', 'detectiontype', 'reason'])
 
         self._filter_label_append = ''
         filter = args.filter
@@ -26,7 +63,7 @@ class SentenceLevelEvaluator:
             self._filter_label_append = f'-{filter_col}-{filter_value}'
             print(self._filter_label_append)
 
-            self._gt_df = self._gt_df[self._gt_df[filter_col] == filter_value]
+            self._gt_df = self._gt_df[self._gt_df[filter_col].astype(str) == filter_value]
             after_len = len(self._gt_df)
             if after_len == 0:
                 raise ValueError(
@@ -35,71 +72,60 @@ class SentenceLevelEvaluator:
             print(
                 f'GT File filtered down to {filter_col} == {filter_value} - Before: {before_len} After: {after_len}')
 
-    def __Run_Analysis_and_Save_Output(self, df_prediction, output_folder, label):
+    def __Save_Report(self, confusion, output_folder, label):
         label = f'{label}{self._filter_label_append}'
         outputtextfile = os.path.join(
             output_folder, f'intermediate/Analysis.Results.{label}.txt')
-        if not df_prediction.empty:
-            pred_gt = pd.merge(
-                df_prediction, 
-                self._gt_df, 
-                how = 'right', 
-                left_on = ['DataID', 'SentenceID'], 
-                right_on = ['DataID', 'SentenceID'])
-        else:
-            pred_gt = self._gt_df.copy()
-            pred_gt['IsHallucinatedSentence'] = False
-            pred_gt['reason'] = "Not Detected"
-            pred_gt['detectiontype'] = label
-        
-        pred_gt.fillna(False, inplace=True)
-
-        val_dict = {True: 1, False: 0, 'NaN': 0}
-        pred_gt['IsHallucination_pred'] = pred_gt['IsHallucinatedSentence'].map(
-            val_dict).fillna(0).astype(int)
         target_names = [
             f'CorrectSentences-{label}',
             f'HallucinatedSentences-{label}']
-
-        outputstr = classification_report(
-            pred_gt['IsHallucination'],
-            pred_gt['IsHallucination_pred'],
-            target_names=target_names,
-            digits=4)
+        outputstr = format_classification_report(confusion, target_names, digits=4)
         print(outputstr)
         with open(outputtextfile, 'w') as outF:
             outF.write(outputstr)
 
-        if label == 'OVERALL':
-            incorrect = pred_gt[pred_gt['IsHallucination'] != pred_gt['IsHallucination_pred']][['DataID', 'SentenceID', 'Sentence', 'IsHallucination','IsHallucination_pred', 'reason']]
-            incorrectfile = os.path.join(output_folder, 'intermediate/incorrect_classification.tsv')
-            incorrect.to_csv(incorrectfile, sep="\t", index=False)
-
     def Print_Sentence_Level_Results(self, args):
+        import numpy as np
+        import pandas as pd
         output_folder = args.output_folder
-        detectiontypes = list(self._hd_df['detectiontype'].unique())
-        detectiontypes.append('OVERALL')
-
-        for detectiontype in detectiontypes:
-            # Select
-            tmp_df = self._hd_df[['data_id', 'sentenceid', 'detectiontype', 'reason']]
-
-            # Filter
-            if detectiontype != 'OVERALL':
-                tmp_df = tmp_df[tmp_df['detectiontype'] == detectiontype]
-
-            # Drop
-            tmp_df = tmp_df.rename(columns={
-                'data_id': 'DataID',
-                'sentenceid': 'SentenceID'
-            })
-            
-            tmp_df = tmp_df.groupby(['DataID', 'SentenceID']).agg(list)
-
-            # Assign
-            tmp_df = tmp_df.assign(IsHallucinatedSentence=True)
-            self.__Run_Analysis_and_Save_Output(
-                tmp_df, output_folder, detectiontype)
+        n_gt = len(self._gt_df)
+
+        # one code per distinct (DataID, SentenceID) of both files
+        keys = pd.MultiIndex.from_arrays([
+            pd.concat([self._gt_df['DataID'], self._hd_df['data_id']], ignore_index=True),
+            pd.concat([self._gt_df['SentenceID'], self._hd_df['sentenceid']], ignore_index=True)])
+        key_codes, key_uniques = pd.factorize(keys)
+        gt_keys, hd_keys = key_codes[:n_gt], key_codes[n_gt:]
+        type_codes, detectiontypes = pd.factorize(self._hd_df['detectiontype'])
+        detectiontypes = list(detectiontypes) + ['OVERALL']
+        n_types = len(detectiontypes)
+
+        # flagged[t, k]: key k was detected by type t, the last row is any type
+        flagged = np.zeros((n_types, len(key_uniques)), dtype=bool)
+        flagged[type_codes, hd_keys] = True
+        flagged[-1] = flagged[:-1].any(axis=0)
+
+        # the confusion matrices of every type in one pass, over the codes (type, gt, pred) of every gt sentence
+        gt = self._gt_df['IsHallucination'].fillna(False).astype(bool).to_numpy(dtype=np.int64)
+        pred = flagged[:, gt_keys].astype(np.int64)
+        codes = (np.arange(n_types)[:, None] * 2 + gt[None, :]) * 2 + pred
+        confusions = np.bincount(codes.ravel(), minlength=n_types * 4).reshape(n_types, 2, 2)
+
+        for detectiontype, confusion in zip(detectiontypes, confusions):
+            self.__Save_Report(confusion, output_folder, detectiontype)
+
+        # sentences the detection got wrong, with the reasons of all its detections
+        incorrect_mask = gt != pred[-1]
+        incorrect = self._gt_df.loc[incorrect_mask, ['DataID', 'SentenceID', 'Sentence', 'IsHallucination']].copy()
+        incorrect['IsHallucination_pred'] = pred[-1][incorrect_mask]
+        incorrect_keys = gt_keys[incorrect_mask]
+        reasons = {}
+        needed = np.isin(hd_keys, incorrect_keys)
+        for key, reason in zip(hd_keys[needed], self._hd_df['reason'].to_numpy()[needed]):
+            reasons.setdefault(key, []).append(reason)
+        incorrect['reason'] = [reasons.get(key, False) for key in incorrect_keys]
+        incorrectfile = os.path.join(output_folder, 'intermediate/incorrect_classification.tsv')
+        incorrect.to_csv(incorrectfile, sep="\t", index=False)
 
 
 def parse_arguments():
@@ -119,11 +145,17 @@ def parse_arguments():
         default='',
         help='A single additional filter pivot (eg. Severity=critical)',
         type=str)
+    parser.add_argument(
+        '--gt_encoding',
+        default='utf-8',
+        help='Encoding of --gtfile, e.g. ISO-8859-1 for files saved as latin-1',
+        type=str)
     parser.add_argument(
         '--output_folder',
         required=True,
         help='Directory where the analysis output will be written.',
         type=str)
+    profiling.add_profile_arguments(parser)
     args = parser.parse_args()
     return args
 
@@ -140,5 +172,9 @@ if __name__ == '__main__':
         "intermediate/HallucinationFinal.tsv")
     os.makedirs(os.path.join(args.output_folder, "intermediate"), exist_ok=True)
 
-    evaluator = SentenceLevelEvaluator(args, gtfile, hdfile)
-    evaluator.Print_Sentence_Level_Results(args)
+    profiling.enable_profiling_from_args(args, args.output_folder)
+    with profiling.stage(profiling.DATA_LOADING):
+        evaluator = SentenceLevelEvaluator(args, gtfile, hdfile)
+    with profiling.stage(profiling.EVALUATION):
+        evaluator.Print_Sentence_Level_Results(args)
+    profiling.finish_profiling()
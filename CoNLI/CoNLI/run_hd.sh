@@ -76,8 +76,11 @@ do_export ta_config_setting ta-general
 do_export aoai_config_setting ${AoaiConfigSetting}
 
 # Experiment E2E Run Speed
-do_export max_parallel_data 2
-do_export max_parallel 2
+# with adaptive concurrency on, max_parallel_data x max_parallel is only the upper bound on
+# in-flight GPT calls; the actual limit follows the endpoint's throttling feedback
+do_export adaptive_concurrency True
+do_export max_parallel_data 8
+do_export max_parallel 4
 
 # On-screen display behavior
 do_export log_level error
@@ -109,6 +112,7 @@ do_hallucination_detection()
          --sentence_selector_type $sentence_selector \
          --max_parallel_data $max_parallel_data \
          --max_parallelism $max_parallel \
+         --adaptive_concurrency $adaptive_concurrency \
          --simple_progress_bar $use_simple_progressbar \
          --log_level $log_level \
          --test_mode $test_mode \
@@ -128,6 +132,7 @@ do_hallucination_detection()
     echo "Sentence Selector Type: $sentence_selector" >> ./CoNLI/baseline/$TaskName/details.txt
     echo "Max Parallel Encounters: $max_parallel_data" >> ./CoNLI/baseline/$TaskName/details.txt
     echo "Max Parallelism: $max_parallel" >> ./CoNLI/baseline/$TaskName/details.txt
+    echo "Adaptive Concurrency: $adaptive_concurrency" >> ./CoNLI/baseline/$TaskName/details.txt
     echo "Test Mode: test_mode $test_mode" >> ./CoNLI/baseline/$TaskName/details.txt
     echo "GPT Batch Size: $gpt_batch_size" >> ./CoNLI/baseline/$TaskName/details.txt
     echo "" >> ./CoNLI/baseline/$TaskName/details.txt
@@ -0,0 +1,33 @@
+import argparse
+import json
+
+from CoNLI.modules.utils import sharding
+from CoNLI.modules.utils.conversion_utils import str2bool
+
+# Merges the outputs of a sharded run_hallucination_detection (--num_shards) into <output_folder>,
+# in the layout of an unsharded run.
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--output_folder',
+        required=True,
+        type=str)
+    parser.add_argument(
+        '--num_shards',
+        required=True,
+        type=int)
+    parser.add_argument(
+        '--allow_incomplete',
+        default=False,
+        help='Merge the complete shards even if some are missing or were cancelled',
+        type=str2bool)
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    summary = sharding.merge_shards(args.output_folder, args.num_shards, args.allow_incomplete)
+    print(json.dumps(summary, indent=2))
+    if summary['missing_shards']:
+        print(f'Shards {summary["missing_shards"]} are missing from the merged output')
@@ -0,0 +1,54 @@
+import argparse
+import time
+from dataclasses import fields
+
+from CoNLI.modules.mock.mock_server_base import MockEndpointConfig
+from CoNLI.modules.mock.aoai_mock_server import create_aoai_mock_server
+from CoNLI.modules.mock.ta_mock_server import create_ta_mock_server
+from CoNLI.modules.utils.logging_utils import init_logging
+
+# Starts local stand-ins for the AOAI and Text Analytics endpoints, so that the detection and
+# mitigation pipelines can be run and benchmarked without Azure. Point the pipelines at them with
+# the "mock-gpt" setting of aoai_config.json and the "ta-mock" setting of ta_config.json.
+
+def add_endpoint_arguments(parser : argparse.ArgumentParser, prefix : str, defaults : MockEndpointConfig):
+    for f in fields(MockEndpointConfig):
+        parser.add_argument(
+            f'--{prefix}_{f.name}',
+            default=getattr(defaults, f.name),
+            help=f.metadata['help'],
+            type=type(getattr(defaults, f.name)))
+
+def endpoint_config_from_args(args, prefix : str) -> MockEndpointConfig:
+    return MockEndpointConfig(**{f.name: getattr(args, f'{prefix}_{f.name}') for f in fields(MockEndpointConfig)})
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--aoai_port', default=8000, help='Port of the mock AOAI endpoint (aoai_config.json: mock-gpt)', type=int)
+    parser.add_argument('--ta_port', default=8001, help='Port of the mock Text Analytics endpoint (ta_config.json: ta-mock)', type=int)
+    add_endpoint_arguments(parser, 'aoai', MockEndpointConfig(latency_median_ms=800, latency_per_output_token_ms=5))
+    add_endpoint_arguments(parser, 'ta', MockEndpointConfig(latency_median_ms=100))
+    parser.add_argument('--log_level', default='info')
+    parser.add_argument('--logfile_name', default=None)
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    init_logging(args.log_level, args.logfile_name)
+
+    aoai_server = create_aoai_mock_server(endpoint_config_from_args(args, 'aoai'), host=args.host, port=args.aoai_port).start()
+    ta_server = create_ta_mock_server(endpoint_config_from_args(args, 'ta'), host=args.host, port=args.ta_port).start()
+    print(f'Mock AOAI endpoint: {aoai_server.url}')
+    print(f'Mock Text Analytics endpoint: {ta_server.url}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f'AOAI mock stats: {aoai_server.state.stats}')
+        print(f'TA mock stats: {ta_server.state.stats}')
+        aoai_server.stop()
+        ta_server.stop()
@@ -0,0 +1,42 @@
+import argparse
+import time
+
+from CoNLI.modules.data.data_loader import DataLoader, LazyMapping
+from CoNLI.modules.data.packed_corpus import PackedCorpus, pack_corpus
+
+# Packs a folder of responses (or a sentence-level tsv) and a folder of sources into one jsonl corpus with an
+# offset index, which run_hallucination_detection --input_hypothesis <corpus>.jsonl reads on demand through a
+# memory map instead of opening one file per document.
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--input_hypothesis',
+        required=True,
+        help='The folder where all of your raw responses are located, or a sentence-level tsv file with columns: DataID, SentenceID, Sentence',
+        type=str)
+    parser.add_argument(
+        '--input_src',
+        required=True,
+        help='The folder where all of your source documents are located',
+        type=str)
+    parser.add_argument(
+        '--output',
+        required=True,
+        help='Path of the packed .jsonl corpus, its index is written next to it',
+        type=str)
+    args = parser.parse_args()
+    if not args.output.endswith('.jsonl'):
+        parser.error('--output must be a .jsonl file')
+    return args
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    start_time = time.time()
+    dataloader = DataLoader(hypothesis=args.input_hypothesis, src_folder=args.input_src, lazy=True)
+    if args.input_hypothesis.endswith('.tsv'):
+        # sentences keep their tsv sentence ids
+        n = pack_corpus(args.output, args.input_src, sentences=LazyMapping(dataloader._data_ids, lambda data_id: dataloader._hypothesis_preproc_sentences[data_id]))
+    else:
+        n = pack_corpus(args.output, args.input_src, responses=LazyMapping(dataloader._data_ids, lambda data_id: dataloader._hypothesis[data_id]))
+    print(f'Packed {n} data into {args.output} in {time.time() - start_time:.1f} seconds ({len(PackedCorpus(args.output))} indexed)')
@@ -1,5 +1,7 @@
 import argparse
+import os
 from CoNLI.modules.eval.response_quality_evaluation import QualityEvaluator
+from CoNLI.modules.utils import profiling
 
 
 def parse_arguments():
@@ -21,12 +23,53 @@ def parse_arguments():
         default=None,
         help='The folder where all of your ground truth responses are located',
         type=str) 
+    parser.add_argument(
+        '--num_workers',
+        default=0,
+        help='Processes that split and score ROUGE (and compute BLEU next to it). 0 computes them in this process',
+        type=int)
+    parser.add_argument(
+        '--bertscore_model',
+        default=None,
+        help='BERTScore model_type, a model name in the local Hugging Face cache. Defaults to the BERTScore default for english',
+        type=str)
+    parser.add_argument(
+        '--bertscore_batch_size',
+        default=64,
+        help='Pairs per BERTScore model batch',
+        type=int)
+    parser.add_argument(
+        '--bertscore_device',
+        default='cpu',
+        help='Device of the BERTScore model, e.g. cpu or cuda:0',
+        type=str)
+    parser.add_argument(
+        '--bertscore_cache',
+        default=None,
+        help='jsonl file of per pair BERTScore results, keyed by a hash of the model and texts. Pairs found there are not scored again',
+        type=str)
+    profiling.add_profile_arguments(parser)
     args = parser.parse_args()
     return args
 
 
 if __name__ == '__main__':
     args = parse_arguments()
-    evaluator = QualityEvaluator(args.llm_responses, args.input_src, args.ground_truth_response)
-    scores = evaluator.evaluate_responses()
-    print("score:", scores)
\ No newline at end of file
+    # no output folder here, profile reports go to ./profile
+    profiling.enable_profiling_from_args(args, os.getcwd())
+    with profiling.stage(profiling.DATA_LOADING):
+        evaluator = QualityEvaluator(
+            args.llm_responses,
+            args.input_src,
+            args.ground_truth_response,
+            num_workers=args.num_workers,
+            bertscore_args={
+                'model_type': args.bertscore_model,
+                'batch_size': args.bertscore_batch_size,
+                'device': args.bertscore_device,
+                'cache_file': args.bertscore_cache,
+            })
+    with profiling.stage(profiling.EVALUATION):
+        scores = evaluator.evaluate_responses()
+    print("score:", scores)
+    profiling.finish_profiling()
\ No newline at end of file
@@ -0,0 +1,105 @@
+import argparse
+import csv
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from CoNLI.run_benchmark import TASKS, latency_summary
+
+# Load generator for run_detection_service: replays the test_suite data as detection requests, either
+# closed-loop (--concurrency clients sending back to back) or open-loop (--rate Poisson arrivals per second,
+# which keeps sending when the service slows down), and reports the latency distribution and status counts.
+
+def load_requests(task : str) -> List[Dict]:
+    hypothesis_file, src_folder = [os.path.join(os.path.dirname(os.path.abspath(__file__)), p) for p in TASKS[task]]
+    sentences = {}
+    with open(hypothesis_file, encoding='utf-8') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            sentences.setdefault(str(row['DataID']), []).append(row['Sentence'])
+    requests = []
+    for data_id, data_sentences in sorted(sentences.items()):
+        src_file = os.path.join(src_folder, f'{data_id}.txt')
+        if not os.path.isfile(src_file):
+            continue
+        with open(src_file, encoding='utf-8') as f:
+            requests.append({'data_id': data_id, 'source': f.read(), 'sentences': data_sentences})
+    return requests
+
+def send(url : str, request : Dict, timeout : float) -> Dict:
+    body = json.dumps(request).encode('utf-8')
+    t0 = time.monotonic()
+    try:
+        req = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            status, payload = response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        status, payload = e.code, None
+    except Exception as e:
+        status, payload = type(e).__name__, None
+    return {'status': status, 'latency': time.monotonic() - t0, 'timed_out': bool(payload and payload.get('timed_out'))}
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:8080/', help='Base url of the detection service', type=str)
+    parser.add_argument('--task', default='summeval', choices=sorted(TASKS), help='test_suite data to send', type=str)
+    parser.add_argument('--num_requests', default=200, help='Requests to send, cycling over the data', type=int)
+    parser.add_argument('--concurrency', default=8, help='Closed loop: clients each sending the next request as soon as the previous one returns', type=int)
+    parser.add_argument('--rate', default=0, help='Open loop: mean requests per second with Poisson arrivals (overrides --concurrency)', type=float)
+    parser.add_argument('--timeout', default=300, help='Client timeout in seconds of a request', type=float)
+    parser.add_argument('--seed', default=1234, type=int)
+    parser.add_argument('--output_file', default=None, help='If set, append the summary to this jsonl file', type=str)
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    url = args.url.rstrip('/') + '/detect'
+    data = load_requests(args.task)
+    requests = [data[i % len(data)] for i in range(args.num_requests)]
+    print(f'Sending {len(requests)} requests from {args.task} ({len(data)} distinct) to {url}')
+
+    results = []
+    lock = threading.Lock()
+    def run(request):
+        result = send(url, request, args.timeout)
+        with lock:
+            results.append(result)
+
+    start = time.monotonic()
+    if args.rate > 0:
+        rng = random.Random(args.seed)
+        with ThreadPoolExecutor(max_workers=max(args.concurrency, 64)) as executor:
+            next_arrival = time.monotonic()
+            for request in requests:
+                next_arrival += rng.expovariate(args.rate)
+                time.sleep(max(next_arrival - time.monotonic(), 0))
+                executor.submit(run, request)
+    else:
+        with ThreadPoolExecutor(max_workers=max(args.concurrency, 1)) as executor:
+            list(executor.map(run, requests))
+    wall_clock = time.monotonic() - start
+
+    statuses = {}
+    for r in results:
+        statuses[str(r['status'])] = statuses.get(str(r['status']), 0) + 1
+    ok_latencies = [r['latency'] for r in results if r['status'] == 200]
+    summary = {
+        'task': args.task,
+        'mode': f'open loop, {args.rate} requests/sec' if args.rate > 0 else f'closed loop, {args.concurrency} clients',
+        'n_requests': len(results),
+        'statuses': statuses,
+        'n_timed_out': sum(1 for r in results if r['timed_out']),
+        'wall_clock_seconds': wall_clock,
+        'requests_per_second': len(ok_latencies) / wall_clock if wall_clock > 0 else None,
+        'latency': latency_summary(ok_latencies),
+    }
+    print(json.dumps(summary, indent=2))
+    if args.output_file:
+        with open(args.output_file, 'a') as f:
+            f.write(json.dumps(summary) + '\n')
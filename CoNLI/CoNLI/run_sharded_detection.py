@@ -0,0 +1,87 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from CoNLI.modules.utils import sharding
+from CoNLI.modules.utils.conversion_utils import str2bool
+
+# Runs run_hallucination_detection as --num_shards local processes, each on the data ids that hash to
+# its shard, then merges the shard outputs into <output_folder>. All other arguments are forwarded to
+# every shard. To spread the shards over several nodes sharing the output folder, run a subset of them
+# on each node with --shard_indices and --merge false, then run run_merge_shards once all are complete.
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--output_folder',
+        required=True,
+        type=str)
+    parser.add_argument(
+        '--num_shards',
+        required=True,
+        type=int)
+    parser.add_argument(
+        '--shard_indices',
+        default='',
+        help='Comma separated shards to run on this node, defaults to all of them',
+        type=str)
+    parser.add_argument(
+        '--merge',
+        default=True,
+        help='Merge the shard outputs once all the shards are complete',
+        type=str2bool)
+    args, detection_args = parser.parse_known_args()
+    if args.shard_indices:
+        args.shard_indices = [int(i) for i in args.shard_indices.split(',') if i.strip()]
+    else:
+        args.shard_indices = list(range(args.num_shards))
+    try:
+        for shard_index in args.shard_indices:
+            sharding.validate_shard(args.num_shards, shard_index)
+    except ValueError as e:
+        parser.error(str(e))
+    return args, detection_args
+
+def launch_shard(args, detection_args, shard_index : int) -> subprocess.Popen:
+    folder = sharding.shard_folder(args.output_folder, args.num_shards, shard_index)
+    os.makedirs(folder, exist_ok=True)
+    cmd = [sys.executable, '-m', 'CoNLI.run_hallucination_detection',
+           *detection_args,
+           '--output_folder', args.output_folder,
+           '--num_shards', str(args.num_shards),
+           '--shard_index', str(shard_index),
+           '--logfile_name', os.path.join(folder, 'detection.log')]
+    stdout = open(os.path.join(folder, 'stdout.log'), 'w')
+    process = subprocess.Popen(cmd, stdout=stdout, stderr=subprocess.STDOUT)
+    stdout.close()
+    return process
+
+if __name__ == '__main__':
+    args, detection_args = parse_arguments()
+    start_time = time.time()
+
+    processes = {i: launch_shard(args, detection_args, i) for i in args.shard_indices}
+    print(f'Started {len(processes)} of {args.num_shards} shards, logs in {os.path.join(args.output_folder, "shards")}')
+    failed = []
+    try:
+        for shard_index, process in processes.items():
+            returncode = process.wait()
+            if returncode != 0:
+                failed.append(shard_index)
+                print(f'Shard {shard_index} failed with exit code {returncode}')
+    except KeyboardInterrupt:
+        # the shards received the same SIGINT and write their partial results
+        for process in processes.values():
+            process.wait()
+        raise
+    print(f'Shards finished in {time.time() - start_time:.1f} seconds')
+
+    if failed:
+        sys.exit(f'Shards {failed} failed, rerun them with --shard_indices {",".join(str(i) for i in failed)}')
+    if args.merge and len(args.shard_indices) == args.num_shards:
+        summary = sharding.merge_shards(args.output_folder, args.num_shards)
+        print(f'Merged {summary["n_data"]} data from {args.num_shards} shards into {summary["output"]}')
+    elif args.merge:
+        print(f'Ran shards {args.shard_indices} only, run run_merge_shards once all {args.num_shards} shards are complete')
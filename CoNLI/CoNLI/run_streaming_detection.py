@@ -0,0 +1,244 @@
+import argparse
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict
+
+from CoNLI.modules.arguments import DetectionArguments, create_openai_arguments, create_ta_arguments
+from CoNLI.modules.data.record_input import RecordError, create_response_preprocess, iter_jsonl_records, record_sentences
+from CoNLI.modules.entity_detector import EntityDetectorFactory
+from CoNLI.modules.sentence_selector import SentenceSelectorFactory
+from CoNLI.modules.hallucination_detector import HallucinationDetector
+from CoNLI.modules.hd_output import to_output_record
+from CoNLI.modules.utils.conversion_utils import str2bool
+from CoNLI.modules.utils.deadline import Deadline
+from CoNLI.modules.utils.logging_utils import init_logging
+
+# Streaming hallucination detection for unix pipelines and queue consumers:
+#   cat responses.jsonl | python -m CoNLI.run_streaming_detection ... > allhallucinations.jsonl
+# Reads {"data_id", "source", "response" | "sentences"} json lines from stdin (or --input), starts detecting
+# each one as soon as it is read, and writes its allhallucinations.jsonl record to stdout (or --output) as
+# soon as it completes. At most --max_pending records are read ahead of the output, so memory stays bounded
+# whatever the length of the stream. Everything else the pipeline prints goes to stderr.
+
+class OutputWriter:
+    """
+    Writes the result of the record with sequence number seq. Unordered, results go out as they complete;
+    ordered, a result waits in a reorder buffer until every earlier record has been written. release is
+    called once per written record, which frees a read-ahead slot.
+    """
+    def __init__(self, stream, ordered : bool, release) -> None:
+        self._stream = stream
+        self._ordered = ordered
+        self._release = release
+        self._lock = threading.Lock()
+        self._next_seq = 0
+        self._buffer : Dict[int, Dict] = {}
+        self.n_written = 0
+
+    def _write(self, result : Dict) -> None:
+        self._stream.write(json.dumps(result) + '\n')
+        self.n_written += 1
+        self._release()
+
+    def put(self, seq : int, result : Dict) -> None:
+        with self._lock:
+            if not self._ordered:
+                self._write(result)
+            else:
+                self._buffer[seq] = result
+                while self._next_seq in self._buffer:
+                    self._write(self._buffer.pop(self._next_seq))
+                    self._next_seq += 1
+            self._stream.flush()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--input',
+        default='-',
+        help='jsonl file of {"data_id", "source", "response" | "sentences"} records, - for stdin',
+        type=str)
+    parser.add_argument(
+        '--output',
+        default='-',
+        help='jsonl file the allhallucinations records are written to, - for stdout',
+        type=str)
+    parser.add_argument(
+        '--ordered',
+        default=False,
+        help='Write the results in input order (a slow record then holds back the ones after it) instead of as they complete',
+        type=str2bool)
+    parser.add_argument(
+        '--max_pending',
+        default=0,
+        help='Records read ahead of the output (in flight or waiting to be written). Defaults to 4 x --max_parallel_data',
+        type=int)
+    parser.add_argument(
+        '--entity_detector_type',
+        default="text_analytics",
+        help='entity detector type: pass_through, text_analytics. If ensembled, you must also specify as ensembled:type1,type2 ...',
+        type=str)
+    parser.add_argument(
+        '--sentence_selector_type',
+        default="pass_through",
+        help='entity detector type: pass_through, None. If ensembled, you must also specify as ensembled:type1,type2 ...',
+        type=str)
+    parser.add_argument(
+        '--aoai_config_file',
+        default=(Path(__file__).absolute()).parent/"configs"/"aoai_config.json",
+        help='JSON file holding the aoai endpoint configs',
+        type=str)
+    parser.add_argument(
+        '--aoai_config_setting',
+        default='gpt-4-32k',
+        help='The configuration setting to run against (aoai_config.json)',
+        type=str)
+    parser.add_argument(
+        '--ta_config_file',
+        default=(Path(__file__).absolute()).parent/"configs"/"ta_config.json",
+        help='JSON file holding the text analytics endpoint configs',
+        type=str)
+    parser.add_argument(
+        '--ta_config_setting',
+        default='ta-general',
+        help='The configuration setting to run against (ta_config.json)',
+        type=str)
+    parser.add_argument(
+        '--max_parallel_data',
+        default=2,
+        help='The maximum number of records to process in parallel',
+        type=int)
+    parser.add_argument(
+        '--max_parallelism',
+        default=2,
+        help='The maximum number of GPT requests to send in parallel per record',
+        type=int)
+    parser.add_argument(
+        '--entity_detection_parallelism',
+        default=2,
+        help='The maximum number of entity detection batches to process in parallel per record',
+        type=int)
+    parser.add_argument(
+        '--dedup_hypotheses',
+        default=False,
+        help='Reuse the verdict of a (source, hypothesis) pair already checked for an earlier record. The table grows with the stream',
+        type=str2bool)
+    parser.add_argument(
+        '--request_timeout',
+        default=0,
+        help='Timeout in seconds of a single GPT http call. 0 keeps the openai default',
+        type=float)
+    parser.add_argument(
+        '--max_retry_wait',
+        default=60,
+        help='Upper bound in seconds on a single back-off sleep after a throttled or failed GPT call',
+        type=float)
+    parser.add_argument(
+        '--data_timeout',
+        default=0,
+        help='Deadline in seconds for detecting a single record. Work left at the deadline is dropped and the record is marked as timed out. 0 disables the deadline',
+        type=float)
+    parser.add_argument('--gpt_batch_size', default=1, type=int)
+    parser.add_argument('--log_level', default='info')
+    parser.add_argument('--logfile_name', default=None)
+    args = parser.parse_args()
+
+    args.max_parallel_data = max(args.max_parallel_data, 1)
+    args.max_parallelism = max(args.max_parallelism, 1)
+    args.entity_detection_parallelism = max(args.entity_detection_parallelism, 1)
+    if args.max_pending <= 0:
+        args.max_pending = 4 * args.max_parallel_data
+    args.max_pending = max(args.max_pending, args.max_parallel_data)
+    print(f'Input Arguments: {args}')
+    return args
+
+if __name__ == '__main__':
+    # stdout carries the results only
+    output_stream = sys.stdout
+    sys.stdout = sys.stderr
+
+    args = parse_arguments()
+    init_logging(args.log_level, args.logfile_name)
+    os.environ['TOKENIZERS_PARALLELISM'] = 'true'
+    os.environ['AZURE_CORE_COLLECT_TELEMETRY'] = 'false'
+
+    openai_args = create_openai_arguments(args.aoai_config_setting, args.max_parallelism, config_file=args.aoai_config_file)
+    detector_args = DetectionArguments()
+    detector_args.batch_size = args.gpt_batch_size
+
+    sentence_selector = None
+    if args.sentence_selector_type:
+        sentence_selector = SentenceSelectorFactory.create_sentence_selector(args.sentence_selector_type)
+    entity_detector = None
+    if args.entity_detector_type:
+        if args.entity_detector_type == "text_analytics":
+            args.entity_detector_type = "ta-general"
+        ta_args = create_ta_arguments(args.ta_config_setting, ta_config_file=args.ta_config_file)
+        entity_detector = EntityDetectorFactory.create_entity_detector(args.entity_detector_type, ta_args=ta_args)
+
+    detector = HallucinationDetector(
+        sentence_selector=sentence_selector,
+        entity_detector=entity_detector,
+        openai_args=openai_args,
+        detection_args=detector_args,
+        aoai_config_file=args.aoai_config_file,
+        entity_detection_parallelism=args.entity_detection_parallelism,
+        disable_progress_bar=True,
+        enable_hypothesis_dedup=args.dedup_hypotheses,
+        request_timeout=args.request_timeout if args.request_timeout > 0 else None,
+        max_retry_wait=args.max_retry_wait)
+    preprocess = create_response_preprocess()
+
+    input_stream = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+    if args.output != '-':
+        output_stream = open(args.output, 'w', encoding='utf-8')
+
+    # SIGTERM / Ctrl-C stop the reading, the records already read are completed and written
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    pending = threading.BoundedSemaphore(args.max_pending)
+    writer = OutputWriter(output_stream, args.ordered, pending.release)
+    n_read = 0
+
+    def detect(seq : int, line_no : int, record) -> None:
+        data_id = record.get('data_id') if isinstance(record, dict) else None
+        try:
+            if isinstance(record, Exception):
+                raise record
+            sentences = record_sentences(record, preprocess)
+            data_id = str(data_id if data_id is not None else line_no)
+            deadline = Deadline(args.data_timeout)
+            hallucinations = detector.detect_hallucinations(data_id, record['source'], sentences, deadline=deadline)
+            result = to_output_record(data_id, len(sentences), hallucinations, deadline.timed_out)
+        except Exception as exc:
+            if not isinstance(exc, RecordError):
+                logging.exception(f'Detection failed for line {line_no}')
+            result = {'data_id': data_id, 'line': line_no, 'error': f'{type(exc).__name__}: {exc}'}
+        writer.put(seq, result)
+
+    start_time = time.time()
+    futures = []
+    try:
+        with ThreadPoolExecutor(max_workers=args.max_parallel_data) as executor:
+            for line_no, record in iter_jsonl_records(input_stream):
+                pending.acquire()
+                futures.append(executor.submit(detect, n_read, line_no, record))
+                n_read += 1
+                # drop the references to completed records
+                if len(futures) > args.max_pending:
+                    futures = [f for f in futures if not f.done()]
+    except KeyboardInterrupt:
+        # the executor has already waited for the records in flight
+        print('Interrupted, stopped reading the input')
+
+    if args.output != '-':
+        output_stream.close()
+    print(f'Streaming detection finished: {n_read} records read, {writer.n_written} written in {time.time() - start_time:.1f} seconds')